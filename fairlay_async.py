@@ -0,0 +1,163 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from fairlay_client import (FairlayProtocol, FairlayServiceUnavailable, ConcurrentCalls, PublicCall,
+                            PublicAPI_address)
+from fairlay_transport import AsyncFairlayConnectionPool
+from request_metrics import METRICS
+
+
+class AsyncFairlayClient(FairlayProtocol):
+    '''
+    asyncio twin of FairlayPythonClient. It has the same API methods, as
+    coroutines, e.g.
+
+        async with AsyncFairlayClient() as client:
+            balance, orders = await asyncio.gather(client.get_balance(),
+                                                   client.get_orders('unmatched'))
+
+    Private API requests share a pool of up to max_connections TCP connections
+    and public API requests share one keep-alive HTTP session.
+    '''
+
+    PUBLIC_TIMEOUT = 15
+
+    def __init__(self, signing_processes=0, requests_per_second=None, max_connections=100):
+        super(AsyncFairlayClient, self).__init__(signing_processes, requests_per_second)
+        self.__pool = AsyncFairlayConnectionPool(self.CONFIG['SERVERIP'], self.CONFIG['PORT'],
+                                                 max_connections)
+        self.__session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.__pool.close()
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def _run(self, call):
+        response, error = None, None
+        while True:
+            try:
+                request = call.throw(error) if error else call.send(response)
+            except StopIteration as stop:
+                return stop.value
+
+            try:
+                response, error = await self.__dispatch(request), None
+            except Exception as e:
+                response, error = None, e
+
+    async def __dispatch(self, request, message=None):
+        if isinstance(request, ConcurrentCalls):
+            return await self.__dispatch_concurrent(request)
+        if isinstance(request, PublicCall):
+            return await self.__public_request(request.endpoint, request.json)
+        return await self.__send_request(request.endpoint, request.data, message)
+
+    async def __dispatch_concurrent(self, request):
+        slots = asyncio.Semaphore(request.limit)
+
+        async def dispatch_one(call, message):
+            try:
+                async with slots:
+                    return request.parse(await self.__dispatch(call, message))
+            except Exception as e:
+                if not request.return_exceptions:
+                    raise
+                return e
+
+        # Signing may use a process pool, keep it off the event loop
+        messages = await asyncio.get_running_loop().run_in_executor(None, self._encode_requests, request.calls)
+        return await asyncio.gather(*[dispatch_one(c, m) for c, m in zip(request.calls, messages)])
+
+    async def __send_request(self, endpoint, data=None, message=None):
+        '''
+        Private API
+        '''
+        while True:
+            message = message or self._encode_request(endpoint, data)
+            if self._rate_limiter:
+                delay = self._rate_limiter.reserve()
+                if delay > 0 and METRICS.enabled:
+                    METRICS.rate_limited('fairlay', endpoint, delay)
+                await asyncio.sleep(delay)
+            start = time.perf_counter()
+            try:
+                response = await self.__pool.request(message)
+            except (asyncio.TimeoutError, OSError):
+                if METRICS.enabled:
+                    METRICS.observe('fairlay', endpoint, time.perf_counter() - start, len(message), error=True)
+                return
+
+            try:
+                result = self._decode_response(response)
+            except FairlayServiceUnavailable:
+                if METRICS.enabled:
+                    METRICS.observe('fairlay', endpoint, time.perf_counter() - start, len(message), len(response),
+                                    error=True)
+                    METRICS.retry('fairlay', endpoint)
+                message = None
+                await asyncio.sleep(self.RETRY_DELAY)
+                continue
+            if METRICS.enabled:
+                METRICS.observe('fairlay', endpoint, time.perf_counter() - start, len(message), len(response))
+            return result
+
+    def pool_stats(self):
+        '''
+        Response: dictionary with the private API connection pool counters
+        '''
+        return self.__pool.stats()
+
+    async def __public_request(self, endpoint, as_json=True):
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.PUBLIC_TIMEOUT))
+
+        # Request: http://83.171.236.114:8080/free{1..9}/{method}/{parameters}
+        name = endpoint.split('/', 1)[0]
+        for attempt in range(self.PUBLIC_TRIES):
+            slot, wait = self._public_slots.acquire()
+            if METRICS.enabled:
+                if attempt:
+                    METRICS.retry('fairlay_public', name)
+                if wait > 0:
+                    METRICS.rate_limited('fairlay_public', name, wait)
+            await asyncio.sleep(wait)
+            start = time.monotonic()
+            try:
+                async with self.__session.get(PublicAPI_address + '/free' + str(slot) + '/' + endpoint) as response:
+                    text = await response.text()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self._public_slots.release(slot, error=True)
+                if METRICS.enabled:
+                    METRICS.observe('fairlay_public', name, time.monotonic() - start, error=True)
+                continue
+
+            if text == 'XError: Service unavailable':
+                self._public_slots.release(slot, error=True)
+                if METRICS.enabled:
+                    METRICS.observe('fairlay_public', name, time.monotonic() - start, received=len(text), error=True)
+                    METRICS.rate_limited('fairlay_public', name)
+                continue
+            self._public_slots.release(slot, time.monotonic() - start)
+            if METRICS.enabled:
+                METRICS.observe('fairlay_public', name, time.monotonic() - start, received=len(text),
+                                error='XError' in text)
+
+            if 'XError' in text:
+                return
+
+            if as_json:
+                return json.loads(text)
+            else:
+                return text
+        raise aiohttp.ClientConnectionError('No free public API slot answered')
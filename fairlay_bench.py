@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+'''
+Micro-benchmarks for the Fairlay client internals. Run one of them with
+
+    $ python fairlay_bench.py signing --count 500 --processes 4
+    $ python fairlay_bench.py response --size 8
+    $ python fairlay_bench.py markets --dump markets.json
+'''
+
+import argparse
+import base64
+import gc
+import gzip
+import io
+import json
+import random
+import time
+import tracemalloc
+
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from Crypto.Hash import SHA512
+
+from fairlay_crypto import FairlayCryptoContext
+from fairlay_markets import Market
+from fairlay_transport import FairlayResponseReader
+
+
+def _report(name, count, seconds, unit):
+    print(f'{name:<32} {count / seconds:>12.1f} {unit}/s  ({count} in {seconds:.3f}s)')
+
+
+def _change_orders_messages(count):
+    messages = []
+    for i in range(count):
+        orders = [{'Mid': str(82339763895 + i), 'Rid': '0', 'Oid': '-1', 'Am': 5, 'Pri': 5.645,
+                   'Sub': '', 'Type': 0, 'Boa': 1, 'Mct': 0}]
+        messages.append('{}|{}|{}|{}'.format(1634000000000 + i, 1023391, 4061, json.dumps(orders)))
+    return messages
+
+
+def bench_signing(args):
+    private_key = RSA.generate(2048, e=65537).exportKey('PEM').decode()
+    messages = _change_orders_messages(args.count)
+
+    # Before: the key is parsed and a signer is built for every message
+    start = time.perf_counter()
+    for message in messages:
+        signer = PKCS1_v1_5.new(RSA.importKey(private_key))
+        base64.b64encode(signer.sign(SHA512.new(message.encode('utf-8'))))
+    _report('importKey per message', len(messages), time.perf_counter() - start, 'signatures')
+
+    context = FairlayCryptoContext(private_key)
+    start = time.perf_counter()
+    for message in messages:
+        context.sign(message)
+    _report('cached context', len(messages), time.perf_counter() - start, 'signatures')
+
+    context = FairlayCryptoContext(private_key, processes=args.processes)
+    context.sign_many(messages[:2])  # start the workers outside of the measurement
+    start = time.perf_counter()
+    context.sign_many(messages)
+    _report('cached context, process pool', len(messages), time.perf_counter() - start, 'signatures')
+    context.close()
+
+
+class _ReplaySocket(object):
+    '''Serves a recorded response through recv/recv_into, like a socket would'''
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def recv(self, size):
+        return self.stream.read(size)
+
+    def recv_into(self, buffer):
+        return self.stream.readinto(buffer)
+
+
+def _unmatched_orders_page(size):
+    order = {'_UnmatchedOrder': {'_Type': 0, 'Price': 1.25, 'PrivCancelAt': 3155378975999999999,
+                                 'PrivSubUser': 'fairlay-1', 'State': 0, 'PrivAmount': 20.0, 'makerCT': 0,
+                                 'RemAmount': 20.0, 'PrivUserID': 1100080, 'PrivID': 636116964109686557,
+                                 'BidOrAsk': 0},
+             '_UserOrder': {'RunnerID': 0, 'OrderID': 636116964109686557, 'MatchedSubUser': None,
+                            'BidOrAsk': 0, 'MarketID': 85924869998}}
+    count = size // len(json.dumps(order)) + 1
+    return json.dumps([order] * count)
+
+
+def _measure(name, func, size):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'{name:<32} {size / seconds / 2**20:>8.1f} MB/s  peak memory {peak / 2**20:.1f} MB')
+
+
+def bench_response(args):
+    key = RSA.generate(2048, e=65537)
+    context = FairlayCryptoContext(key.exportKey('PEM').decode(), key.publickey().exportKey('PEM').decode())
+
+    payload = '{}|{}|{}'.format(1634000000000, 1023391, _unmatched_orders_page(args.size * 2**20))
+    response = '{}|{}'.format(context.sign(payload), payload).encode('utf-8')
+    compressed = gzip.compress(response)
+    print(f'{len(response) / 2**20:.1f} MB response, {len(compressed) / 2**20:.1f} MB compressed')
+
+    def concatenate():
+        # Before: 4 KB chunks appended to one buffer, decompressed once complete
+        conn = _ReplaySocket(compressed)
+        data = b''
+        while True:
+            new_data = conn.recv(4096)
+            if not new_data:
+                break
+            data += new_data
+        message = gzip.GzipFile(fileobj=io.BytesIO(data)).read().decode('utf-8')
+        idx = message.find('|')
+        signature = message[:idx]
+        verifier = PKCS1_v1_5.new(key.publickey())
+        verifier.verify(SHA512.new(message[idx+1:].encode('utf-8')),
+                        base64.b64decode(signature + '=' * ((4 - len(signature) % 4) % 4)))
+        return message.split('|')[-1]
+
+    def stream():
+        conn = _ReplaySocket(compressed)
+        reader = FairlayResponseReader()
+        while not reader.done:
+            reader.readinto(conn)
+        context.verify(reader.output)
+        return str(memoryview(reader.output)[reader.output.rfind(b'|') + 1:], 'utf-8')
+
+    _measure('concatenate, then decompress', concatenate, len(response))
+    _measure('streaming reader', stream, len(response))
+
+
+def _market_dump(count):
+    competitions = ['NFL', 'NCAA', 'NBA', 'Premier League', 'ATP', 'Bad News']
+    markets = []
+    for i in range(count):
+        order_book = '~'.join(json.dumps({'S': 1, 'Bids': [[round(random.uniform(1.01, 10), 3), 19.0]] * 5,
+                                          'Asks': [[round(random.uniform(1.01, 10), 3), 13.0]] * 5})
+                              for _ in range(2))
+        markets.append({
+            'ID': 57650700754 + i, 'CatID': random.choice([12, 13, 1, 2]), 'Comp': random.choice(competitions),
+            'Title': f'Market {i}', 'Descr': 'This market resolves to ... ' * 10,
+            'Ru': [{'RedA': 0.0, 'VisDelay': 3000, 'Name': 'Yes', 'VolMatched': 0.0},
+                   {'RedA': 0.0, 'VisDelay': 3000, 'Name': 'No', 'VolMatched': 0.0}],
+            'LastSoftCh': '2015-11-30T00:50:09.2443208Z', 'LastCh': '2015-10-30T06:05:00.7541435Z',
+            'OrdBStr': order_book, 'Status': 0, '_Type': 2, '_Period': 1, 'SettlT': 0, 'Comm': 0.02,
+            'ClosD': '2016-10-01T00:00:00', 'SettlD': '2017-01-01T00:00:00', 'Margin': 10000.0,
+            'MaxVal': 0.0, 'MinVal': 0.0, 'CreatorName': 'FairMM', 'Pop': 0.0,
+        })
+    return json.dumps(markets)
+
+
+def _retained(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def bench_markets(args):
+    if args.dump:
+        with open(args.dump) as f:
+            dump = f.read()
+    else:
+        dump = _market_dump(args.count)
+
+    markets, dict_size = _retained(lambda: json.loads(dump))
+    print(f'{len(markets)} markets')
+    del markets
+    markets, object_size = _retained(lambda: [Market(m) for m in json.loads(dump)])
+    print(f'{"dicts":<32} {dict_size / 2**20:>8.1f} MB')
+    print(f'{"Market objects":<32} {object_size / 2**20:>8.1f} MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fairlay client micro-benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    signing = subparsers.add_parser('signing', help='RSA request signing throughput')
+    signing.add_argument('-c', '--count', type=int, default=500,
+                         help='Number of change_orders messages to sign (default:500)')
+    signing.add_argument('-p', '--processes', type=int, default=None,
+                         help='Signing processes (default: all cores)')
+    signing.set_defaults(func=bench_signing)
+
+    response = subparsers.add_parser('response', help='Private API response reading and verification')
+    response.add_argument('-s', '--size', type=int, default=8,
+                          help='Decompressed response size in MB (default:8)')
+    response.set_defaults(func=bench_response)
+
+    markets = subparsers.add_parser('markets', help='Memory of a market dump as dicts and as Market objects')
+    markets.add_argument('-d', '--dump', default=None,
+                         help='JSON file saved from get_markets_and_odds (default: generated markets)')
+    markets.add_argument('-c', '--count', type=int, default=20000,
+                         help='Number of generated markets (default:20000)')
+    markets.set_defaults(func=bench_markets)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,19 +1,23 @@
 # Cloned from official site, modified for supporting Python 3
+import abc
 import json
 import socket
-import gzip
-import io
-import base64
 import sys
 import time
 import datetime
-import random
 import threading
+import collections
+import concurrent.futures
+import functools
 
 import requests
 from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
-from Crypto.Hash import SHA512
+
+from fairlay_crypto import FairlayCryptoContext
+from fairlay_markets import FairlayMarketStore, FairlayOrderBookDiff, Market
+from fairlay_matched import FairlayMatchedOrderTracker, FairlayPositionEngine
+from fairlay_transport import FairlayConnectionPool, FairlayRateLimiter, FairlaySlotBalancer
+from request_metrics import METRICS
 
 ### Update this if needed ###
 PublicAPI_address = 'http://83.171.236.114:8080'
@@ -23,7 +27,41 @@ def convert_ticks_to_datetime(s):
     return datetime.datetime(1, 1, 1) + datetime.timedelta(microseconds=int(s)/10)
 
 
-class FairlayPythonClient(object):
+# Requests yielded by the protocol calls of FairlayProtocol
+PrivateCall = collections.namedtuple('PrivateCall', ['endpoint', 'data'])
+PublicCall = collections.namedtuple('PublicCall', ['endpoint', 'json'])
+# Up to `limit` of `calls` in flight at once, each response passed through `parse` as it arrives.
+# The protocol call is sent back the parsed responses in the order of `calls`. With
+# return_exceptions, a failed call's exception takes its place instead of being thrown.
+ConcurrentCalls = collections.namedtuple('ConcurrentCalls', ['calls', 'limit', 'parse', 'return_exceptions'],
+                                         defaults=(False,))
+
+
+class FairlayServiceUnavailable(IOError):
+    '''The private API answered 'XError: Service unavailable', the request should be resent later'''
+
+
+def fairlay_call(method):
+    '''
+    Turn a protocol generator into an API method.
+
+    The generator yields PrivateCall/PublicCall requests and is sent back their
+    responses (or has their exceptions thrown into it). The client's _run() does
+    the I/O, so the same method blocks on FairlayPythonClient and is a coroutine
+    on AsyncFairlayClient.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self._run(method(self, *args, **kwargs))
+    return wrapper
+
+
+class FairlayProtocol(abc.ABC):
+    '''
+    Everything about the Fairlay API except the I/O: constants, configuration,
+    request signing, response verification and the API methods themselves.
+    Subclasses implement _run() to do the I/O.
+    '''
 
     MARKET_CATEGORY = {
         1: 'Soccer',
@@ -166,11 +204,25 @@ class FairlayPythonClient(object):
                             '-----END PUBLIC KEY-----')
     }
 
-    def __init__(self):
-        super(FairlayPythonClient, self).__init__()
+    # Seconds to wait before resending a request refused with 'Service unavailable'
+    RETRY_DELAY = 6
+
+    # Attempts of a public API request, each on the least loaded free slot
+    PUBLIC_TRIES = 4
+
+    MAX_ORDERS_PER_REQUEST = 50
+
+    def __init__(self, signing_processes=0, requests_per_second=None):
+        super(FairlayProtocol, self).__init__()
         self.__load_config()
         self.__last_time_check = None
         self.__offset = None
+        self.__last_nonce = 0
+        self.__nonce_lock = threading.Lock()
+        self.__crypto = FairlayCryptoContext(self.CONFIG['PrivateRSAKey'], self.CONFIG['SERVERPUBLICKEY'],
+                                             signing_processes)
+        self._rate_limiter = FairlayRateLimiter(requests_per_second) if requests_per_second else None
+        self._public_slots = FairlaySlotBalancer()
 
     def __load_config(self):
         try:
@@ -216,97 +268,76 @@ class FairlayPythonClient(object):
         self.CONFIG['PrivateRSAKey'] = private_key.decode()
         print(type(public_key))
 
-    def __send_request(self, endpoint, data=None):
+    @abc.abstractmethod
+    def _run(self, call):
         '''
-        Private API
+        Drive a protocol generator of fairlay_call, doing the I/O of the requests it yields
+
+        Response: the value returned by the generator (or a coroutine resolving to it)
         '''
-        nonce = int(round(time.time() * 1000))
+
+    def _next_nonce(self):
+        # Milliseconds, but strictly increasing when requests are built concurrently
+        with self.__nonce_lock:
+            self.__last_nonce = max(int(round(time.time() * 1000)), self.__last_nonce + 1)
+            return self.__last_nonce
+
+    def __message(self, endpoint, data):
+        nonce = self._next_nonce()
         endpoint_code = self.ENDPOINTS[endpoint] + 1000 * self.CONFIG['APIAccountID']
 
         message = "{}|{}|{}".format(nonce, self.CONFIG['ID'], endpoint_code)
         if data:
             message += '|' + data
-        sign = self.__sign_message(message)
-        message = '{}|{}<ENDOFDATA>'.format(sign, message)
+        return message
 
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(15)
-            s.connect((self.CONFIG['SERVERIP'], self.CONFIG['PORT']))
-            s.send(message)
-
-            data = ''
-            while True:
-                new_data = s.recv(4096)
-                if not new_data:
-                    break
-                data += new_data
-            s.close()
-            response = gzip.GzipFile(fileobj=io.StringIO(data)).read()
-        except socket.timeout:
-            return
-        except socket.error:
-            return
+    def _encode_request(self, endpoint, data=None):
+        '''
+        Private API request, signed and framed: bytes
+        '''
+        message = self.__message(endpoint, data)
+        sign = self.__crypto.sign(message)
+        return '{}|{}<ENDOFDATA>'.format(sign, message).encode('utf-8')
 
-        if not self.__verify_response(response):
+    def _encode_requests(self, calls):
+        '''
+        _encode_request for every PrivateCall of a batch (None for other calls),
+        signed together so that a signing process pool can share the work
+        '''
+        messages = [self.__message(c.endpoint, c.data) if isinstance(c, PrivateCall) else None for c in calls]
+        signatures = iter(self.__crypto.sign_many([m for m in messages if m is not None]))
+        return [None if m is None else '{}|{}<ENDOFDATA>'.format(next(signatures), m).encode('utf-8')
+                for m in messages]
+
+    def _decode_response(self, raw):
+        '''
+        Private API response (decompressed bytes) to the payload string
+        '''
+        if not self.__crypto.verify(raw):
             raise ValueError
 
-        response = response.split('|')[-1]
+        response = str(memoryview(raw)[raw.rfind(b'|') + 1:], 'utf-8')
 
         if response == 'XError: Service unavailable':
-            time.sleep(6)
-            return self.__send_request(endpoint, data)
+            raise FairlayServiceUnavailable(response)
 
         if response.startswith('XError'):
             raise IOError(response.replace('XError:', ''))
         return response
 
-    def __verify_response(self, message):
-        idx = message.find('|')
-        if idx == -1:
-            return True
-
-        signed_message = message[:idx]
-        original_message = message[idx+1:]
-        key = RSA.importKey(self.CONFIG['SERVERPUBLICKEY'])
-        signer = PKCS1_v1_5.new(key)
-        digest = SHA512.new()
-        digest.update(original_message)
-        if signer.verify(digest, base64.b64decode(signed_message + "=" * ((4 - len(signed_message) % 4) % 4))):
-            return True
-
-    def __sign_message(self, message):
-        key = RSA.importKey(self.CONFIG['PrivateRSAKey'])
-        signer = PKCS1_v1_5.new(key)
-        digest = SHA512.new()
-        digest.update(message.encode('utf-8'))
-        sign = signer.sign(digest)
-        return base64.b64encode(sign)
-
-    def __public_request(self, endpoint, json=True, tries=0):
-        try:
-            # Request: http://83.171.236.114:8080/free{1..9}/{method}/{parameters}
-            # free calls from 1 to 9, increase the given limits
-            call = PublicAPI_address + '/free'+ str(random.randint(1,9)) + '/' + endpoint
-            # print(call)
-            response = requests.get(call)
-
-            if response == 'XError: Service unavailable':
-                raise requests.exceptions.ConnectionError
-
-            if 'XError' in response.text:
-                return
+    def public_slot_stats(self):
+        '''
+        Response: dictionary with the latency, error rate and load of each free public API slot
+        '''
+        return self._public_slots.stats()
 
-            if json:
-                return response.json()
-            else:
-                return response
-        except requests.exceptions.ConnectionError:
-            time.sleep(6)
-            if tries >= 3:
-                raise requests.exceptions.ConnectionError
-            return self.__public_request(endpoint, json, tries + 1)
+    def server_time_offset(self):
+        '''
+        Response: datetime.timedelta (local clock - server clock), None before the first time check
+        '''
+        return self.__offset
 
+    @fairlay_call
     def get_markets_and_odds(self, market_filter={}, changed_after=datetime.datetime(2021, 1, 1)):
         '''
             Free Public API for retrieving markets and odds. Check the documentation at:
@@ -325,24 +356,17 @@ class FairlayPythonClient(object):
                   'ClosD': '2016-10-01T00:00:00', 'Margin': 10000.0, 'ID': 57650700754, 'MaxVal': 0.0,
                   'SettlT': 0, 'MinVal': 0.0, 'CreatorName': 'FairMM', 'Pop': 0.0, 'MarketPeriod': 'FIRST_SET',
                   'SettlD': '2017-01-01T00:00:00', '_Period': 1, 'SettlementType': 'BINARY'}
+            None if the server time could not be fetched, as the markets cannot be filtered by change date
         '''
-        if not self.__last_time_check or self.__last_time_check + datetime.timedelta(minutes=10) < datetime.datetime.now():
-            try:
-                response = self.__public_request('time')
-                if not response:
-                    raise ValueError
-            except Exception:
-                return []
-
-            self.__offset = datetime.datetime.now() - convert_ticks_to_datetime(response)
-            self.__last_time_check = datetime.datetime.now()
+        if not (yield from self.__check_time()):
+            return None
 
         changed = changed_after - datetime.timedelta(seconds=10) - self.__offset
         filters = {'ToID': 10000, 'SoftChangedAfter': changed.isoformat()}
         filters.update(market_filter)
 
         try:
-            response = self.__public_request('markets/{}'.format(json.dumps(filters)))
+            response = yield PublicCall('markets/{}'.format(json.dumps(filters)), True)
         except ValueError:
             return []
 
@@ -350,6 +374,32 @@ class FairlayPythonClient(object):
         #     self.__parse_market(market)
         return response
 
+    @fairlay_call
+    def sync_server_time(self, max_age=datetime.timedelta(minutes=10)):
+        '''
+            Refresh the offset to the server clock used by get_markets_and_odds,
+            if it is older than max_age. Call it once before sharing the client
+            between threads, so that they don't all look it up.
+
+        Response: bool (False if the server time could not be fetched)
+        '''
+        return (yield from self.__check_time(max_age))
+
+    def __check_time(self, max_age=datetime.timedelta(minutes=10)):
+        if self.__last_time_check and self.__last_time_check + max_age >= datetime.datetime.now():
+            return True
+
+        try:
+            response = yield PublicCall('time', True)
+            if not response:
+                raise ValueError
+        except Exception:
+            return False
+
+        self.__offset = datetime.datetime.now() - convert_ticks_to_datetime(response)
+        self.__last_time_check = datetime.datetime.now()
+        return True
+
     def __parse_market(self, market):
         market['MarketCategory'] = self.MARKET_CATEGORY[market['CatID']]
         market['MarketType'] = self.MARKET_TYPE[market['_Type']]
@@ -358,13 +408,15 @@ class FairlayPythonClient(object):
         if market['OrdBStr']:
             market['OrdBJSON'] = [json.loads(ob) for ob in market['OrdBStr'].split('~') if ob]
 
+    @fairlay_call
     def get_server_time(self):
         '''
         Response: string
             E.g. '636093693129714057'
         '''
-        return self.__send_request('get_server_time')
+        return (yield PrivateCall('get_server_time', None))
 
+    @fairlay_call
     def get_balance(self):
         '''
         Response: dictionary
@@ -372,14 +424,15 @@ class FairlayPythonClient(object):
                   'AvailableFunds': 42.4242, 'CreatorUsed': 0.0,
                   'SettleUsed': 0.0, 'MaxFunds': 0.0, 'PrivUsedFunds': 25.0}
         '''
-        response = self.__send_request('get_balance')
+        response = yield PrivateCall('get_balance', None)
         if response:
             try:
                 return json.loads(response)
             except ValueError:
                 return None
 
-    def get_orders(self, order_type, timestamp=1420070400, market_id=None):
+    @fairlay_call
+    def get_orders(self, order_type, timestamp=1420070400, market_id=None, parallelism=1):
         '''
             When two open orders are matched, a Matched Order is created in the PENDING state.
             If the maker of the bet cancels his bet within a certain time period (usually 0, 3 or 6 seconds depending on the market)
@@ -389,6 +442,7 @@ class FairlayPythonClient(object):
 
         Request:
             order_type: 'matched' or 'unmatched'
+            parallelism: pages fetched at once after the first one (not used with market_id)
 
         Response: list of dictionaries
 
@@ -414,45 +468,61 @@ class FairlayPythonClient(object):
                  'StatusStr': 'ACTIVE', TypeStr = 'MAKERTAKER'
                 }]
         '''
+        endpoint = 'get_'+ order_type +'_orders'
+        if market_id:
+            response = yield PrivateCall(endpoint, str(timestamp) + '|' + str(market_id))
+            try:
+                return json.loads(response)
+            except ValueError:
+                return []
+
         max_items = 1500
         start = 0
         orders = []
+        parse = functools.partial(self.__parse_orders_page, order_type)
 
+        # Probe the first page, then fetch the following ones `parallelism` at a time
+        pages_at_once = 1
         while True:
-            if market_id:
-                message = str(timestamp) + '|' + str(market_id)
+            calls = [PrivateCall(endpoint, str(timestamp) + '|' + str(s) + '|' + str(s + max_items))
+                     for s in range(start, start + pages_at_once * max_items, max_items)]
+            if len(calls) == 1:
+                pages = [parse((yield calls[0]))]
             else:
-                message = str(timestamp) + '|' + str(start) + '|' + str(start + max_items)
+                pages = yield ConcurrentCalls(calls, parallelism, parse)
 
-            response = self.__send_request('get_'+ order_type +'_orders', message)
+            for page in pages:
+                if page is None:
+                    return orders
+                orders += page
+                if len(page) < max_items:
+                    return orders
 
-            try:
-                temp = json.loads(response)
-                if market_id:
-                    return temp
-                orders += temp
-            except ValueError:
-                break
+            start += len(calls) * max_items
+            pages_at_once = max(1, parallelism)
 
-            if len(temp) < max_items:
-                break
-            else:
-                start += max_items
+    def __parse_orders_page(self, order_type, response):
+        try:
+            orders = json.loads(response)
+        except ValueError:
+            return None
 
         for o in orders:
-            status = o['_MatchedOrder'] if order_type == 'matched' else o['_UnmatchedOrder']
-            o['StatusStr'] = self.MATCHED_ORDER_STATE[status['State']]
-            if order_type == 'unmatched':
-                o['TypeStr'] = self.ORDER_TYPE[status['_Type']]
+            if order_type == 'matched':
+                o['StatusStr'] = self.MATCHED_ORDER_STATE[o['_MatchedOrder']['State']]
+            else:
+                o['StatusStr'] = self.UNMATCHED_ORDER_STATE[o['_UnmatchedOrder']['State']]
+                o['TypeStr'] = self.ORDER_TYPE[o['_UnmatchedOrder']['_Type']]
         return orders
 
+    @fairlay_call
     def change_orders(self, orders_list=[]):
         '''
         Request:
             Allows you to create, cancel and alter orders
             Set Pri to 0  to cancel an order
             Set Oid to -1 to create an order
-            ** Maximum allowed orders in one request: 50
+            ** Maximum allowed orders in one request: 50 (see submit_orders for more)
 
             orders_list:
                 Mid: Market ID
@@ -470,24 +540,78 @@ class FairlayPythonClient(object):
                    'PrivSubUser': '', 'State': 0, 'PrivAmount': 5.0, 'makerCT': 0, 'RemAmount': 5.0,
                    'PrivUserID': 1100080, 'PrivID': 636093725357177200, 'BidOrAsk': 1}]
         '''
-        if len(orders_list) > 50:
+        if len(orders_list) > self.MAX_ORDERS_PER_REQUEST:
             return
 
+        response = yield PrivateCall('change_orders', self.__encode_orders(orders_list))
+
+        try:
+            response = json.loads(response)
+        except ValueError:
+            return None
+
+        orders, markets_to_cancel = self.__parse_orders_response(orders_list, response)
+        if markets_to_cancel:
+            yield PrivateCall('cancel_orders_on_markets', str([str(x) for x in markets_to_cancel]))
+        return orders
+
+    @fairlay_call
+    def submit_orders(self, orders_list, parallelism=4):
+        '''
+        change_orders for any number of orders. They are sent in batches of 50, up to
+        `parallelism` batches at once, throttled only if the client was created with
+        requests_per_second. The markets of all orders refused with a YError are
+        cancelled together, in one request sent after every batch has been answered.
+
+        Request:
+            orders_list: list of dictionaries (see change_orders)
+            parallelism: int >= 1
+
+        Response: list with one dictionary per order, in the order of orders_list
+            (see change_orders). The orders of a batch that failed get {'error': '...'}.
+        '''
+        if parallelism < 1:
+            raise ValueError(f'submit_orders() parallelism must be at least 1, not {parallelism}')
+        size = self.MAX_ORDERS_PER_REQUEST
+        batches = [orders_list[i:i + size] for i in range(0, len(orders_list), size)]
+        calls = [PrivateCall('change_orders', self.__encode_orders(batch)) for batch in batches]
+        responses = yield ConcurrentCalls(calls, parallelism, self.__load_json, True)
+
+        results = []
+        markets_to_cancel = []
+        for batch, response in zip(batches, responses):
+            if isinstance(response, Exception) or not isinstance(response, list):
+                error = str(response) if isinstance(response, Exception) else 'Invalid response'
+                results += [{'error': error} for _ in batch]
+                continue
+            orders, markets = self.__parse_orders_response(batch, response)
+            results += orders
+            markets_to_cancel += [m for m in markets if m not in markets_to_cancel]
+
+        if markets_to_cancel:
+            yield PrivateCall('cancel_orders_on_markets', str([str(x) for x in markets_to_cancel]))
+        return results
+
+    def __encode_orders(self, orders_list):
         message = []
         for order in orders_list:
             temp = {}
             for k, v in order.items():
                 temp[k] = str(v) if k in ['Mid', 'Rid', 'Oid'] else v
             message.append(temp)
-        response = self.__send_request('change_orders', json.dumps(message))
+        return json.dumps(message)
 
+    def __load_json(self, response):
         try:
-            response = json.loads(response)
-        except ValueError:
+            return json.loads(response)
+        except (TypeError, ValueError):
             return None
 
+    def __parse_orders_response(self, orders_list, response):
+        '''
+        Response: (list of dictionaries, list of market IDs to cancel orders on)
+        '''
         markets_to_cancel = []
-        response_orders = []
         for idx, order in enumerate(orders_list):
             response_order = response[idx]
             if 'YError:Market Closed' in response_order or response_order == 'Order cancelled':
@@ -495,9 +619,9 @@ class FairlayPythonClient(object):
             elif 'YError' in response_order:
                 markets_to_cancel.append(orders_list[idx]['Mid'])
                 response[idx] = '{"error": "' + response[idx].split(':')[1] + '"}'
-        self.cancel_orders_on_markets(markets_to_cancel)
-        return [json.loads(x) for x in response]
+        return [json.loads(x) for x in response], markets_to_cancel
 
+    @fairlay_call
     def get_market(self, market_id):
         '''
         Request:
@@ -507,7 +631,7 @@ class FairlayPythonClient(object):
             dictionary (see example in get_markets_and_odds above)
         '''
         message = str(market_id)
-        response = self.__send_request('get_market', message)
+        response = yield PrivateCall('get_market', message)
 
         try:
             market = json.loads(response)
@@ -516,6 +640,7 @@ class FairlayPythonClient(object):
         except ValueError:
             return None
 
+    @fairlay_call
     def get_odds(self, market_id):
         '''
         Request:
@@ -525,7 +650,7 @@ class FairlayPythonClient(object):
             E.g. [{'S': 1, 'Bids': [[2.573, 19.0]], 'Asks': [[3.752, 13.0]]}]
         '''
         message = str(market_id)
-        response = self.__send_request('get_orderbook', message)
+        response = yield PrivateCall('get_orderbook', message)
 
         if not ('Bids' in response or 'Asks' in response):
             return []
@@ -534,6 +659,7 @@ class FairlayPythonClient(object):
         except ValueError:
             return []
 
+    @fairlay_call
     def create_market(self, data):
         '''
         Request:
@@ -573,23 +699,26 @@ class FairlayPythonClient(object):
             dic['Ru'].append({'Name': run, 'InvDelay': 0, 'VisDelay': 0})
 
         message = json.dumps(dic)
-        return self.__send_request('create_market', message)
+        return (yield PrivateCall('create_market', message))
 
+    @fairlay_call
     def cancel_orders_on_markets(self, market_ids=[]):
         '''
         Response: int (number of cancelled orders)
         '''
-        response = self.__send_request('cancel_orders_on_markets', str([str(x) for x in market_ids]))
+        response = yield PrivateCall('cancel_orders_on_markets', str([str(x) for x in market_ids]))
         return int(response.split(' ')[0])
 
+    @fairlay_call
     def cancel_all_orders(self):
         '''
         Response: int (number of cancelled orders)
         '''
-        response = self.__send_request('cancel_all_orders')
+        response = yield PrivateCall('cancel_all_orders', None)
         if response:
             return int(response.split(' ')[0])
 
+    @fairlay_call
     def change_closing(self,market_id,closing_date,resolution_date):
         '''
         Request:
@@ -608,8 +737,9 @@ class FairlayPythonClient(object):
         }
 
         message = json.dumps(dic)
-        return self.__send_request('change_closing', message)
+        return (yield PrivateCall('change_closing', message))
 
+    @fairlay_call
     def settle_market(self,data):
         '''
         Request:
@@ -635,8 +765,9 @@ class FairlayPythonClient(object):
         '''
 
         message = json.dumps(data)
-        return self.__send_request('settle_market', message)
+        return (yield PrivateCall('settle_market', message))
 
+    @fairlay_call
     def set_absence_cancel_policy(self, miliseconds):
         '''
         Request:
@@ -644,9 +775,10 @@ class FairlayPythonClient(object):
 
         Response: bool
         '''
-        response = self.__send_request('set_absence_cancel_policy', str(miliseconds))
+        response = yield PrivateCall('set_absence_cancel_policy', str(miliseconds))
         return True if response =='success' else False
 
+    @fairlay_call
     def set_force_nonce(self, force):
         '''
         Request:
@@ -655,17 +787,153 @@ class FairlayPythonClient(object):
         Response: bool
         '''
         force = 'true' if force else 'false'
-        response = self.__send_request('set_force_nonce', force)
+        response = yield PrivateCall('set_force_nonce', force)
         return True if response =='success' else False
 
+    @fairlay_call
     def set_ready_only(self):
         '''
         Response: bool
         '''
-        response = self.__send_request('set_ready_only')
+        response = yield PrivateCall('set_ready_only', None)
         if 'success' in response:
             return True
 
+
+class FairlayPythonClient(FairlayProtocol):
+    '''
+    Blocking client: private API requests go over pooled TCP connections and
+    public API requests over one keep-alive HTTP session.
+    '''
+
+    PUBLIC_TIMEOUT = 15
+
+    def __init__(self, signing_processes=0, requests_per_second=None):
+        super(FairlayPythonClient, self).__init__(signing_processes, requests_per_second)
+        self.__pool = FairlayConnectionPool(self.CONFIG['SERVERIP'], self.CONFIG['PORT'])
+        self.__session = requests.Session()
+
+    def _run(self, call):
+        response, error = None, None
+        while True:
+            try:
+                request = call.throw(error) if error else call.send(response)
+            except StopIteration as stop:
+                return stop.value
+
+            try:
+                response, error = self.__dispatch(request), None
+            except Exception as e:
+                response, error = None, e
+
+    def __dispatch(self, request, message=None):
+        if isinstance(request, ConcurrentCalls):
+            return self.__dispatch_concurrent(request)
+        if isinstance(request, PublicCall):
+            return self.__public_request(request.endpoint, request.json)
+        return self.__send_request(request.endpoint, request.data, message)
+
+    def __dispatch_concurrent(self, request):
+        def dispatch_one(call, message):
+            try:
+                return request.parse(self.__dispatch(call, message))
+            except Exception as e:
+                if not request.return_exceptions:
+                    raise
+                return e
+
+        messages = self._encode_requests(request.calls)
+        with concurrent.futures.ThreadPoolExecutor(request.limit) as executor:
+            return list(executor.map(dispatch_one, request.calls, messages))
+
+    def __send_request(self, endpoint, data=None, message=None):
+        '''
+        Private API
+        '''
+        while True:
+            message = message or self._encode_request(endpoint, data)
+            if self._rate_limiter:
+                delay = self._rate_limiter.reserve()
+                if delay > 0 and METRICS.enabled:
+                    METRICS.rate_limited('fairlay', endpoint, delay)
+                time.sleep(delay)
+            start = time.perf_counter()
+            try:
+                response = self.__pool.request(message)
+            except socket.timeout:
+                if METRICS.enabled:
+                    METRICS.observe('fairlay', endpoint, time.perf_counter() - start, len(message), error=True)
+                return
+            except socket.error:
+                if METRICS.enabled:
+                    METRICS.observe('fairlay', endpoint, time.perf_counter() - start, len(message), error=True)
+                return
+
+            try:
+                result = self._decode_response(response)
+            except FairlayServiceUnavailable:
+                if METRICS.enabled:
+                    METRICS.observe('fairlay', endpoint, time.perf_counter() - start, len(message), len(response),
+                                    error=True)
+                    METRICS.retry('fairlay', endpoint)
+                message = None
+                time.sleep(self.RETRY_DELAY)
+                continue
+            if METRICS.enabled:
+                METRICS.observe('fairlay', endpoint, time.perf_counter() - start, len(message), len(response))
+            return result
+
+    def pool_stats(self):
+        '''
+        Response: dictionary with the private API connection pool counters
+            E.g. {'requests': 120, 'hits': 117, 'connects': 3, 'reconnects': 1,
+                  'errors': 0, 'in_flight': 2, 'idle': 1}
+        '''
+        return self.__pool.stats()
+
+    def __public_request(self, endpoint, json=True):
+        # Request: http://83.171.236.114:8080/free{1..9}/{method}/{parameters}
+        # free calls from 1 to 9, increase the given limits
+        name = endpoint.split('/', 1)[0]
+        for attempt in range(self.PUBLIC_TRIES):
+            slot, wait = self._public_slots.acquire()
+            if METRICS.enabled:
+                if attempt:
+                    METRICS.retry('fairlay_public', name)
+                if wait > 0:
+                    METRICS.rate_limited('fairlay_public', name, wait)
+            time.sleep(wait)
+            start = time.monotonic()
+            try:
+                response = self.__session.get(PublicAPI_address + '/free' + str(slot) + '/' + endpoint,
+                                              timeout=self.PUBLIC_TIMEOUT)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._public_slots.release(slot, error=True)
+                if METRICS.enabled:
+                    METRICS.observe('fairlay_public', name, time.monotonic() - start, error=True)
+                continue
+
+            if response.text == 'XError: Service unavailable':
+                self._public_slots.release(slot, error=True)
+                if METRICS.enabled:
+                    METRICS.observe('fairlay_public', name, time.monotonic() - start, received=len(response.content),
+                                    error=True)
+                    METRICS.rate_limited('fairlay_public', name)
+                continue
+            self._public_slots.release(slot, time.monotonic() - start)
+            if METRICS.enabled:
+                METRICS.observe('fairlay_public', name, time.monotonic() - start, received=len(response.content),
+                                error='XError' in response.text)
+
+            if 'XError' in response.text:
+                return
+
+            if json:
+                return response.json()
+            else:
+                return response
+        raise requests.exceptions.ConnectionError
+
 # client = FairlayPythonClient()
 # print( client.get_orders('unmatched'))
 # print( '--------')
@@ -676,29 +944,81 @@ class FairlayPythonClient(object):
 ###############################################################################
 
 class FairlayMarketFetcher(object):
-    markets = []
+    '''
+    Keeps `markets` up to date with the markets changed since the previous fetch.
+
+    With a state_path, the markets and the watermark of the last successful
+    fetch are saved there on shutdown, in server time so that they survive a
+    change of the clock offset. They are loaded back on startup and only the
+    markets changed since then are requested.
+
+    `order_books` turns every page of fetched markets into the price levels
+    added, removed or resized since the previous fetch, which are passed to the
+    callbacks given to subscribe() with the IDs of the fetched markets, e.g. to
+    keep a FairlayLargeOrderIndex.
+    '''
     last_fetch_date = datetime.datetime(2016, 1, 1)
 
-    def __init__(self):
+    def __init__(self, snapshot_dir=None, state_path=None):
         super(FairlayMarketFetcher, self).__init__()
         self.client = FairlayPythonClient()
+        self.markets = FairlayMarketStore()
+        self.order_books = FairlayOrderBookDiff()
+        self.__subscribers = []
+        self.__lock = threading.Lock()
+        # SoftChangedAfter of the next fetch in server time, None before the first successful one
+        self.watermark = None
+        self.state_path = state_path
+        if state_path is not None:
+            self.watermark = self.markets.load(state_path)
+            self.markets.expire(datetime.datetime.now() - datetime.timedelta(minutes=30))
+            self.order_books.update(self.markets)
+        self.snapshots = None
+        if snapshot_dir is not None:
+            # NumPy is only needed to record the order books
+            from fairlay_snapshots import FairlaySnapshotStore
+            self.snapshots = FairlaySnapshotStore(snapshot_dir)
         self.event = threading.Event()
         threading.Thread(target=self.__run).start()
 
     def __run(self):
         while not self.event.is_set():
-            self.fetch_new_markets()
-            self.last_fetch_date = datetime.datetime.now()
+            fetch_date = datetime.datetime.now()
+            if self.fetch_new_markets():
+                self.last_fetch_date = fetch_date
+                self.watermark = fetch_date - self.client.server_time_offset()
             self.event.wait(60 * 5)  # 5 minutes
+        self.save_state()
 
     def fetch_new_markets(self):
+        '''
+        Response: bool (False if some markets could not be fetched)
+        '''
+        if not self.client.sync_server_time():
+            return False
+        if self.watermark is not None:
+            # Saved in server time, get_markets_and_odds expects the local time
+            self.last_fetch_date = self.watermark + self.client.server_time_offset()
+
         from_id = 0
         increment = 100
 
-        new_markets = []
         while True:
             filters = {'FromID': from_id, 'ToID': from_id + increment}
-            new_markets += self.client.get_markets_and_odds(filters, self.last_fetch_date)
+            try:
+                new_markets = self.client.get_markets_and_odds(filters, self.last_fetch_date)
+            except requests.exceptions.ConnectionError:
+                new_markets = None
+            if new_markets is None:
+                print('Cannot fetch the markets, retrying them at the next fetch.')
+                return False
+            markets = [Market(m) for m in new_markets]
+            with self.__lock:
+                self.markets.update(markets)
+                self.__publish(self.order_books.update(markets), [m['ID'] for m in markets])
+            if self.snapshots is not None and new_markets:
+                from fairlay_orderbook import FairlayOrderBook
+                self.snapshots.append_order_book(FairlayOrderBook(new_markets))
 
             if len(new_markets) < increment:
                 break
@@ -706,18 +1026,43 @@ class FairlayMarketFetcher(object):
                 from_id += increment
             time.sleep(2)
 
-        now = datetime.datetime.now() - datetime.timedelta(minutes=30)
-        for idx, market in enumerate(self.markets):
-            closing_date = datetime.datetime.strptime(market['ClosD'][:19], '%Y-%m-%dT%H:%M:%S')
-            if closing_date < now:
-                del self.market[idx]
+        with self.__lock:
+            changes = []
+            for market in self.markets.expire(datetime.datetime.now() - datetime.timedelta(minutes=30)):
+                changes.extend(self.order_books.forget(market['ID']))
+            self.__publish(changes)
+        return True
 
-        self.markets += new_markets
+    def subscribe(self, callback, replay=False):
+        '''
+        Call callback(changes, market_ids) from the fetcher thread after every page of fetched markets, changes being
+        a list of fairlay_markets.LevelChange(market_id, runner, side, price, old_amount, new_amount) and market_ids
+        the IDs of the fetched markets, as a market can change e.g. its 'Comp' without any change to its levels
+
+        replay: first call it with all the current levels, as added ones
+        '''
+        with self.__lock:
+            if replay:
+                callback(self.order_books.snapshot(), [])
+            self.__subscribers.append(callback)
+
+    def __publish(self, changes, market_ids=()):
+        if not changes and not market_ids:
+            return
+        for callback in self.__subscribers:
+            try:
+                callback(changes, market_ids)
+            except Exception as e:
+                print(f'Order book change callback failed: {e!r}')
+
+    def save_state(self):
+        if self.state_path is not None:
+            self.markets.save(self.state_path, self.watermark)
 
     def stop(self):
         self.event.set()
 
-# fetcher = FairlayMarketFetcher()
+# fetcher = FairlayMarketFetcher(state_path='fairlay_markets.json.gz')
 # while True:
 #     try:
 #         time.sleep(1)
@@ -736,6 +1081,8 @@ class FairlayOrderMatching(object):
     def __init__(self):
         super(FairlayOrderMatching, self).__init__()
         self.client = FairlayPythonClient()
+        self.positions = FairlayPositionEngine(self.client)
+        self.tracker = None
 
     def create_wait_get_matched(self):
         order = {
@@ -749,61 +1096,36 @@ class FairlayOrderMatching(object):
             'Boa': 1,
             'Mct': 0
         }
+        if self.tracker is None:
+            self.tracker = FairlayMatchedOrderTracker(self.client, positions=self.positions)
         order = self.client.change_orders([order])[0]
 
         if order:
             order_id = order['PrivID']
-
-            time.sleep(6)
-            temp = self.client.get_orders('matched')
-
-            for match in temp:
-                if match['_UserUMOrderID'] == order_id:
-                    self.matched_orders.append(match)
+            self.matched_orders += self.tracker.wait_for(order_id, timeout=6)
 
         return self.matched_orders
 
+    def close(self):
+        '''
+            Stop the matched order tracker thread
+        '''
+        if self.tracker is not None:
+            self.tracker.stop()
+            self.tracker = None
+
     def calculate_position(self, market_id):
         '''
             Calculate user position for each runner in the specified market ID
             Return possible winnings and losing for each runner in BTC
-        '''
-        position = {}
-        matched = self.client.get_orders('matched')
 
-        for order in matched:
-            m_id = order['_UserOrder']['MarketID']
-            r_id = order['_UserOrder']['RunnerID']
-            is_back = order['_UserOrder']['BidOrAsk'] == 1
-            amount = order['_MatchedOrder']['Amount'] / 1000.0
-            odds = order['_MatchedOrder']['Price']
-
-            if m_id != market_id:
-                continue
-
-            winnings = losings = 0
-            if is_back:
-                winnings += (amount * odds) - amount
-                losings += -amount
-            else:
-                winnings += -amount
-                losings += (amount * (1 + (1 / (odds - 1)))) - amount
-
-            if r_id in position.keys():
-                position[r_id]['possible_winnings'] += winnings
-                position[r_id]['possible_losings'] += losings
-            else:
-                position[r_id] = {
-                    'possible_winnings': winnings,
-                    'possible_losings': losings
-                }
-
-        total_losings = sum([m['possible_losings'] for m in position.values()])
-        for key, d in position.items():
-            position[key]['possible_losings'] += total_losings - d['possible_losings']
-
-        return position
+            Only the matched orders changed since the previous call are downloaded,
+            use self.positions.position(market_id) to skip the update.
+        '''
+        self.positions.update()
+        return self.positions.position(market_id)
 
 # matching = FairlayOrderMatching()
 # print( matching.create_wait_get_matched()
 # print( matching.calculate_position(82339763895)
+# matching.close()
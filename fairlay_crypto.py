@@ -0,0 +1,91 @@
+import base64
+import concurrent.futures
+import os
+
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from Crypto.Hash import SHA512
+
+
+# Signing context of a worker process, created once by the pool initializer
+_worker_context = None
+
+
+def _init_signing_worker(private_key):
+    global _worker_context
+    _worker_context = FairlayCryptoContext(private_key)
+
+
+def _sign_in_worker(message):
+    return _worker_context.sign(message)
+
+
+class FairlayCryptoContext(object):
+    '''
+    Signs requests and verifies responses of the private API.
+
+    The PEM keys are parsed once and the PKCS1_v1_5 signer/verifier objects are
+    reused for every message. With processes != 0, sign_many() spreads a batch of
+    messages over a process pool (processes=None uses all cores).
+    '''
+
+    def __init__(self, private_key, server_public_key=None, processes=0):
+        super(FairlayCryptoContext, self).__init__()
+        self.__private_key = private_key
+        self.__signer = PKCS1_v1_5.new(RSA.importKey(private_key))
+        self.__verifier = None
+        if server_public_key:
+            self.__verifier = PKCS1_v1_5.new(RSA.importKey(server_public_key))
+        self.processes = processes
+        self.__executor = None
+
+    def sign(self, message):
+        '''
+        Request:
+            message: string
+
+        Response: string (base64 encoded signature)
+        '''
+        digest = SHA512.new(message.encode('utf-8'))
+        return base64.b64encode(self.__signer.sign(digest)).decode('ascii')
+
+    def sign_many(self, messages):
+        '''
+        Request:
+            messages: list of strings
+
+        Response: list of strings (signatures in the same order)
+        '''
+        if self.processes == 0 or len(messages) < 2:
+            return [self.sign(m) for m in messages]
+
+        if self.__executor is None:
+            self.__executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.processes,
+                initializer=_init_signing_worker,
+                initargs=(self.__private_key,))
+        workers = self.processes or os.cpu_count() or 1
+        chunksize = max(1, len(messages) // (workers * 4))
+        return list(self.__executor.map(_sign_in_worker, messages, chunksize=chunksize))
+
+    def verify(self, message):
+        '''
+        Request:
+            message: bytes-like in the format b'<signature>|<signed message>'
+
+        Response: bool
+        '''
+        idx = message.find(b'|')
+        if idx == -1:
+            return True
+
+        view = memoryview(message)
+        signed_message = bytes(view[:idx])
+        digest = SHA512.new(view[idx+1:])
+        signature = base64.b64decode(signed_message + b"=" * ((4 - len(signed_message) % 4) % 4))
+        return self.__verifier.verify(digest, signature)
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
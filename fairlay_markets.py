@@ -0,0 +1,467 @@
+import bisect
+import collections
+import datetime
+import gzip
+import heapq
+import json
+import os
+import sys
+import threading
+
+
+def parse_closing_date(s):
+    # 'ClosD' looks like '2016-10-01T00:00:00' or '2016-10-01T00:00:00.123Z'
+    return datetime.datetime.fromisoformat(s[:19])
+
+
+def _protocol():
+    # Imported on use, fairlay_client imports this module
+    from fairlay_client import FairlayProtocol
+    return FairlayProtocol
+
+
+class Market(object):
+    '''
+    Compact market from get_markets_and_odds.
+
+    Only the fields read by the fetchers are kept ('Descr' and the runner
+    details other than their names are dropped) and repeated strings are
+    interned. The order book and the enum labels are decoded when accessed.
+    Fields can be read as attributes or, like the original dict, as market['CatID'].
+    '''
+
+    __slots__ = ('ID', 'CatID', 'Comp', 'Title', 'CreatorName', 'Status', 'ClosD', 'SettlD',
+                 'LastCh', 'LastSoftCh', '_Type', '_Period', 'SettlT', 'Comm', 'OrdBStr',
+                 'Runners', '__order_book')
+
+    FIELDS = ('ID', 'CatID', 'Comp', 'Title', 'CreatorName', 'Status', 'ClosD', 'SettlD',
+              'LastCh', 'LastSoftCh', '_Type', '_Period', 'SettlT', 'Comm', 'OrdBStr')
+
+    def __init__(self, market):
+        intern = sys.intern
+        self.ID = market['ID']
+        self.CatID = market['CatID']
+        self.Comp = intern(market.get('Comp') or '')
+        self.Title = market.get('Title')
+        self.CreatorName = intern(market.get('CreatorName') or '')
+        self.Status = market.get('Status')
+        self.ClosD = intern(market['ClosD'])
+        self.SettlD = intern(market.get('SettlD') or '')
+        self.LastCh = market.get('LastCh')
+        self.LastSoftCh = market.get('LastSoftCh')
+        self._Type = market.get('_Type')
+        self._Period = market.get('_Period')
+        self.SettlT = market.get('SettlT')
+        self.Comm = market.get('Comm')
+        self.OrdBStr = market.get('OrdBStr')
+        self.Runners = tuple(intern(ru['Name']) for ru in market.get('Ru') or ())
+        self.__order_book = None
+
+    def __repr__(self):
+        return 'Market(ID={}, Comp={!r}, Title={!r})'.format(self.ID, self.Comp, self.Title)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        '''
+        Market fields as returned by get_markets_and_odds, Market(market.to_dict()) is an equal market
+        '''
+        market = {key: getattr(self, key) for key in self.FIELDS}
+        market['Ru'] = [{'Name': name} for name in self.Runners]
+        return market
+
+    @property
+    def order_book(self):
+        '''
+        list of {'S': ..., 'Bids': [[price, amount], ...], 'Asks': [...]}, one per runner
+        '''
+        if self.__order_book is None:
+            self.__order_book = [json.loads(ob) for ob in (self.OrdBStr or '').split('~') if ob]
+        return self.__order_book
+
+    OrdBJSON = order_book
+
+    @property
+    def MarketCategory(self):
+        return _protocol().MARKET_CATEGORY[self.CatID]
+
+    @property
+    def MarketType(self):
+        return _protocol().MARKET_TYPE[self._Type]
+
+    @property
+    def MarketPeriod(self):
+        return _protocol().MARKET_PERIOD[self._Period]
+
+    @property
+    def SettlementType(self):
+        return _protocol().MARKET_SETTLEMENT[self.SettlT]
+
+
+class FairlayMarketStore(object):
+    '''
+    Markets keyed by 'ID', with secondary indexes by 'CatID' and 'Comp'.
+
+    Markets polled with SoftChangedAfter are applied as upserts, so an updated
+    market replaces its previous version. Closing dates are parsed once per
+    market version and kept in a heap, so expiring closed markets costs
+    O(log n) per market instead of a scan over the whole store.
+    '''
+
+    def __init__(self):
+        super(FairlayMarketStore, self).__init__()
+        self.__markets = {}
+        self.__closing = {}
+        self.__heap = []
+        self.__by_category = collections.defaultdict(set)
+        self.__by_competition = collections.defaultdict(set)
+
+    def __len__(self):
+        return len(self.__markets)
+
+    def __contains__(self, market_id):
+        return market_id in self.__markets
+
+    def __iter__(self):
+        return iter(self.__markets.values())
+
+    def get(self, market_id):
+        return self.__markets.get(market_id)
+
+    def by_category(self, cat_id):
+        '''
+        Response: list of markets with the given 'CatID'
+        '''
+        return [self.__markets[i] for i in self.__by_category.get(cat_id, ())]
+
+    def by_competition(self, comp):
+        '''
+        Response: list of markets with the given 'Comp'
+        '''
+        return [self.__markets[i] for i in self.__by_competition.get(comp, ())]
+
+    def upsert(self, market):
+        market_id = market['ID']
+        old = self.__markets.get(market_id)
+        if old is not None:
+            self.__unindex(old)
+        self.__markets[market_id] = market
+        self.__by_category[market['CatID']].add(market_id)
+        self.__by_competition[market['Comp']].add(market_id)
+
+        if old is None or old['ClosD'] != market['ClosD']:
+            closing = parse_closing_date(market['ClosD'])
+            self.__closing[market_id] = closing
+            heapq.heappush(self.__heap, (closing, market_id))
+            # Entries of replaced closing dates are dropped lazily; rebuild once they dominate
+            if len(self.__heap) > 2 * len(self.__markets) + 64:
+                self.__heap = [(c, i) for i, c in self.__closing.items()]
+                heapq.heapify(self.__heap)
+
+    def update(self, markets):
+        for market in markets:
+            self.upsert(market)
+
+    def save(self, path, watermark=None):
+        '''
+        Write the markets and the SoftChangedAfter watermark (a datetime) to a gzipped JSON file
+        '''
+        state = {'watermark': watermark.isoformat() if watermark else None,
+                 'markets': [m.to_dict() for m in self.__markets.values()]}
+        tmp = path + '.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    def load(self, path):
+        '''
+        Add the markets of a file written by save()
+
+        Response: the saved watermark (datetime), None if there is none or no file
+        '''
+        if not os.path.exists(path):
+            return None
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'Cannot load the market state {path}: {e!r}')
+            return None
+
+        self.update(Market(m) for m in state['markets'])
+        if state['watermark']:
+            return datetime.datetime.fromisoformat(state['watermark'])
+
+    def remove(self, market_id):
+        market = self.__markets.pop(market_id, None)
+        if market is not None:
+            self.__unindex(market)
+            del self.__closing[market_id]
+        return market
+
+    def expire(self, before):
+        '''
+        Remove the markets closing before the given datetime
+
+        Response: list of removed markets
+        '''
+        expired = []
+        while self.__heap and self.__heap[0][0] < before:
+            closing, market_id = heapq.heappop(self.__heap)
+            if self.__closing.get(market_id) == closing:
+                expired.append(self.remove(market_id))
+        return expired
+
+    def __unindex(self, market):
+        for index, key in ((self.__by_category, market['CatID']), (self.__by_competition, market['Comp'])):
+            ids = index[key]
+            ids.discard(market['ID'])
+            if not ids:
+                del index[key]
+
+
+# A price level that changed between two fetches, old_amount is 0 when it was added and new_amount 0 when removed
+LevelChange = collections.namedtuple('LevelChange', 'market_id runner side price old_amount new_amount')
+
+
+class FairlayOrderBookDiff(object):
+    '''
+    Last seen price levels of every market, to turn fetched markets into level changes.
+
+    update() compares each market's order book with the previous one per
+    runner, side and price and returns only the added, removed and resized
+    levels. A market whose 'LastCh' (or else 'OrdBStr') did not change is
+    skipped without decoding its order book, so the work follows the changes
+    rather than the number of markets fetched.
+    '''
+
+    BID = 0
+    ASK = 1
+
+    def __init__(self):
+        super(FairlayOrderBookDiff, self).__init__()
+        self.__versions = {}
+        self.__levels = {}
+
+    def __len__(self):
+        return len(self.__levels)
+
+    def levels(self, market_id):
+        '''
+        Response: dictionary of (runner, side, price) -> amount
+        '''
+        return dict(self.__levels.get(market_id, {}))
+
+    def snapshot(self):
+        '''
+        Response: list of LevelChange adding every current level
+        '''
+        return [LevelChange(market_id, runner, side, price, 0, amount)
+                for market_id, levels in self.__levels.items()
+                for (runner, side, price), amount in levels.items()]
+
+    def update(self, markets):
+        '''
+        Response: list of LevelChange
+        '''
+        changes = []
+        for market in markets:
+            changes.extend(self.diff(market))
+        return changes
+
+    def diff(self, market):
+        market_id = market['ID']
+        ordbstr = market.get('OrdBStr') or ''
+        last_change = market.get('LastCh')
+        old_version = self.__versions.get(market_id)
+        if old_version is not None and (old_version[0] == last_change if last_change else old_version[1] == ordbstr):
+            return []
+        self.__versions[market_id] = (last_change, ordbstr)
+
+        old = self.__levels.get(market_id, {})
+        new = self.__parse(ordbstr)
+        self.__levels[market_id] = new
+
+        changes = []
+        for (runner, side, price), old_amount in old.items():
+            new_amount = new.get((runner, side, price), 0)
+            if new_amount != old_amount:
+                changes.append(LevelChange(market_id, runner, side, price, old_amount, new_amount))
+        for (runner, side, price), amount in new.items():
+            if (runner, side, price) not in old:
+                changes.append(LevelChange(market_id, runner, side, price, 0, amount))
+        return changes
+
+    def forget(self, market_id):
+        '''
+        Drop a market, e.g. once it closed
+
+        Response: list of LevelChange removing its levels
+        '''
+        self.__versions.pop(market_id, None)
+        old = self.__levels.pop(market_id, {})
+        return [LevelChange(market_id, runner, side, price, amount, 0)
+                for (runner, side, price), amount in old.items()]
+
+    def __parse(self, ordbstr):
+        levels = {}
+        for runner, ob in enumerate(ob for ob in ordbstr.split('~') if ob):
+            ob = json.loads(ob)
+            for side, key in ((self.BID, 'Bids'), (self.ASK, 'Asks')):
+                for price, amount in ob.get(key) or ():
+                    level = (runner, side, price)
+                    levels[level] = levels.get(level, 0) + amount
+        return levels
+
+
+Level = collections.namedtuple('Level', 'market_id runner side price amount')
+
+
+class FairlayLargeOrderIndex(object):
+    '''
+    Order book levels sorted by amount, partitioned by ('CatID', 'Comp').
+
+    query() answers "all levels >= amount in a category/competition" with a
+    binary search per partition, so several thresholds and filters share one
+    index instead of each rescanning every order book. The index is kept up to
+    date from LevelChange lists: update() diffs fetched markets itself, and
+    apply() takes the changes of FairlayMarketFetcher.subscribe() (with the
+    fetcher's `markets` given to look up the partition of new markets), e.g.
+    fetcher.subscribe(FairlayLargeOrderIndex(fetcher.markets).apply).
+    '''
+
+    def __init__(self, markets=None):
+        super(FairlayLargeOrderIndex, self).__init__()
+        self.markets = markets
+        self.__diff = FairlayOrderBookDiff()
+        self.__lock = threading.Lock()
+        self.__partitions = {}
+        self.__competitions = collections.defaultdict(list)
+        self.__market_partition = {}
+        self.__market_levels = collections.Counter()
+
+    def __len__(self):
+        return sum(self.__market_levels.values())
+
+    def update(self, markets):
+        '''
+        Index the order books of fetched markets, replacing their previous levels
+        '''
+        markets = list(markets)
+        changes = []
+        for market in markets:
+            changes.extend(self.__diff.diff(market))
+        by_id = {m['ID']: m for m in markets}
+        # A market may change competition without any change to its order book
+        self.__apply(changes, by_id, by_id)
+
+    def apply(self, changes, market_ids=(), markets=None):
+        '''
+        Request:
+            changes: list of LevelChange
+            market_ids: IDs of updated markets, moved to their new partition if their 'CatID' or
+                'Comp' changed even though their levels did not
+            markets: mapping of market ID -> market, for the 'CatID' and 'Comp' of the changed
+                markets (default: the `markets` given to the constructor)
+        '''
+        markets = self.markets if markets is None else markets
+        if markets is None:
+            raise ValueError('FairlayLargeOrderIndex.apply() needs the markets, none were given to the constructor')
+        self.__apply(changes, markets, {change.market_id for change in changes}.union(market_ids))
+
+    def __apply(self, changes, markets, market_ids):
+        partitions = {}
+        for market_id in market_ids:
+            market = markets.get(market_id)
+            if market is not None:
+                partitions[market_id] = (market['CatID'], market['Comp'])
+
+        with self.__lock:
+            for market_id, key in partitions.items():
+                old_key = self.__market_partition.get(market_id)
+                if old_key is not None and old_key != key:
+                    self.__move(market_id, old_key, key)
+            for change in changes:
+                market_id = change.market_id
+                key = self.__market_partition.get(market_id)
+                if key is None:
+                    if not change.new_amount:
+                        continue
+                    if market_id not in partitions:
+                        raise KeyError(f'Market {market_id} is not in the markets, its partition is unknown')
+                    key = partitions[market_id]
+                if change.old_amount:
+                    self.__remove(key, (change.old_amount, market_id, change.runner, change.side, change.price))
+                if change.new_amount:
+                    self.__insert(key, (change.new_amount, market_id, change.runner, change.side, change.price))
+
+    def query(self, min_amount, cat_id=None, comp=None):
+        '''
+        Request:
+            cat_id: 'CatID' of the markets, all categories if None
+            comp: 'Comp' of the markets or a prefix of it, all competitions if None
+
+        Response: list of Level with amount >= min_amount, largest first
+        '''
+        with self.__lock:
+            runs = []
+            for key in self.__matching_partitions(cat_id, comp):
+                entries = self.__partitions[key]
+                runs.append(reversed(entries[bisect.bisect_left(entries, (min_amount,)):]))
+            return [Level(market_id, runner, side, price, amount)
+                    for amount, market_id, runner, side, price in heapq.merge(*runs, reverse=True)]
+
+    def __matching_partitions(self, cat_id, comp):
+        categories = self.__competitions if cat_id is None else [cat_id]
+        for cat in categories:
+            comps = self.__competitions.get(cat, [])
+            if comp is None:
+                start, end = 0, len(comps)
+            else:
+                start = bisect.bisect_left(comps, comp)
+                end = start
+                while end < len(comps) and comps[end].startswith(comp):
+                    end += 1
+            for c in comps[start:end]:
+                yield cat, c
+
+    def __insert(self, key, entry):
+        entries = self.__partitions.get(key)
+        if entries is None:
+            entries = self.__partitions[key] = []
+            bisect.insort(self.__competitions[key[0]], key[1])
+        bisect.insort(entries, entry)
+        self.__market_partition[entry[1]] = key
+        self.__market_levels[entry[1]] += 1
+
+    def __move(self, market_id, old_key, key):
+        entries = [entry for entry in self.__partitions.get(old_key, []) if entry[1] == market_id]
+        for entry in entries:
+            self.__remove(old_key, entry)
+        for entry in entries:
+            self.__insert(key, entry)
+
+    def __remove(self, key, entry):
+        entries = self.__partitions.get(key, [])
+        i = bisect.bisect_left(entries, entry)
+        if i == len(entries) or entries[i] != entry:
+            return
+        del entries[i]
+        market_id = entry[1]
+        self.__market_levels[market_id] -= 1
+        if not self.__market_levels[market_id]:
+            del self.__market_levels[market_id]
+            del self.__market_partition[market_id]
+        if not entries:
+            del self.__partitions[key]
+            comps = self.__competitions[key[0]]
+            comps.remove(key[1])
+            if not comps:
+                del self.__competitions[key[0]]
@@ -0,0 +1,253 @@
+import collections
+import threading
+import time
+
+
+def order_key(order):
+    return (order['_UserUMOrderID'], order['_MatchedOrder']['ID'])
+
+
+def order_position(order):
+    '''
+    Possible winnings and losings of one matched order in BTC
+
+    Response: (market ID, runner ID, winnings, losings)
+    '''
+    is_back = order['_UserOrder']['BidOrAsk'] == 1
+    amount = order['_MatchedOrder']['Amount'] / 1000.0
+    odds = order['_MatchedOrder']['Price']
+
+    if is_back:
+        winnings = (amount * odds) - amount
+        losings = -amount
+    else:
+        winnings = -amount
+        losings = (amount * (1 + (1 / (odds - 1)))) - amount
+    return order['_UserOrder']['MarketID'], order['_UserOrder']['RunnerID'], winnings, losings
+
+
+class FairlayPositionEngine(object):
+    '''
+    Positions of the account on every market, kept up to date incrementally.
+
+    update() only downloads the matched orders changed since the previous
+    update (get_orders' `timestamp`) and applies them; an order seen again
+    replaces its previous contribution. position() then answers from memory
+    in O(runners). rebuild() recomputes everything from a full history with
+    NumPy.
+    '''
+
+    # Seconds re-requested before the last update, to cover clock skew
+    OVERLAP = 60
+
+    def __init__(self, client=None):
+        super(FairlayPositionEngine, self).__init__()
+        self.client = client
+        self.timestamp = None
+        self.__lock = threading.Lock()
+        self.__orders = {}
+        self.__positions = collections.defaultdict(dict)
+
+    def update(self):
+        '''
+        Fetch and apply the matched orders changed since the last update (all of them the first time)
+
+        Response: int (number of orders applied)
+        '''
+        started = int(time.time())
+        if self.timestamp is None:
+            orders = self.client.get_orders('matched')
+            self.rebuild(orders)
+        else:
+            orders = self.client.get_orders('matched', timestamp=self.timestamp - self.OVERLAP)
+            self.apply(orders)
+        self.timestamp = started
+        return len(orders)
+
+    def apply(self, orders):
+        with self.__lock:
+            for order in orders:
+                key = order_key(order)
+                old = self.__orders.get(key)
+                if old is not None:
+                    self.__add(old[0], old[1], -old[2], -old[3])
+                new = order_position(order)
+                self.__orders[key] = new
+                self.__add(*new)
+
+    def rebuild(self, orders):
+        '''
+        Replace all positions by the ones of a full matched order history
+        '''
+        import numpy as np
+
+        keys = [order_key(o) for o in orders]
+        market = np.array([o['_UserOrder']['MarketID'] for o in orders], dtype=np.int64)
+        runner = np.array([o['_UserOrder']['RunnerID'] for o in orders], dtype=np.int64)
+        is_back = np.array([o['_UserOrder']['BidOrAsk'] == 1 for o in orders], dtype=bool)
+        amount = np.array([o['_MatchedOrder']['Amount'] for o in orders], dtype=np.float64) / 1000.0
+        odds = np.array([o['_MatchedOrder']['Price'] for o in orders], dtype=np.float64)
+
+        with np.errstate(divide='ignore'):
+            winnings = np.where(is_back, amount * odds - amount, -amount)
+            losings = np.where(is_back, -amount, amount * (1 + 1 / (odds - 1)) - amount)
+
+        books, inverse = np.unique(np.column_stack((market, runner)).reshape(-1, 2), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        total_winnings = np.bincount(inverse, weights=winnings, minlength=len(books))
+        total_losings = np.bincount(inverse, weights=losings, minlength=len(books))
+
+        positions = collections.defaultdict(dict)
+        for (m_id, r_id), w, l in zip(books.tolist(), total_winnings.tolist(), total_losings.tolist()):
+            positions[m_id][r_id] = [w, l]
+        contributions = dict(zip(keys, zip(market.tolist(), runner.tolist(), winnings.tolist(), losings.tolist())))
+
+        with self.__lock:
+            self.__positions = positions
+            self.__orders = contributions
+
+    def position(self, market_id):
+        '''
+            Position for each runner in the specified market ID, as FairlayOrderMatching.calculate_position
+            Return possible winnings and losing for each runner in BTC
+        '''
+        with self.__lock:
+            runners = {r_id: list(v) for r_id, v in self.__positions.get(market_id, {}).items()}
+
+        total_losings = sum(l for w, l in runners.values())
+        return {r_id: {'possible_winnings': w, 'possible_losings': total_losings}
+                for r_id, (w, l) in runners.items()}
+
+    def markets(self):
+        with self.__lock:
+            return list(self.__positions)
+
+    def __add(self, market_id, runner_id, winnings, losings):
+        runners = self.__positions[market_id]
+        if runner_id in runners:
+            runners[runner_id][0] += winnings
+            runners[runner_id][1] += losings
+        else:
+            runners[runner_id] = [winnings, losings]
+
+
+class FairlayMatchedOrderTracker(object):
+    '''
+    Follows the account's fills in a background thread.
+
+    Every `interval` seconds it asks only for the matched orders changed since
+    the previous poll and indexes them by the unmatched order they filled
+    ('_UserUMOrderID'). Callers can block on wait_for() or subscribe() a
+    callback for given order IDs instead of sleeping and scanning the history.
+    It only polls while a wait_for() is in progress or a subscription remains,
+    so an idle tracker uses none of the account's requests. stop() ends the
+    thread.
+    '''
+
+    # Seconds re-requested before the previous poll, to cover clock skew
+    OVERLAP = 60
+
+    def __init__(self, client, interval=0.5, positions=None):
+        super(FairlayMatchedOrderTracker, self).__init__()
+        self.client = client
+        self.interval = interval
+        self.positions = positions
+        self.timestamp = int(time.time())
+        self.__matches = collections.defaultdict(dict)
+        self.__subscribers = collections.defaultdict(list)
+        self.__waiters = 0
+        self.__condition = threading.Condition()
+        # Set while someone waits for or subscribes to fills
+        self.__active = threading.Event()
+        self.event = threading.Event()
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        while not self.event.is_set():
+            self.__active.wait()
+            if self.event.is_set():
+                break
+            try:
+                self.poll()
+            except Exception as e:
+                print(f'Cannot poll matched orders: {e!r}')
+            self.event.wait(self.interval)
+
+    def poll(self):
+        '''
+        Response: list of the matched orders that are new or changed since the previous poll
+        '''
+        started = int(time.time())
+        orders = self.client.get_orders('matched', timestamp=self.timestamp - self.OVERLAP)
+
+        changed = []
+        with self.__condition:
+            for order in orders:
+                matches = self.__matches[order['_UserUMOrderID']]
+                key = order_key(order)
+                old = matches.get(key)
+                if old is None or old['_MatchedOrder'] != order['_MatchedOrder']:
+                    matches[key] = order
+                    changed.append(order)
+            callbacks = [(cb, o) for o in changed for cb in self.__subscribers.get(o['_UserUMOrderID'], ())]
+            if changed:
+                self.__condition.notify_all()
+        self.timestamp = started
+
+        if self.positions is not None and changed:
+            self.positions.apply(changed)
+        for callback, order in callbacks:
+            callback(order)
+        return changed
+
+    def matches(self, order_id):
+        '''
+        Response: list of the matched orders seen for an unmatched order ID
+        '''
+        with self.__condition:
+            return list(self.__matches.get(order_id, {}).values())
+
+    def wait_for(self, order_id, timeout=None):
+        '''
+        Block until the order has at least one fill
+
+        Response: list of matched orders ([] on timeout)
+        '''
+        with self.__condition:
+            self.__waiters += 1
+            self.__update_activity()
+            try:
+                self.__condition.wait_for(lambda: self.__matches.get(order_id), timeout)
+            finally:
+                self.__waiters -= 1
+                self.__update_activity()
+            return list(self.__matches.get(order_id, {}).values())
+
+    def subscribe(self, order_id, callback):
+        '''
+        Call callback(matched_order) from the tracker thread on every new or changed fill of the order
+        '''
+        with self.__condition:
+            self.__subscribers[order_id].append(callback)
+            self.__update_activity()
+
+    def unsubscribe(self, order_id, callback=None):
+        with self.__condition:
+            if callback is None:
+                self.__subscribers.pop(order_id, None)
+            elif callback in self.__subscribers.get(order_id, ()):
+                self.__subscribers[order_id].remove(callback)
+                if not self.__subscribers[order_id]:
+                    del self.__subscribers[order_id]
+            self.__update_activity()
+
+    def __update_activity(self):
+        # Called with the condition held
+        if self.__waiters or self.__subscribers:
+            self.__active.set()
+        else:
+            self.__active.clear()
+
+    def stop(self):
+        self.event.set()
+        self.__active.set()
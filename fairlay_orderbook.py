@@ -0,0 +1,117 @@
+import json
+
+import numpy as np
+
+
+def parse_order_book(ordbstr):
+    '''
+    'OrdBStr' of a market to a list with one {'Bids': [[price, amount], ...], 'Asks': [...]}
+    per runner, decoded with a single json.loads
+    '''
+    if not ordbstr:
+        return []
+    return json.loads('[' + ','.join(ob for ob in ordbstr.split('~') if ob) + ']')
+
+
+class FairlayOrderBook(object):
+    '''
+    Order books of many markets in columnar form, built once per fetch.
+
+    Every price level of every market is one row of the contiguous `price` and
+    `amount` arrays. Rows are grouped by market, then runner, then side (bids
+    before asks, each in the order Fairlay sent them). For each row, `market` is
+    the index into `markets`, `book` the index of its (market, runner) book and
+    `side` BID or ASK. The rows of the i-th market are offsets[i]:offsets[i+1],
+    and book_market/book_runner give the market index and runner of each book.
+    '''
+
+    BID = 0
+    ASK = 1
+
+    def __init__(self, markets):
+        super(FairlayOrderBook, self).__init__()
+        self.markets = list(markets)
+
+        book_market, book_runner = [], []
+        segment_book, segment_side, counts, levels = [], [], [], []
+        for m, market in enumerate(self.markets):
+            for r, runner in enumerate(parse_order_book(market.get('OrdBStr'))):
+                book = len(book_market)
+                book_market.append(m)
+                book_runner.append(r)
+                for side, key in ((self.BID, 'Bids'), (self.ASK, 'Asks')):
+                    rows = runner.get(key) or []
+                    segment_book.append(book)
+                    segment_side.append(side)
+                    counts.append(len(rows))
+                    levels.extend(rows)
+
+        table = np.array(levels, dtype=np.float64).reshape(-1, 2)
+        self.price = np.ascontiguousarray(table[:, 0])
+        self.amount = np.ascontiguousarray(table[:, 1])
+        self.book_market = np.array(book_market, dtype=np.int64)
+        self.book_runner = np.array(book_runner, dtype=np.int64)
+        self.book = np.repeat(np.array(segment_book, dtype=np.int64), counts)
+        self.side = np.repeat(np.array(segment_side, dtype=np.int8), counts)
+        self.market = self.book_market[self.book]
+        self.offsets = np.searchsorted(self.market, np.arange(len(self.markets) + 1))
+
+    def __len__(self):
+        return len(self.price)
+
+    def levels(self, rows):
+        '''
+        Response: list of [price, amount] for the given rows
+        '''
+        return np.column_stack((self.price[rows], self.amount[rows])).tolist()
+
+    def large_orders(self, min_amount, side=None):
+        '''
+        Response: array of the rows with amount >= min_amount (on one side if given)
+        '''
+        mask = self.amount >= min_amount
+        if side is not None:
+            mask &= self.side == side
+        return np.flatnonzero(mask)
+
+    def group_by_market(self, rows):
+        '''
+        Split sorted rows by market
+
+        Response: list of (market index, rows of that market)
+        '''
+        if not len(rows):
+            return []
+        markets = self.market[rows]
+        starts = np.flatnonzero(np.diff(markets)) + 1
+        return list(zip(markets[np.r_[0, starts]].tolist(), np.split(rows, starts)))
+
+    def best_prices(self):
+        '''
+        Response: (best_bid, best_ask), arrays with one price per book (NaN if the side is empty).
+            The best bid is the highest bid price and the best ask the lowest ask price.
+        '''
+        best_bid = np.full(len(self.book_market), np.nan)
+        best_ask = np.full(len(self.book_market), np.nan)
+        bids = self.side == self.BID
+        np.fmax.at(best_bid, self.book[bids], self.price[bids])
+        np.fmin.at(best_ask, self.book[~bids], self.price[~bids])
+        return best_bid, best_ask
+
+    def depth(self, side, limit):
+        '''
+        Amount available on one side up to a price
+
+        Request:
+            side: BID or ASK
+            limit: price, a scalar or an array with one price per book.
+                Bids priced >= limit and asks priced <= limit are counted.
+
+        Response: array with the amount per book
+        '''
+        limit = np.broadcast_to(np.asarray(limit, dtype=np.float64), self.book_market.shape)[self.book]
+        if side == self.BID:
+            mask = (self.side == side) & (self.price >= limit)
+        else:
+            mask = (self.side == side) & (self.price <= limit)
+        return np.bincount(self.book[mask], weights=self.amount[mask], minlength=len(self.book_market))
@@ -1,10 +1,16 @@
 #! /usr/bin/env python3
 
-import json
-import requests
+import concurrent.futures
+import os
 import time
 
-from client import FairlayPythonClient
+import requests
+
+from fairlay_client import FairlayPythonClient
+from fairlay_markets import FairlayLargeOrderIndex
+from fairlay_orderbook import FairlayOrderBook
+from fairlay_snapshots import FairlaySnapshotStore
+from fx_rates import FxRateService, FxRateUnavailable, blockchain_usd_rates
 
 # Some pre-defined market filters
 class FILTER(object):
@@ -13,55 +19,124 @@ class FILTER(object):
     NBA = {'Cat': 12, 'Comp': 'NBA'}
 
 
-def fetch_large_market_orders(min_mBTC_amount, market_filter={}):
-    client = FairlayPythonClient()
-
-    print(f'Fetching markets and odds {market_filter} ...')
-    from_id = 0
-    increment = 10000
-
-    new_markets = []
-    # filters = {'FromID': from_id,'NoZombie': True, "OnlyActive": True, "SortPopular": True}
-    # filters.update(market_filter)
-    # new_markets = client.get_markets_and_odds(filters)
-    while True:
-        filters = {'FromID': from_id, 'ToID': from_id + increment,
-                   'NoZombie': True, "OnlyActive": True,
-                   "SortPopular": True}
+class FairlayMarketDownloader(object):
+    '''
+    Downloads the markets of several filters at once.
+
+    Each filter's result list is split into FromID/ToID shards of shard_size
+    markets. Every filter keeps shards_ahead shards in flight on a shared pool
+    of worker threads, and a filter stops at its first short shard. Shards are
+    yielded as soon as they return. The clock offset to the server is looked
+    up once for all of them, and `timings` records each shard. A shard still
+    failing after SHARD_TRIES attempts is listed in `failed` as (filter name,
+    FromID) and skipped, the following shards of its filter being downloaded
+    anyway. A filter is given up after SHARD_TRIES consecutive failed shards,
+    as the API is then most likely down.
+    '''
+
+    BASE_FILTER = {'NoZombie': True, "OnlyActive": True, "SortPopular": True}
+    SHARD_TRIES = 3
+    RETRY_DELAY = 1  # in seconds
+
+    def __init__(self, client=None, workers=8, shard_size=2000, shards_ahead=2):
+        super(FairlayMarketDownloader, self).__init__()
+        self.client = client or FairlayPythonClient()
+        self.workers = workers
+        self.shard_size = shard_size
+        self.shards_ahead = shards_ahead
+        self.timings = []
+        self.failed = []
+
+    def download(self, filters):
+        '''
+        Request:
+            filters: dictionary of name -> market filter
+
+        Response: generator of (name, list of markets), one per shard
+        '''
+        self.client.sync_server_time()
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = {}
+            next_from_id = dict.fromkeys(filters, 0)
+            failures = dict.fromkeys(filters, 0)
+            finished = set()
+
+            def submit(name):
+                from_id = next_from_id[name]
+                next_from_id[name] += self.shard_size
+                pending[executor.submit(self.__fetch_shard, filters[name], from_id)] = (name, from_id)
+
+            for name in filters:
+                for _ in range(self.shards_ahead):
+                    submit(name)
+
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name, from_id = pending.pop(future)
+                    markets, seconds = future.result()
+                    self.timings.append({'filter': name, 'from_id': from_id,
+                                         'markets': None if markets is None else len(markets), 'seconds': seconds})
+                    if markets is None:
+                        # Not the end of the filter's markets, only unknown ones
+                        print(f'Cannot download the markets of {name}[{from_id}:{from_id + self.shard_size}], skipped.')
+                        self.failed.append((name, from_id))
+                        failures[name] += 1
+                        if failures[name] >= self.SHARD_TRIES and name not in finished:
+                            print(f'Cannot download the markets of {name}, {failures[name]} shards failed in a row.')
+                            finished.add(name)
+                        if name not in finished:
+                            submit(name)
+                        continue
+                    failures[name] = 0
+                    if len(markets) < self.shard_size:
+                        finished.add(name)
+                    elif name not in finished:
+                        submit(name)
+                    yield name, markets
+
+    def __fetch_shard(self, market_filter, from_id):
+        filters = {'FromID': from_id, 'ToID': from_id + self.shard_size}
+        filters.update(self.BASE_FILTER)
         filters.update(market_filter)
-        mkts = client.get_markets_and_odds(filters)
+        start = time.perf_counter()
+        for attempt in range(self.SHARD_TRIES):
+            if attempt:
+                time.sleep(self.RETRY_DELAY)
+            try:
+                markets = self.client.get_markets_and_odds(filters)
+            except requests.exceptions.ConnectionError:
+                continue
+            # None when the server answered an error
+            if markets is not None:
+                return markets, time.perf_counter() - start
+        return None, time.perf_counter() - start
+
+    def print_timings(self):
+        for t in sorted(self.timings, key=lambda t: (t['filter'], t['from_id'])):
+            markets = 'failed' if t['markets'] is None else f"{t['markets']} market(s)"
+            print(f"  shard {t['filter']}[{t['from_id']}:{t['from_id'] + self.shard_size}]"
+                  f"  {markets} in {t['seconds']:.2f}s")
 
-        if mkts is not None:
-            new_markets += mkts
 
-        if len(new_markets) < from_id + increment:
-            break
-        else:
-            from_id += increment
-        print('...')
+def print_large_orders(client, order_book, min_mBTC_amount):
+    '''
+    Print the markets of a FairlayOrderBook having orders >= min_mBTC_amount
+
+    Response: int (number of markets printed)
+    '''
+    # All price levels of all markets, as [price, amount]:
+    #   price: the decimal odds at which the order is placed.
+    #   amount: the amount in mBTC.
+    markets = order_book.markets
+    large_rows = order_book.large_orders(min_mBTC_amount)
 
-    print(f'Filtering market orders >= {min_mBTC_amount} mBTC ...')
     count = 0
-    for market in new_markets:
-        if market['OrdBStr']:
-            OrderBook = [json.loads(ob) for ob in market['OrdBStr'].split('~') if ob]
-        large_order = []
-        for ru_order in OrderBook:
-            # Array of open bids orders
-            for order in ru_order['Bids']:
-                # order: [ price, amount ]
-                #   price: the decimal odds at which the order is placed.
-                #   amount: the amount in mBTC.
-                if order[1] >= min_mBTC_amount:
-                    large_order.append(order)
-            # Array of open asks orders
-            for order in ru_order['Asks']:
-                if order[1] >= min_mBTC_amount:
-                    large_order.append(order)
-
-        # No large order for this market, skip printing
-        if len(large_order) == 0:
-            continue
+    for market_idx, rows in order_book.group_by_market(large_rows):
+        market = markets[market_idx]
+        # Open bids then asks of each runner
+        large_order = order_book.levels(rows)
 
         count += 1
         # Many fields that can be displayed
@@ -71,26 +146,94 @@ def fetch_large_market_orders(min_mBTC_amount, market_filter={}):
         SettlementType = client.MARKET_SETTLEMENT[market['SettlT']]
         # Visit https://fairlay.com/market/{market['ID']} on browser
         print(f"MarketID:{market['ID']} Category:{MarketCategory} Comp:{market['Comp']} Period:{MarketPeriod} large_order([odds, amount]):{large_order}")
-    print(f'({count}/{len(new_markets)} row(s) in total)')
+    return count
+
+
+def fetch_large_market_orders(min_mBTC_amount, market_filter={}):
+    fetch_large_orders_parallel(min_mBTC_amount, {'': market_filter})
+
+
+def fetch_large_orders_parallel(min_mBTC_amount, filters, workers=8, snapshot_dir=None):
+    '''
+    Request:
+        filters: dictionary of name -> market filter
+        snapshot_dir: directory of a FairlaySnapshotStore recording the fetched order books
+    '''
+    downloader = FairlayMarketDownloader(workers=workers)
+    snapshots = FairlaySnapshotStore(snapshot_dir) if snapshot_dir else None
+
+    print(f'Fetching markets and odds {filters} and filtering orders >= {min_mBTC_amount} mBTC ...')
+    start = time.perf_counter()
+    count = dict.fromkeys(filters, 0)
+    total = dict.fromkeys(filters, 0)
+    for name, markets in downloader.download(filters):
+        order_book = FairlayOrderBook(markets)
+        if snapshots is not None:
+            snapshots.append_order_book(order_book)
+        count[name] += print_large_orders(downloader.client, order_book, min_mBTC_amount)
+        total[name] += len(markets)
+
+    for name in filters:
+        print(f'{name}: ({count[name]}/{total[name]} row(s) in total)')
+    print(f'{len(downloader.timings)} shard(s) in {time.perf_counter() - start:.2f}s:')
+    downloader.print_timings()
+    if downloader.failed:
+        print(f'Incomplete: {len(downloader.failed)} shard(s) could not be downloaded.')
+
+def fetch_large_orders_for_desks(desks, workers=8):
+    '''
+    Download the markets of every desk's filter once and answer all the desks from one FairlayLargeOrderIndex
+
+    Request:
+        desks: dictionary of name -> (min_mBTC_amount, market filter), the filter using 'Cat' and 'Comp'
+    '''
+    downloader = FairlayMarketDownloader(workers=workers)
+    filters = {}
+    for _, market_filter in desks.values():
+        filters.setdefault(repr(sorted(market_filter.items())), market_filter)
+    index = FairlayLargeOrderIndex()
+    markets = {}
+    for _, shard in downloader.download(filters):
+        index.update(shard)
+        markets.update((m['ID'], m) for m in shard)
+    if downloader.failed:
+        print(f'Incomplete: {len(downloader.failed)} shard(s) could not be downloaded.')
+
+    for name, (min_mBTC_amount, market_filter) in desks.items():
+        levels = index.query(min_mBTC_amount, market_filter.get('Cat'), market_filter.get('Comp'))
+        print(f'{name}: {len(levels)} level(s) >= {min_mBTC_amount} mBTC')
+        for level in levels:
+            market = markets[level.market_id]
+            side = 'bid' if level.side == FairlayOrderBook.BID else 'ask'
+            print(f"  MarketID:{market['ID']} Comp:{market['Comp']} Runner:{level.runner} {side} [odds, amount]:{[level.price, level.amount]}")
+
+
+_fx_rates = None
+
 
-def usd_to_mBTC(dollar):
+def usd_to_mBTC(dollar, fx_rates=None):
+    '''
+    Request:
+        fx_rates: FxRateService, by default one shared by the calls fetching from blockchain.info
+    '''
+    global _fx_rates
+    if fx_rates is None:
+        if _fx_rates is None:
+            _fx_rates = FxRateService([blockchain_usd_rates])
+        fx_rates = _fx_rates
     try:
-        # https://www.blockchain.com/api/exchange_rates_api
-        call = 'https://blockchain.info/tobtc?currency=USD&value=' + str(dollar)
-        response = requests.get(call)
-        if response.status_code != 200:
-            print('Cannot get recent USD/BTC exchange rate.')
-            return 100
-        btc = response.json()
-        return btc * 1000
-    except requests.exceptions.ConnectionError:
+        (btc,), stale = fx_rates.from_usd([dollar], 'btc')
+    except FxRateUnavailable:
         print('Cannot get recent USD/BTC exchange rate.')
         return 100
+    if stale:
+        print('Using an outdated USD/BTC exchange rate.')
+    return btc * 1000
 
 if __name__ == '__main__':
     min_usd_amount = 5000
     min_mBTC_amount = usd_to_mBTC(min_usd_amount)
-    fetch_large_market_orders(min_mBTC_amount, FILTER.NFL)
-    fetch_large_market_orders(min_mBTC_amount, FILTER.NCAAF)
-    fetch_large_market_orders(min_mBTC_amount, FILTER.NBA)
+    fetch_large_orders_parallel(min_mBTC_amount, {'NFL': FILTER.NFL, 'NCAAF': FILTER.NCAAF, 'NBA': FILTER.NBA},
+                                snapshot_dir=os.environ.get('FAIRLAY_SNAPSHOT_DIR'))
     # fetch_large_market_orders(min_mBTC_amount) # All
+    # fetch_large_orders_for_desks({'NFL': (min_mBTC_amount, FILTER.NFL), 'NBA': (10 * min_mBTC_amount, FILTER.NBA)})
@@ -0,0 +1,202 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+class FairlaySnapshotStore(object):
+    '''
+    Append-only on-disk history of order books.
+
+    A directory of segment files, each a sequence of chunks. A chunk is one
+    fetched order book: a header followed by its columns (market ID, price,
+    amount, timestamp, runner, side) stored contiguously, with the rows sorted
+    by market ID. Readers memory-map the segments and get the columns as NumPy
+    views of the file, so range queries by time or market only copy the rows
+    they return. Segments are rotated at segment_bytes, and compact() merges
+    old segments into one, optionally dropping rows older than a given time.
+    '''
+
+    MAGIC = b'FOB1'
+    # magic, rows, min/max timestamp, min/max market ID
+    HEADER = struct.Struct('<4sIddqq')
+    COLUMNS = (('market', np.int64), ('price', np.float64), ('amount', np.float64),
+               ('timestamp', np.float64), ('runner', np.int32), ('side', np.int8))
+    SUFFIX = '.fob'
+
+    def __init__(self, directory, segment_bytes=64 * 2**20):
+        super(FairlaySnapshotStore, self).__init__()
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.__lock = threading.Lock()
+        self.__segment = None
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self):
+        return sorted(os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                      if f.endswith(self.SUFFIX))
+
+    def append(self, market, runner, side, price, amount, timestamp=None):
+        '''
+        Append one snapshot, given as equally long arrays (timestamp may be a scalar, default now)
+        '''
+        timestamp = time.time() if timestamp is None else timestamp
+        columns = {
+            'market': np.asarray(market, dtype=np.int64),
+            'price': np.asarray(price, dtype=np.float64),
+            'amount': np.asarray(amount, dtype=np.float64),
+            'runner': np.asarray(runner, dtype=np.int32),
+            'side': np.asarray(side, dtype=np.int8),
+        }
+        columns['timestamp'] = np.broadcast_to(np.asarray(timestamp, dtype=np.float64),
+                                               columns['market'].shape)
+        if not len(columns['market']):
+            return
+
+        with self.__lock:
+            path = self.__current_segment(float(columns['timestamp'].min()))
+            if path != self.__segment:
+                self.__truncate_torn_chunk(path)
+                self.__segment = path
+            with open(path, 'ab') as f:
+                f.write(self.__encode_chunk(columns))
+
+    def append_order_book(self, order_book, timestamp=None):
+        '''
+        Append a FairlayOrderBook
+        '''
+        market_ids = np.array([m['ID'] for m in order_book.markets], dtype=np.int64)
+        self.append(market_ids[order_book.market] if len(market_ids) else order_book.market,
+                    order_book.book_runner[order_book.book], order_book.side,
+                    order_book.price, order_book.amount, timestamp)
+
+    def chunks(self, start=None, end=None, paths=None):
+        '''
+        Zero-copy views of the stored chunks overlapping [start, end)
+
+        Response: generator of dictionaries of column name -> array
+        '''
+        for path in paths or self.segments():
+            if not os.path.getsize(path):
+                continue
+            with open(path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            for offset, rows, min_ts, max_ts in self.__headers(buffer):
+                if (start is None or max_ts >= start) and (end is None or min_ts < end):
+                    yield self.__decode_chunk(buffer, offset, rows)
+
+    def query(self, start=None, end=None, market_id=None):
+        '''
+        Rows with start <= timestamp < end, of one market if market_id is given
+
+        Response: dictionary of column name -> array
+        '''
+        parts = []
+        for chunk in self.chunks(start, end):
+            if market_id is not None:
+                lo, hi = np.searchsorted(chunk['market'], [market_id, market_id + 1])
+                chunk = {name: column[lo:hi] for name, column in chunk.items()}
+            mask = np.ones(len(chunk['market']), dtype=bool)
+            if start is not None:
+                mask &= chunk['timestamp'] >= start
+            if end is not None:
+                mask &= chunk['timestamp'] < end
+            parts.append({name: column[mask] for name, column in chunk.items()})
+
+        return {name: np.concatenate([p[name] for p in parts]) if parts else np.empty(0, dtype)
+                for name, dtype in self.COLUMNS}
+
+    def compact(self, older_than, drop_before=None):
+        '''
+        Merge every segment whose rows are all older than `older_than` into a
+        single segment sorted by market and time, dropping rows older than
+        drop_before if given.
+
+        Response: int (number of segments merged)
+        '''
+        with self.__lock:
+            old = []
+            for path in self.segments():
+                last = max((c['timestamp'].max() for c in self.chunks(paths=[path])), default=None)
+                if last is not None and last < older_than:
+                    old.append(path)
+            if not old or (len(old) == 1 and drop_before is None):
+                return 0
+
+            chunks = [c for c in self.chunks(paths=old)]
+            columns = {name: np.concatenate([c[name] for c in chunks]) for name, _ in self.COLUMNS}
+            if drop_before is not None:
+                keep = columns['timestamp'] >= drop_before
+                columns = {name: column[keep] for name, column in columns.items()}
+
+            target = old[0]
+            tmp = target + '.tmp'
+            with open(tmp, 'wb') as f:
+                if len(columns['market']):
+                    f.write(self.__encode_chunk(columns))
+            del chunks
+            os.replace(tmp, target)
+            self.__segment = None
+            for path in old[1:]:
+                os.remove(path)
+            return len(old)
+
+    def __current_segment(self, timestamp):
+        segments = self.segments()
+        if segments and os.path.getsize(segments[-1]) < self.segment_bytes:
+            return segments[-1]
+        name = '{:015d}{}'.format(int(timestamp * 1000), self.SUFFIX)
+        path = os.path.join(self.directory, name)
+        while path in segments:
+            timestamp += 0.001
+            path = os.path.join(self.directory, '{:015d}{}'.format(int(timestamp * 1000), self.SUFFIX))
+        return path
+
+    def __headers(self, buffer):
+        offset = 0
+        while offset + self.HEADER.size <= len(buffer):
+            magic, rows, min_ts, max_ts, _, _ = self.HEADER.unpack_from(buffer, offset)
+            size = self.__chunk_size(rows)
+            if magic != self.MAGIC or offset + size > len(buffer):
+                break  # torn write at the end of the segment
+            yield offset, rows, min_ts, max_ts
+            offset += size
+
+    def __truncate_torn_chunk(self, path):
+        # Chunks appended after a torn write would be unreachable
+        if not os.path.exists(path):
+            return
+        with open(path, 'r+b') as f:
+            data = f.read()
+            end = 0
+            for offset, rows, _, _ in self.__headers(data):
+                end = offset + self.__chunk_size(rows)
+            if end < len(data):
+                f.truncate(end)
+
+    def __chunk_size(self, rows):
+        size = self.HEADER.size + sum(np.dtype(dtype).itemsize * rows for _, dtype in self.COLUMNS)
+        return size + (-size % 8)
+
+    def __encode_chunk(self, columns):
+        order = np.lexsort((columns['timestamp'], columns['market']))
+        rows = len(order)
+        parts = [self.HEADER.pack(self.MAGIC, rows,
+                                  float(columns['timestamp'].min()), float(columns['timestamp'].max()),
+                                  int(columns['market'].min()), int(columns['market'].max()))]
+        for name, dtype in self.COLUMNS:
+            parts.append(np.ascontiguousarray(columns[name][order], dtype=dtype).tobytes())
+        data = b''.join(parts)
+        return data + b'\0' * (-len(data) % 8)
+
+    def __decode_chunk(self, buffer, offset, rows):
+        chunk = {}
+        offset += self.HEADER.size
+        for name, dtype in self.COLUMNS:
+            chunk[name] = np.frombuffer(buffer, dtype=dtype, count=rows, offset=offset)
+            offset += np.dtype(dtype).itemsize * rows
+        return chunk
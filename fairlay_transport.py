@@ -0,0 +1,388 @@
+import asyncio
+import collections
+import math
+import random
+import socket
+import threading
+import time
+import zlib
+
+
+class _StaleConnection(ConnectionError):
+    '''The server closed an idle connection before answering on it'''
+
+
+class FairlayRateLimiter(object):
+    '''
+    Token bucket for the account's request budget, shared by all requests of a
+    client. It only computes delays; the caller sleeps the way its I/O does.
+    '''
+
+    def __init__(self, rate, burst=None):
+        super(FairlayRateLimiter, self).__init__()
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.__tokens = float(self.burst)
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self):
+        '''
+        Take one request from the budget
+
+        Response: float (seconds to wait before sending it)
+        '''
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+            self.__tokens -= 1
+            return max(0.0, -self.__tokens / self.rate)
+
+
+class FairlaySlotBalancer(object):
+    '''
+    Routes public API requests over the free slots /free1 ... /free9.
+
+    Every slot keeps a moving average of its latency and error rate, its number
+    of requests in flight and a count of its recent requests (decaying over
+    RECENT_WINDOW seconds, as each slot has its own rate limit); acquire()
+    picks the least loaded slot. A failing slot backs off on its own, with an
+    exponential and jittered delay, while the others keep serving requests.
+    '''
+
+    # Weight of the newest sample in the moving averages
+    ALPHA = 0.2
+    RECENT_WINDOW = 10.0
+
+    def __init__(self, slots=range(1, 10), base_delay=1.0, max_delay=60.0, latency=0.5):
+        super(FairlaySlotBalancer, self).__init__()
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.__lock = threading.Lock()
+        self.__updated = time.monotonic()
+        self.__slots = {slot: {'latency': latency, 'error_rate': 0.0, 'in_flight': 0, 'recent': 0.0,
+                               'requests': 0, 'errors': 0, 'consecutive_errors': 0, 'backoff_until': 0.0}
+                        for slot in slots}
+
+    def acquire(self):
+        '''
+        Response: (slot, seconds to wait before using it)
+        '''
+        with self.__lock:
+            now = time.monotonic()
+            decay = math.exp((self.__updated - now) / self.RECENT_WINDOW)
+            self.__updated = now
+            for st in self.__slots.values():
+                st['recent'] *= decay
+
+            ready = [s for s, st in self.__slots.items() if st['backoff_until'] <= now]
+            if ready:
+                slot = min(ready, key=lambda s: (self.__load(self.__slots[s]), random.random()))
+                wait = 0.0
+            else:
+                slot = min(self.__slots, key=lambda s: self.__slots[s]['backoff_until'])
+                wait = self.__slots[slot]['backoff_until'] - now
+            self.__slots[slot]['in_flight'] += 1
+            self.__slots[slot]['recent'] += 1
+            self.__slots[slot]['requests'] += 1
+            return slot, wait
+
+    def release(self, slot, latency=None, error=False):
+        with self.__lock:
+            st = self.__slots[slot]
+            st['in_flight'] -= 1
+            st['error_rate'] += self.ALPHA * ((1.0 if error else 0.0) - st['error_rate'])
+            if error:
+                st['errors'] += 1
+                st['consecutive_errors'] += 1
+                delay = min(self.max_delay, self.base_delay * 2 ** (st['consecutive_errors'] - 1))
+                st['backoff_until'] = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            else:
+                st['consecutive_errors'] = 0
+                if latency is not None:
+                    st['latency'] += self.ALPHA * (latency - st['latency'])
+
+    def stats(self):
+        '''
+        Response: dictionary of slot -> counters
+            E.g. {1: {'latency': 0.21, 'error_rate': 0.0, 'in_flight': 1, 'recent': 3.2, 'requests': 40,
+                      'errors': 0, 'consecutive_errors': 0, 'backoff_until': 0.0}, ...}
+        '''
+        with self.__lock:
+            return {slot: dict(st) for slot, st in self.__slots.items()}
+
+    def __load(self, st):
+        return (1 + st['in_flight'] + st['recent']) * st['latency'] * (1 + 4 * st['error_rate'])
+
+
+class FairlayResponseReader(object):
+    '''
+    Incremental reader of one gzip framed response.
+
+    Compressed bytes are received straight into a preallocated buffer
+    (readinto) or fed as chunks (feed) and are decompressed as they arrive,
+    appending to a single bytearray. The compressed response is never
+    assembled, and the decompressed one is never copied.
+    '''
+
+    def __init__(self, buffer_size=65536):
+        super(FairlayResponseReader, self).__init__()
+        self.__view = memoryview(bytearray(buffer_size))
+        self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.output = bytearray()
+        self.received = 0
+
+    @property
+    def done(self):
+        return self.__decompressor.eof
+
+    def readinto(self, conn):
+        '''
+        Receive once from a socket into the buffer and decompress it.
+
+        Response: int (number of compressed bytes, 0 when the socket is closed)
+        '''
+        nbytes = conn.recv_into(self.__view)
+        if nbytes:
+            self.feed(self.__view[:nbytes])
+        return nbytes
+
+    def feed(self, data):
+        self.received += len(data)
+        self.output += self.__decompressor.decompress(data)
+
+
+class FairlayConnectionPool(object):
+    '''
+    Keeps TCP connections to the private API server open and reuses them.
+
+    A request is written as '<message><ENDOFDATA>' and the response is a single
+    gzip stream, so the end of the gzip stream marks the end of the response and
+    the connection can carry the next request. An idle connection is checked
+    before it is reused: if the server has closed it (as it may do after every
+    response), it is dropped and a new one is opened without a round trip.
+    A request is only resent when the server closed the connection before
+    sending a single byte of the response; after a reset or a partial response
+    it may already have been processed (e.g. change_orders), so it is not.
+    '''
+
+    RECV_SIZE = 65536
+
+    def __init__(self, host, port, max_connections=8, timeout=15):
+        super(FairlayConnectionPool, self).__init__()
+        self.address = (host, port)
+        self.timeout = timeout
+        self.__idle = collections.deque()
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(max_connections)
+        self.__stats = {
+            'requests': 0,
+            'hits': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'errors': 0,
+            'in_flight': 0,
+        }
+
+    def request(self, message):
+        '''
+        Request:
+            message: bytes, already terminated with <ENDOFDATA>
+
+        Response: bytearray (decompressed)
+        '''
+        with self.__slots:
+            self.__count('requests')
+            conn, reused = self.__acquire()
+            self.__count('in_flight')
+            try:
+                try:
+                    response = self.__exchange(conn, message)
+                except _StaleConnection:
+                    conn.close()
+                    if not reused:
+                        raise
+                    self.__count('reconnects')
+                    conn = self.__connect()
+                    response = self.__exchange(conn, message)
+            except Exception:
+                conn.close()
+                self.__count('errors')
+                raise
+            else:
+                self.__release(conn)
+            finally:
+                self.__count('in_flight', -1)
+        return response
+
+    def stats(self):
+        '''
+        Response: dictionary
+            E.g. {'requests': 120, 'hits': 117, 'connects': 3, 'reconnects': 1,
+                  'errors': 0, 'in_flight': 2, 'idle': 1}
+        '''
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['idle'] = len(self.__idle)
+        return stats
+
+    def close(self):
+        with self.__lock:
+            while self.__idle:
+                self.__idle.pop().close()
+
+    def __count(self, key, value=1):
+        with self.__lock:
+            self.__stats[key] += value
+
+    def __acquire(self):
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                conn = self.__idle.pop()
+            if self.__usable(conn):
+                self.__count('hits')
+                return conn, True
+            conn.close()
+        return self.__connect(), False
+
+    def __usable(self, conn):
+        # An idle connection has nothing to read: EOF, an error or stray bytes rule it out
+        conn.setblocking(False)
+        try:
+            conn.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            conn.settimeout(self.timeout)
+        return False
+
+    def __release(self, conn):
+        with self.__lock:
+            self.__idle.append(conn)
+
+    def __connect(self):
+        conn = socket.create_connection(self.address, timeout=self.timeout)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__count('connects')
+        return conn
+
+    def __exchange(self, conn, message):
+        conn.sendall(message)
+
+        reader = FairlayResponseReader(self.RECV_SIZE)
+        while not reader.done:
+            if not reader.readinto(conn):
+                if not reader.received:
+                    raise _StaleConnection('Connection closed by server')
+                raise ConnectionError('Connection closed in the middle of a response')
+        return reader.output
+
+
+class AsyncFairlayConnectionPool(object):
+    '''
+    asyncio version of FairlayConnectionPool, with the same framing, reconnects
+    and counters. Up to max_connections requests are in flight at once.
+    '''
+
+    RECV_SIZE = 65536
+
+    def __init__(self, host, port, max_connections=100, timeout=15):
+        super(AsyncFairlayConnectionPool, self).__init__()
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.__idle = collections.deque()
+        self.__slots = None
+        self.__stats = {
+            'requests': 0,
+            'hits': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'errors': 0,
+            'in_flight': 0,
+        }
+
+    async def request(self, message):
+        '''
+        Request:
+            message: bytes, already terminated with <ENDOFDATA>
+
+        Response: bytearray (decompressed)
+        '''
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.max_connections)
+
+        async with self.__slots:
+            self.__stats['requests'] += 1
+            conn, reused = await self.__acquire()
+            self.__stats['in_flight'] += 1
+            try:
+                try:
+                    response = await asyncio.wait_for(self.__exchange(conn, message), self.timeout)
+                except _StaleConnection:
+                    conn[1].close()
+                    if not reused:
+                        raise
+                    self.__stats['reconnects'] += 1
+                    conn = await self.__connect()
+                    response = await asyncio.wait_for(self.__exchange(conn, message), self.timeout)
+            except BaseException:
+                conn[1].close()
+                self.__stats['errors'] += 1
+                raise
+            else:
+                self.__idle.append(conn)
+            finally:
+                self.__stats['in_flight'] -= 1
+        return response
+
+    def stats(self):
+        '''
+        Response: dictionary, see FairlayConnectionPool.stats()
+        '''
+        stats = dict(self.__stats)
+        stats['idle'] = len(self.__idle)
+        return stats
+
+    async def close(self):
+        while self.__idle:
+            writer = self.__idle.pop()[1]
+            writer.close()
+            await writer.wait_closed()
+
+    async def __acquire(self):
+        while self.__idle:
+            stream, writer = conn = self.__idle.pop()
+            # The server may close the connection after every response
+            if stream.at_eof() or stream.exception() or writer.is_closing():
+                writer.close()
+                continue
+            self.__stats['hits'] += 1
+            return conn, True
+        return await self.__connect(), False
+
+    async def __connect(self):
+        conn = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.__stats['connects'] += 1
+        return conn
+
+    async def __exchange(self, conn, message):
+        stream, writer = conn
+        writer.write(message)
+        await writer.drain()
+
+        reader = FairlayResponseReader(0)
+        while not reader.done:
+            data = await stream.read(self.RECV_SIZE)
+            if not data:
+                if not reader.received:
+                    raise _StaleConnection('Connection closed by server')
+                raise ConnectionError('Connection closed in the middle of a response')
+            reader.feed(data)
+        return reader.output
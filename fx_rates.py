@@ -0,0 +1,134 @@
+import collections
+import threading
+import time
+
+import requests
+
+
+class FxRateUnavailable(Exception):
+    pass
+
+
+# rates: dictionary of currency -> USD value of one unit, e.g. {'btc': 44863.16, 'eth': 3155.57}
+# stale: True once the rates are older than the TTL because the sources are down
+FxRates = collections.namedtuple('FxRates', 'rates timestamp stale')
+
+
+def blockchain_usd_rates():
+    '''
+    USD value of one BTC from https://www.blockchain.com/api/exchange_rates_api
+
+    Response: dictionary, e.g. {'btc': 44863.16}
+    '''
+    # Ask for the BTC value of $1M, the response has few decimals
+    response = requests.get('https://blockchain.info/tobtc?currency=USD&value=1000000', timeout=15)
+    if response.status_code != 200:
+        raise FxRateUnavailable(f'blockchain.info answered {response.status_code}')
+    return {'btc': 1000000 / response.json()}
+
+
+class FxRateService(object):
+    '''
+    Currency rates in USD shared by the Fairlay and Stake scripts.
+
+    The rates are fetched from the first source that answers, a source being a
+    function returning a dictionary like blockchain_usd_rates(), e.g.
+    StakePythonClient.get_usd_currency_conversion_rate. A background thread
+    refreshes them before they are `ttl` seconds old, retrying every
+    `retry_interval` seconds while the sources are down. In the meantime the
+    last rates are still served, flagged as stale. Without sources there is no
+    background thread, the rates only come from update().
+    '''
+
+    def __init__(self, sources, ttl=300, refresh_ahead=0.2, retry_interval=30):
+        super(FxRateService, self).__init__()
+        self.sources = list(sources)
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.retry_interval = retry_interval
+        self.__rates = None
+        self.__timestamp = None
+        self.__condition = threading.Condition()
+        self.__attempted = False
+        self.event = threading.Event()
+        if self.sources:
+            threading.Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        while not self.event.is_set():
+            with self.__condition:
+                age = time.time() - self.__timestamp if self.__timestamp else None
+            refresh_age = self.ttl * (1 - self.refresh_ahead)
+            if age is not None and age < refresh_age:
+                # Rates given to update() in the meantime
+                self.event.wait(refresh_age - age)
+            elif self.refresh():
+                self.event.wait(refresh_age)
+            else:
+                self.event.wait(self.retry_interval)
+
+    def refresh(self):
+        '''
+        Response: bool (False if no source answered)
+        '''
+        rates = None
+        for source in self.sources:
+            try:
+                rates = source()
+                break
+            except Exception as e:
+                print(f'Cannot get exchange rates from {getattr(source, "__name__", source)}: {e!r}')
+
+        if rates:
+            self.update(rates)
+        else:
+            with self.__condition:
+                self.__attempted = True
+                self.__condition.notify_all()
+        return bool(rates)
+
+    def update(self, rates):
+        '''
+        Replace the rates by ones fetched elsewhere, e.g. batched with other requests
+        '''
+        with self.__condition:
+            self.__rates = dict(rates)
+            self.__timestamp = time.time()
+            self.__attempted = True
+            self.__condition.notify_all()
+
+    def rates(self, timeout=30):
+        '''
+        Wait up to `timeout` seconds for the first refresh, if there are sources
+
+        Response: FxRates
+        '''
+        with self.__condition:
+            if self.sources:
+                self.__condition.wait_for(lambda: self.__attempted, timeout)
+            if self.__rates is None:
+                raise FxRateUnavailable('No exchange rate could be fetched yet')
+            return FxRates(self.__rates, self.__timestamp, time.time() - self.__timestamp > self.ttl)
+
+    def to_usd(self, amounts, currencies):
+        '''
+        Convert a batch of amounts, amounts[i] being in currencies[i] (or all in one currency if it is a string)
+
+        Response: (list of USD amounts, None for unknown currencies; stale flag)
+        '''
+        rates, _, stale = self.rates()
+        if isinstance(currencies, str):
+            currencies = [currencies] * len(amounts)
+        return [amount * rates[c] if c in rates else None for amount, c in zip(amounts, currencies)], stale
+
+    def from_usd(self, usd_amounts, currency):
+        '''
+        Response: (list of amounts in the currency; stale flag)
+        '''
+        rates, _, stale = self.rates()
+        if currency not in rates:
+            raise FxRateUnavailable(f'No exchange rate for {currency}')
+        return [usd / rates[currency] for usd in usd_amounts], stale
+
+    def stop(self):
+        self.event.set()
@@ -1,6 +1,10 @@
 import json
+import time
+
 import requests
 
+from request_metrics import METRICS
+
 parameters = {
     "order": 'order',
     "per-page": 130,
@@ -8,7 +12,13 @@ parameters = {
     "markets-limit":100,
 }
 
+start = time.perf_counter()
 response = requests.get(url="https://api.matchbook.com/edge/rest/events", params=parameters)
+if METRICS.enabled:
+    METRICS.observe('matchbook', 'events', time.perf_counter() - start, received=len(response.content),
+                    error=response.status_code != 200)
+    if response.status_code == 429:
+        METRICS.rate_limited('matchbook', 'events')
 
 data_dict = response.json()
 
@@ -0,0 +1,158 @@
+import collections
+import time
+
+from request_metrics import METRICS
+
+
+class AdaptivePollScheduler(object):
+    '''
+    Poll interval of a feed that returns its latest `limit` items, e.g. Stake's allSportBets.
+
+    Consecutive windows of item ids should overlap. A full window sharing no id
+    with the previous one means items arrived in between that no poll saw: the
+    scheduler counts it as a gap and shortens the interval right away.
+
+    The items missed in a gap are estimated from the ids skipped between the
+    windows when the ids are sequence numbers, e.g. the 15696289 of Stake's
+    'sport:15696289' extracted by `sequence`, scaled by the share of the ids
+    the feed returns (a high roller feed returns a few of them). Without
+    sequence numbers, or next to an empty window, they are estimated from the
+    arrival rate instead.
+
+    Between gaps, the interval is set so that a poll sees about `target_fill` *
+    limit new items at the measured rate, and backed off while the feed is
+    idle. At most `budget` polls are scheduled per `budget_period` seconds.
+    Gaps and missed items are recorded in METRICS under (service, endpoint).
+    '''
+
+    def __init__(self, limit, interval=60, min_interval=1, max_interval=300, budget=None, budget_period=60,
+                 target_fill=0.5, backoff=1.5, smoothing=0.3, sequence=None, service='stake', endpoint='bets'):
+        '''
+        interval: initial interval in seconds, until the arrival rate is known
+        budget: maximum number of polls per budget_period seconds, None for no limit
+        smoothing: weight of the last poll in the arrival rate, between 0 and 1
+        sequence: function of an id returning its sequence number, None if the ids are not ordered
+        '''
+        super(AdaptivePollScheduler, self).__init__()
+        self.limit = limit
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.budget = budget
+        self.budget_period = budget_period
+        self.target_fill = target_fill
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.sequence = sequence
+        self.service = service
+        self.endpoint = endpoint
+
+        self.rate = None     # estimated items per second
+        self.overlap = None  # ids of the last window also in the previous one
+        self.polls = 0
+        self.gaps = 0
+        self.missed = 0.0    # estimated items missed in all the gaps
+        self.__window = None
+        self.__last_poll = None
+        self.__poll_times = collections.deque(maxlen=budget or 1)
+
+    def observe(self, ids, now=None):
+        '''
+        Record the ids returned by a poll
+
+        Response: number of new ids
+        '''
+        now = time.monotonic() if now is None else now
+        window = set(ids)
+        self.polls += 1
+        self.__poll_times.append(now)
+        previous, last_poll = self.__window, self.__last_poll
+        self.__window, self.__last_poll = window, now
+        if previous is None:
+            return len(window)
+
+        self.overlap = len(window & previous)
+        new = len(window) - self.overlap
+        elapsed = max(now - last_poll, 1e-3)
+        gap = self.overlap == 0 and len(window) >= self.limit
+
+        if gap:
+            missed = self.__estimate_missed(previous, window, elapsed, new)
+            self.gaps += 1
+            self.missed += missed
+            if METRICS.enabled:
+                METRICS.gap(self.service, self.endpoint, missed)
+            # Without an estimate, only a lower bound of the rate
+            self.rate = max(self.rate or 0.0, (new + missed) / elapsed)
+        elif self.rate is None:
+            self.rate = new / elapsed
+        else:
+            self.rate += self.smoothing * (new / elapsed - self.rate)
+
+        if gap:
+            interval = min(self.interval / 2, self.target_fill * self.limit / self.rate)
+        elif new == 0:
+            interval = self.interval * self.backoff
+        else:
+            interval = self.target_fill * self.limit / self.rate
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        return new
+
+    def __estimate_missed(self, previous, window, elapsed, new):
+        # An empty window has no sequence numbers to compare
+        if self.sequence is not None and previous and window:
+            try:
+                previous, window = sorted(map(self.sequence, previous)), sorted(map(self.sequence, window))
+            except (TypeError, ValueError):
+                pass
+            else:
+                # Share of the sequence numbers in the windows that belong to the feed
+                spans = (previous[-1] - previous[0]) + (window[-1] - window[0])
+                density = min(1.0, (len(previous) + len(window) - 2) / spans) if spans > 0 else 1.0
+                return max(0, window[0] - previous[-1] - 1) * density
+        return max(0.0, self.rate * elapsed - new) if self.rate else 0.0
+
+    def next_delay(self, now=None):
+        '''
+        Response: seconds to wait before the next poll
+        '''
+        if self.__last_poll is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        delay = self.interval - (now - self.__last_poll)
+        if self.budget and len(self.__poll_times) == self.budget:
+            delay = max(delay, self.__poll_times[0] + self.budget_period - now)
+        return max(delay, 0.0)
+
+
+class DedupIndex(object):
+    '''
+    Keys seen in the last max_age seconds, at most capacity of them, oldest first.
+
+    A key seen again moves to the end, so the bets still listed by a slow feed
+    stay in the index however old they are.
+    '''
+
+    def __init__(self, capacity=100000, max_age=3600):
+        super(DedupIndex, self).__init__()
+        self.capacity = capacity
+        self.max_age = max_age
+        self.__seen = collections.OrderedDict()
+
+    def add(self, key, now=None):
+        '''
+        Response: bool (True if the key is new)
+        '''
+        now = time.monotonic() if now is None else now
+        new = key not in self.__seen
+        self.__seen[key] = now
+        self.__seen.move_to_end(key)
+        while len(self.__seen) > self.capacity or next(iter(self.__seen.values())) < now - self.max_age:
+            self.__seen.popitem(last=False)
+        return new
+
+    def __contains__(self, key):
+        return key in self.__seen
+
+    def __len__(self):
+        return len(self.__seen)
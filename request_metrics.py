@@ -0,0 +1,200 @@
+import atexit
+import bisect
+import os
+import threading
+
+
+class RequestMetrics(object):
+    '''
+    Per endpoint request counters of the Fairlay, Stake and Matchbook clients.
+
+    For each (service, endpoint) it keeps the number of requests, a latency
+    histogram, the bytes sent and received, the errors, retries and rate
+    limit hits, and for polled feeds the gaps between polls. The clients check
+    `enabled` before recording anything, so a disabled instance costs one
+    attribute lookup per request. Read them with stats(), or write them
+    periodically in the Prometheus text format with start_exporter(). Setting
+    $REQUEST_METRICS_FILE enables the shared METRICS instance and exports it to
+    that file.
+    '''
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    COUNTERS = ('requests', 'errors', 'retries', 'rate_limited', 'rate_limit_wait',
+                'latency_sum', 'bytes_sent', 'bytes_received', 'gaps', 'missed_estimate')
+
+    def __init__(self, enabled=False):
+        super(RequestMetrics, self).__init__()
+        self.enabled = enabled
+        self.__lock = threading.Lock()
+        self.__endpoints = {}
+        self.__exporter = None
+        self.__exporter_path = None
+        # The exporter thread and the last write of stop_exporter() share the temporary file
+        self.__write_lock = threading.Lock()
+        self.__atexit = False
+
+    def __entry(self, service, endpoint):
+        entry = self.__endpoints.get((service, endpoint))
+        if entry is None:
+            entry = self.__endpoints[(service, endpoint)] = {
+                'counters': dict.fromkeys(self.COUNTERS, 0),
+                'buckets': [0] * (len(self.LATENCY_BUCKETS) + 1),
+            }
+        return entry
+
+    def observe(self, service, endpoint, latency, sent=0, received=0, error=False):
+        '''
+        Record one request (one attempt when it is retried)
+        '''
+        with self.__lock:
+            entry = self.__entry(service, endpoint)
+            counters = entry['counters']
+            counters['requests'] += 1
+            counters['latency_sum'] += latency
+            counters['bytes_sent'] += sent
+            counters['bytes_received'] += received
+            if error:
+                counters['errors'] += 1
+            entry['buckets'][bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+
+    def retry(self, service, endpoint):
+        with self.__lock:
+            self.__entry(service, endpoint)['counters']['retries'] += 1
+
+    def rate_limited(self, service, endpoint, wait=0.0):
+        '''
+        Record a request delayed by a rate limit, or refused by the server if wait is 0
+        '''
+        with self.__lock:
+            counters = self.__entry(service, endpoint)['counters']
+            counters['rate_limited'] += 1
+            counters['rate_limit_wait'] += wait
+
+    def gap(self, service, endpoint, missed=0.0):
+        '''
+        Record a poll of a feed that shared no item with the previous one, and the items estimated missed
+        '''
+        with self.__lock:
+            counters = self.__entry(service, endpoint)['counters']
+            counters['gaps'] += 1
+            counters['missed_estimate'] += missed
+
+    def reset(self):
+        with self.__lock:
+            self.__endpoints = {}
+
+    def stats(self):
+        '''
+        Response: dictionary of service -> endpoint -> counters
+            E.g. {'fairlay': {'get_orders': {'requests': 12, 'errors': 0, 'retries': 1, 'rate_limited': 0,
+                  'rate_limit_wait': 0.0, 'latency_sum': 1.84, 'latency_mean': 0.153, 'bytes_sent': 5412,
+                  'bytes_received': 80211, 'gaps': 0, 'missed_estimate': 0.0,
+                  'latency_buckets': {0.005: 0, ..., 30.0: 12, inf: 12}}}}
+            latency_buckets are cumulative, like Prometheus histograms.
+        '''
+        with self.__lock:
+            endpoints = {key: (dict(e['counters']), list(e['buckets'])) for key, e in self.__endpoints.items()}
+
+        stats = {}
+        for (service, endpoint), (counters, buckets) in endpoints.items():
+            counters['latency_mean'] = counters['latency_sum'] / counters['requests'] if counters['requests'] else 0.0
+            cumulative, total = {}, 0
+            for bound, count in zip(self.LATENCY_BUCKETS + (float('inf'),), buckets):
+                total += count
+                cumulative[bound] = total
+            counters['latency_buckets'] = cumulative
+            stats.setdefault(service, {})[endpoint] = counters
+        return stats
+
+    def prometheus_text(self):
+        metrics = (
+            ('api_requests_total', 'counter', 'Requests sent, retries included', 'requests'),
+            ('api_errors_total', 'counter', 'Requests that failed or were refused', 'errors'),
+            ('api_retries_total', 'counter', 'Requests sent again after a failure', 'retries'),
+            ('api_rate_limited_total', 'counter', 'Requests delayed or refused by a rate limit', 'rate_limited'),
+            ('api_rate_limit_wait_seconds_total', 'counter', 'Time spent waiting for a rate limit',
+             'rate_limit_wait'),
+            ('api_request_bytes_total', 'counter', 'Request payload bytes', 'bytes_sent'),
+            ('api_response_bytes_total', 'counter', 'Response payload bytes', 'bytes_received'),
+            ('api_feed_gaps_total', 'counter', 'Feed polls sharing no item with the previous poll', 'gaps'),
+            ('api_feed_missed_items_total', 'counter', 'Feed items estimated missed between polls',
+             'missed_estimate'),
+        )
+        stats = self.stats()
+        rows = [(service, endpoint, counters) for service, endpoints in sorted(stats.items())
+                for endpoint, counters in sorted(endpoints.items())]
+
+        lines = []
+        for name, kind, help, key in metrics:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for service, endpoint, counters in rows:
+                lines.append(f'{name}{{{self.__labels(service, endpoint)}}} {counters[key]}')
+
+        name = 'api_request_duration_seconds'
+        lines.append(f'# HELP {name} Request latency')
+        lines.append(f'# TYPE {name} histogram')
+        for service, endpoint, counters in rows:
+            labels = self.__labels(service, endpoint)
+            for bound, count in counters['latency_buckets'].items():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(f'{name}_sum{{{labels}}} {counters["latency_sum"]}')
+            lines.append(f'{name}_count{{{labels}}} {counters["requests"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
+
+    def start_exporter(self, path, interval=15):
+        '''
+        Enable the metrics and write them to path every interval seconds from a background thread,
+        and once more when stopped or when the program exits, so that short scripts write them too
+        '''
+        self.enabled = True
+        self.stop_exporter(write=False)
+        event = threading.Event()
+        self.__exporter = event
+        self.__exporter_path = path
+        if not self.__atexit:
+            atexit.register(self.stop_exporter)
+            self.__atexit = True
+
+        def run():
+            while not event.wait(interval):
+                self.__write(path)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop_exporter(self, write=True):
+        '''
+        Stop the exporter, writing the metrics a last time unless write is False
+        '''
+        if self.__exporter is not None:
+            self.__exporter.set()
+            self.__exporter = None
+            if write:
+                self.__write(self.__exporter_path)
+
+    def __write(self, path):
+        try:
+            with self.__write_lock:
+                self.write_prometheus(path)
+        except OSError as e:
+            print(f'Cannot write the request metrics to {path}: {e!r}')
+
+    @staticmethod
+    def __labels(service, endpoint):
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return f'service="{escape(service)}",endpoint="{escape(endpoint)}"'
+
+
+METRICS = RequestMetrics()
+if os.environ.get('REQUEST_METRICS_FILE'):
+    METRICS.start_exporter(os.environ['REQUEST_METRICS_FILE'])
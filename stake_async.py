@@ -0,0 +1,222 @@
+import asyncio
+import itertools
+import json
+from os import environ
+import queue
+import threading
+import time
+
+import aiohttp
+
+from request_metrics import METRICS
+from stake_client import StakePythonClient, _batch_request, _split_result
+
+
+class AsyncStakeClient(object):
+    '''
+    asyncio twin of StakePythonClient. Its query methods run with run(), e.g.
+
+        async with AsyncStakeClient() as client:
+            rates, bets = await asyncio.gather(client.run('get_usd_currency_conversion_rate'),
+                                               client.run('get_all_sport_bets', 50))
+
+    and the request bodies of stake_queries.StakeQueryRegistry with send_prepared().
+    Requests share one keep-alive session of up to max_connections connections.
+    GraphQL subscriptions, e.g. to new bets, run over a websocket with subscribe().
+    '''
+
+    TIMEOUT = 15
+    # Seconds between websocket pings, to find out a dead connection
+    HEARTBEAT = 20
+
+    def __init__(self, accessToken=None, endpoint=None, max_connections=10, websocket_endpoint=None):
+        super(AsyncStakeClient, self).__init__()
+        self.ENDPOINT = endpoint or StakePythonClient.ENDPOINT
+        self.WEBSOCKET_ENDPOINT = websocket_endpoint or StakePythonClient.WEBSOCKET_ENDPOINT
+        self.headers = dict(StakePythonClient.HEADERS)
+        # Like StakePythonClient, $STAKE_API_TOKEN by default
+        self.headers['x-access-token'] = environ.get('STAKE_API_TOKEN', '') if accessToken is None else accessToken
+        self.max_connections = max_connections
+        self.__session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def run(self, name, *args):
+        '''
+        Run a query method of StakePythonClient, e.g. run('get_all_sport_bets', 50)
+        '''
+        operation = getattr(StakePythonClient, name).operation(self, *args)
+        data = next(operation)
+        try:
+            operation.send(await self.send_graphql_request(data))
+        except StopIteration as e:
+            return e.value
+        raise RuntimeError(f'{name} yielded more than one request')
+
+    async def send_graphql_request(self, data):
+        return await self.__post(data.get('operationName') or 'anonymous', json.dumps(data).encode('utf-8'))
+
+    async def send_prepared(self, prepared):
+        '''
+        Response: list of the responses of the operations of the prepared request
+        '''
+        result = await self.__post(prepared.operationName, prepared.body)
+        if len(prepared.names) == 1:
+            return [result]
+        return _split_result(result, len(prepared.names))
+
+    async def send_graphql_batch(self, requests_data):
+        requests_data = list(requests_data)
+        if len(requests_data) == 1:
+            return [await self.send_graphql_request(requests_data[0])]
+        return _split_result(await self.send_graphql_request(_batch_request(requests_data)), len(requests_data))
+
+    def __open_session(self):
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                headers=self.headers, timeout=aiohttp.ClientTimeout(total=self.TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=self.max_connections))
+        return self.__session
+
+    async def subscribe(self, data, resume=None, retry_delay=1, max_retry_delay=60):
+        '''
+        Async generator of the results of a GraphQL subscription, with the graphql-transport-ws protocol.
+
+        The websocket is reconnected when it drops, after retry_delay seconds
+        doubled up to max_retry_delay while it keeps failing. resume is a
+        coroutine function called after each reconnection, once subscribed
+        again, returning results to yield before the new ones, e.g. the bets
+        published while disconnected fetched with a query. They may repeat
+        results already yielded.
+        '''
+        session = self.__open_session()
+        delay, reconnection = retry_delay, False
+        for attempt in itertools.count():
+            start = time.perf_counter()
+            try:
+                async with session.ws_connect(self.WEBSOCKET_ENDPOINT, protocols=('graphql-transport-ws',),
+                                              heartbeat=self.HEARTBEAT) as ws:
+                    await ws.send_json({'type': 'connection_init',
+                                        'payload': {'accessToken': self.headers['x-access-token']}})
+                    ack = await ws.receive_json(timeout=self.TIMEOUT)
+                    if ack.get('type') != 'connection_ack':
+                        raise ConnectionError(f'The subscription was not acknowledged: {ack}')
+                    await ws.send_json({'id': '1', 'type': 'subscribe', 'payload': data})
+                    if METRICS.enabled:
+                        METRICS.observe('stake', data.get('operationName') or 'subscription',
+                                        time.perf_counter() - start)
+                        if attempt:
+                            METRICS.retry('stake', data.get('operationName') or 'subscription')
+
+                    if reconnection and resume is not None:
+                        for result in await resume():
+                            yield result
+                    delay = retry_delay
+
+                    async for message in ws:
+                        if message.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        message = json.loads(message.data)
+                        if message['type'] == 'next':
+                            yield message['payload']
+                        elif message['type'] == 'ping':
+                            await ws.send_json({'type': 'pong'})
+                        elif message['type'] == 'error':
+                            # Subscribed again on the next connection, like after a drop
+                            raise ConnectionError(f'The subscription failed: {message.get("payload")}')
+                        elif message['type'] == 'complete':
+                            return
+                print(f'Stake websocket closed, reconnecting in {delay} seconds.')
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                if METRICS.enabled:
+                    METRICS.observe('stake', data.get('operationName') or 'subscription',
+                                    time.perf_counter() - start, error=True)
+                print(f'Stake websocket lost: {e!r}, reconnecting in {delay} seconds.')
+            reconnection = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_retry_delay)
+
+    async def __post(self, operation, body):
+        session = self.__open_session()
+        start = time.perf_counter()
+        try:
+            async with session.post(self.ENDPOINT, data=body) as response:
+                content = await response.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if METRICS.enabled:
+                METRICS.observe('stake', operation, time.perf_counter() - start, len(body), error=True)
+            print('Cannot send a GraphQL request to Stake.')
+            raise
+        if METRICS.enabled:
+            METRICS.observe('stake', operation, time.perf_counter() - start, len(body), len(content),
+                            error=response.status != 200)
+            if response.status == 429:
+                METRICS.rate_limited('stake', operation)
+        if response.status != 200:
+            raise Exception(f'Query failed to run with a {response.status}.')
+        return json.loads(content)
+
+
+class StakeSubscription(object):
+    '''
+    AsyncStakeClient.subscribe() run in a background thread for blocking code, see StakePythonClient.subscribe().
+    Iterate it for the results, close() it from any thread to stop. The thread's event loop is closed once the
+    subscription has ended.
+    '''
+
+    # End of the results, after close() or an error
+    __END = object()
+
+    def __init__(self, data, resume=None, accessToken=None, endpoint=None, websocket_endpoint=None):
+        super(StakeSubscription, self).__init__()
+        self.__results = queue.Queue()
+        self.__loop = asyncio.new_event_loop()
+        self.__task = self.__loop.create_task(self.__run(data, resume, accessToken, endpoint, websocket_endpoint))
+        threading.Thread(target=self.__run_loop, daemon=True).start()
+
+    def __run_loop(self):
+        try:
+            self.__loop.run_until_complete(self.__task)
+        finally:
+            self.__loop.run_until_complete(self.__loop.shutdown_asyncgens())
+            self.__loop.run_until_complete(self.__loop.shutdown_default_executor())
+            self.__loop.close()
+
+    async def __run(self, data, resume, accessToken, endpoint, websocket_endpoint):
+        loop = asyncio.get_running_loop()
+        # resume is a blocking function here, e.g. a poll with StakePythonClient
+        async_resume = None if resume is None else lambda: loop.run_in_executor(None, resume)
+        try:
+            async with AsyncStakeClient(accessToken, endpoint, websocket_endpoint=websocket_endpoint) as client:
+                async for result in client.subscribe(data, async_resume):
+                    self.__results.put(result)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.__results.put(e)
+        finally:
+            self.__results.put(self.__END)
+
+    def __iter__(self):
+        while True:
+            result = self.__results.get()
+            if result is self.__END:
+                return
+            if isinstance(result, Exception):
+                raise result
+            yield result
+
+    def close(self):
+        try:
+            self.__loop.call_soon_threadsafe(self.__task.cancel)
+        except RuntimeError:
+            pass  # Already ended, its loop is closed
@@ -0,0 +1,171 @@
+#! /usr/bin/env python3
+'''
+Benchmarks of the Stake client against a local stand-in GraphQL server
+(stake_standin.py). Run one of them with
+
+    $ python stake_bench.py session --polls 50 --connect-delay 0.05
+    $ python stake_bench.py batch --ticks 20 --latency 0.03
+    $ python stake_bench.py queries --repeat 200
+'''
+
+import argparse
+import json
+import statistics
+import time
+import timeit
+
+import requests
+
+from stake_client import StakePythonClient
+from stake_queries import StakeQueryRegistry
+from stake_run import BET_FIELDS, QUERIES
+from stake_standin import StakeStandIn, StandInGraphQLServer
+
+
+def _report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) >= 20 else latencies[-1]
+    print(f'{name:<32} mean {statistics.mean(latencies) * 1000:>8.2f} ms'
+          f'  median {statistics.median(latencies) * 1000:>8.2f} ms  p95 {p95 * 1000:>8.2f} ms')
+
+
+class _ConnectionPerRequestClient(StakePythonClient):
+    '''The client before it had a session: requests.post opens a new connection for every request'''
+
+    def send_graphql_request(self, data):
+        r = requests.post(self.ENDPOINT, json=data, headers=self.HEADERS)
+        if r.status_code != 200:
+            raise Exception(f"Query failed to run with a {r.status_code}.")
+        return r.json()
+
+
+def _poll(client, polls):
+    latencies = []
+    for _ in range(polls):
+        start = time.perf_counter()
+        client.get_all_sport_bets(50)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_session(args):
+    with StandInGraphQLServer(StakeStandIn(rate=args.rate), connect_delay=args.connect_delay,
+                              latency=args.latency) as server:
+        print(f'{args.polls} polls of allSportBets(limit: 50), {args.connect_delay * 1000:.0f} ms per new connection')
+
+        connections = server.connections
+        _report('requests.post per poll', _poll(_ConnectionPerRequestClient(endpoint=server.url), args.polls))
+        print(f'{"":<32} {server.connections - connections} connection(s)')
+
+        connections = server.connections
+        client = StakePythonClient(endpoint=server.url)
+        _report('pooled session', _poll(client, args.polls))
+        print(f'{"":<32} {server.connections - connections} connection(s)')
+        client.close()
+
+
+DASHBOARD = (('get_usd_currency_conversion_rate',), ('get_highroller_sport_bets', 50), ('get_all_sport_bets', 50),
+             ('get_live_sport_list',), ('get_upcoming_fixture_count',))
+
+
+def bench_batch(args):
+    with StandInGraphQLServer(StakeStandIn(rate=args.rate), latency=args.latency) as server:
+        client = StakePythonClient(endpoint=server.url)
+        print(f'{args.ticks} dashboard refreshes of {len(DASHBOARD)} operations, '
+              f'{args.latency * 1000:.0f} ms per request')
+
+        latencies = []
+        for _ in range(args.ticks):
+            start = time.perf_counter()
+            for name, *arguments in DASHBOARD:
+                getattr(client, name)(*arguments)
+            latencies.append(time.perf_counter() - start)
+        _report('one request per operation', latencies)
+
+        for mode in ('alias', 'array'):
+            latencies = []
+            for _ in range(args.ticks):
+                start = time.perf_counter()
+                client.batch(*DASHBOARD, mode=mode)
+                latencies.append(time.perf_counter() - start)
+            _report(f'batch, {mode}', latencies)
+        client.close()
+
+
+# Official queries of the client against the trimmed ones of the registry
+TRIMMED = (
+    (('get_all_sport_bets', 50), ('FetcherAllSportBets', {'limit': 50})),
+    (('get_highroller_sport_bets', 50), ('FetcherHighrollerSportBets', {'limit': 50})),
+    (('get_usd_currency_conversion_rate',), ('FetcherUsdRates', {})),
+    (('get_bet_lookup', 'sport:10000001'), ('BetSummary', {'iid': 'sport:10000001'})),
+)
+
+
+def _measure(client, send, repeat):
+    '''Response: (request bytes, response bytes, compressed response bytes, median parse time)'''
+    r = send()
+    if r.status_code != 200:
+        raise Exception(f"Query failed to run with a {r.status_code}.")
+    parse = statistics.median(timeit.repeat(lambda: json.loads(r.content), number=1, repeat=repeat))
+    return len(r.request.body), len(r.content), int(r.headers.get('content-length', len(r.content))), parse
+
+
+def bench_queries(args):
+    queries = StakeQueryRegistry()
+    queries.register('BetSummary', 'bet(iid: $iid)', BET_FIELDS, {'iid': 'String'})
+    with StandInGraphQLServer(StakeStandIn(rate=args.rate)) as server:
+        # Let enough bets arrive to fill the feeds
+        time.sleep(min(60, 50 / args.rate))
+        client = StakePythonClient(endpoint=server.url)
+        print(f'{"operation":<28}{"request B":>20}{"response B":>22}{"gzip B":>18}{"parse ms":>20}'
+              f'{"serialize us":>16}')
+        for (method, *arguments), (name, variables) in TRIMMED:
+            registry = queries if name in queries else QUERIES
+            data = next(getattr(StakePythonClient, method).operation(client, *arguments))
+            prepared = registry.prepare((name, variables))
+
+            full = _measure(client, lambda: client.session.post(client.ENDPOINT, json=data), args.repeat)
+            trimmed = _measure(client, lambda: client.session.post(client.ENDPOINT, data=prepared.body),
+                               args.repeat)
+            # Serializing the body on every poll, which prepared requests do once
+            serialize = statistics.median(timeit.repeat(lambda: json.dumps(data).encode(), number=1,
+                                                        repeat=args.repeat))
+
+            columns = ''.join(f'{f"{a}->{b}":>14} {(1 - b / a) * 100:>4.0f}%' for a, b in zip(full[:3], trimmed[:3]))
+            print(f'{data["operationName"]:<28}{columns}'
+                  f'{f"{full[3] * 1000:.3f}->{trimmed[3] * 1000:.3f}":>14} {(1 - trimmed[3] / full[3]) * 100:>4.0f}%'
+                  f'{serialize * 1e6:>15.1f}')
+        client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stake client benchmarks against a local stand-in server')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    session = subparsers.add_parser('session', help='Poll latency with and without a keep-alive session')
+    session.add_argument('-n', '--polls', type=int, default=50, help='Number of polls (default:50)')
+    session.add_argument('-c', '--connect-delay', type=float, default=0.05,
+                         help='Seconds added to every new connection, standing for the TLS handshake (default:0.05)')
+    session.add_argument('-l', '--latency', type=float, default=0.0,
+                         help='Seconds added to every request (default:0)')
+    session.add_argument('-r', '--rate', type=float, default=5.0,
+                         help='New bets per second on the stand-in server (default:5)')
+    session.set_defaults(func=bench_session)
+
+    batch = subparsers.add_parser('batch', help='Dashboard refresh latency with and without batching')
+    batch.add_argument('-n', '--ticks', type=int, default=20, help='Number of refreshes (default:20)')
+    batch.add_argument('-l', '--latency', type=float, default=0.03,
+                       help='Seconds added to every request, standing for the round trip (default:0.03)')
+    batch.add_argument('-r', '--rate', type=float, default=5.0,
+                       help='New bets per second on the stand-in server (default:5)')
+    batch.set_defaults(func=bench_batch)
+
+    queries = subparsers.add_parser('queries', help='Payload size and parse time of the trimmed queries')
+    queries.add_argument('-n', '--repeat', type=int, default=200,
+                         help='Timing repetitions of the parsing and serialization (default:200)')
+    queries.add_argument('-r', '--rate', type=float, default=50.0,
+                         help='New bets per second on the stand-in server (default:50)')
+    queries.set_defaults(func=bench_queries)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,10 +1,141 @@
 #! /usr/bin/env python3
 
 from os import environ
+import functools
+import re
+import time
+
 import requests
 
+from request_metrics import METRICS
+
+
+def graphql_operation(func):
+    """
+    Write a query method as a generator: it yields its request data and receives the response, so that
+    StakePythonClient.batch() can send several of them in one request. Called directly, it is sent alone.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        operation = func(self, *args, **kwargs)
+        data = next(operation)
+        try:
+            operation.send(self.send_graphql_request(data))
+        except StopIteration as e:
+            return e.value
+        raise RuntimeError(f"{func.__name__} yielded more than one request")
+    wrapper.operation = func
+    return wrapper
+
+
+_TOKEN = re.compile(r"\.\.\.|[A-Za-z_]\w*|[^\sA-Za-z_]")
+_NAME = re.compile(r"[A-Za-z_]")
+
+
+def _merge_operations(operations):
+    """
+    Merge GraphQL requests into one query, prefixing the root fields (as aliases),
+    variables and fragments of the i-th request with b{i}_
+
+    Response: request data
+    """
+    variable_definitions, selections, fragments, variables = [], [], [], {}
+    for i, data in enumerate(operations):
+        prefix = f"b{i}_"
+        query = data["query"]
+
+        out, length, last, previous = [], 0, 0, None
+        depth = parens = 0
+        in_fragment = False
+        operation_start = body_start = body_end = None
+        for match in _TOKEN.finditer(query):
+            token = match.group()
+            in_body = body_start is not None and body_end is None
+            if previous in ("$", "fragment") or (previous == "..." and token != "on"):
+                text = prefix + token
+            elif in_body and depth == 1 and parens == 0 and _NAME.match(token) and previous != ":":
+                # A root field: prefix its alias, or alias it
+                is_alias = query[match.end():].lstrip().startswith(":")
+                text = prefix + token if is_alias else f"{prefix}{token}: {token}"
+            else:
+                text = token
+
+            if depth == 0 and operation_start is None and not in_fragment:
+                if token in ("query", "mutation", "subscription", "{"):
+                    operation_start = length + match.start() - last
+            if depth == 0 and token == "fragment":
+                in_fragment = True
+
+            out.append(query[last:match.start()])
+            out.append(text)
+            length += match.start() - last + len(text)
+            last, previous = match.end(), token
+
+            if token == "(":
+                parens += 1
+            elif token == ")":
+                parens -= 1
+            elif token == "{":
+                depth += 1
+                if depth == 1 and not in_fragment and body_start is None:
+                    body_start = length
+            elif token == "}":
+                depth -= 1
+                if depth == 0:
+                    if in_fragment:
+                        in_fragment = False
+                    elif body_end is None:
+                        body_end = length - 1
+        renamed = "".join(out) + query[last:]
+
+        header = renamed[operation_start:body_start - 1]
+        if "(" in header:
+            variable_definitions.append(header[header.index("(") + 1:header.rindex(")")])
+        selections.append(renamed[body_start:body_end])
+        fragments.append(renamed[:operation_start] + renamed[body_end + 1:])
+        variables.update((prefix + name, value) for name, value in (data.get("variables") or {}).items())
+
+    header = "query Batch"
+    if variable_definitions:
+        header += "(" + ", ".join(variable_definitions) + ")"
+    return {"operationName": "Batch", "variables": variables,
+            "query": header + " {" + "".join(selections) + "}\n" + "".join(fragments)}
+
+
+def _batch_request(requests_data):
+    """
+    Merge GraphQL requests into one, named Batch_<their operation names>
+    """
+    merged = _merge_operations(requests_data)
+    merged["operationName"] = "Batch_" + "_".join(d.get("operationName") or "anonymous" for d in requests_data)
+    merged["query"] = merged["query"].replace("query Batch", "query " + merged["operationName"], 1)
+    return merged
+
+
+def _split_result(result, count):
+    """
+    Response: list of the results of the requests merged by _merge_operations
+    """
+    results = [{"data": None if result.get("data") is None else {}} for _ in range(count)]
+    for key, value in (result.get("data") or {}).items():
+        i, _, name = key[1:].partition("_")
+        results[int(i)]["data"][name] = value
+    for error in result.get("errors") or []:
+        path = error.get("path") or []
+        if path and re.match(r"b\d+_", str(path[0])):
+            i, _, name = path[0][1:].partition("_")
+            targets = [int(i)]
+            error = dict(error, path=[name] + list(path[1:]))
+        else:
+            targets = range(count)
+        for i in targets:
+            results[i].setdefault("errors", []).append(error)
+    return results
+
+
 class StakePythonClient(object):
     ENDPOINT = "https://api.stake.com/graphql"
+    WEBSOCKET_ENDPOINT = "wss://api.stake.com/websockets"
     HEADERS = {
         "content-type": "application/json",
         "Referer": "https://stake.com/",
@@ -12,12 +143,47 @@ class StakePythonClient(object):
         "Origin": "https://stake.com",
     }
 
-    def __init__(self, accessToken=None):
+    def __init__(self, accessToken=None, pool_size=10, endpoint=None, websocket_endpoint=None):
+        """
+        pool_size: connections kept alive to the API, at least the number of threads sharing the client
+        endpoint: GraphQL URL, e.g. a local stand-in server from stake_bench.py
+        websocket_endpoint: GraphQL subscriptions URL, e.g. a local stand-in server from stake_standin.py
+        """
         # Stake API TOKEN is required by requests for personal account,
         # but seems not required by requests for public info.
         if accessToken is None:
             accessToken = self._load_access_token()
-        self.HEADERS["x-access-token"] = accessToken
+        if endpoint is not None:
+            self.ENDPOINT = endpoint
+        if websocket_endpoint is not None:
+            self.WEBSOCKET_ENDPOINT = websocket_endpoint
+        self.headers = dict(self.HEADERS)
+        self.headers["x-access-token"] = accessToken
+        # gzip and deflate, plus br when the brotli package is installed
+        self.headers["accept-encoding"] = requests.utils.DEFAULT_ACCEPT_ENCODING
+
+        # One keep-alive session per client, so polls reuse the TLS connections
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(self.headers)
+
+    def close(self):
+        self.session.close()
+
+    def subscribe(self, data, resume=None):
+        """
+        Subscribe to a GraphQL subscription, e.g. new bets, over a websocket reconnected when it drops
+            resume: function called after each reconnection, returning the results to yield first,
+                    e.g. the bets published while disconnected fetched with get_all_sport_bets
+
+        Returns a stake_async.StakeSubscription, iterate it for the results and close() it to stop
+        """
+        # aiohttp is only needed for subscriptions
+        from stake_async import StakeSubscription
+        return StakeSubscription(data, resume, self.headers["x-access-token"], self.ENDPOINT,
+                                 self.WEBSOCKET_ENDPOINT)
 
     def _load_access_token(self):
         """Find the access token in default places"""
@@ -27,8 +193,31 @@ class StakePythonClient(object):
         return ''
 
     def send_graphql_request(self, data):
+        """
+        data: request data, or a list of them sent as one batched-array request
+        """
+        return self.__post(self.__operation_name(data), json=data)
+
+    def send_prepared(self, prepared):
+        """
+        Send a request body serialized once by stake_queries.StakeQueryRegistry.prepare()
+
+        Returns the list of the responses of its operations
+        """
+        result = self.__post(prepared.operationName, data=prepared.body)
+        if len(prepared.names) == 1:
+            return [result]
+        return _split_result(result, len(prepared.names))
+
+    def __post(self, operation, **body):
+        start = time.perf_counter()
         try:
-            r = requests.post(self.ENDPOINT, json=data, headers=self.HEADERS)
+            r = self.session.post(self.ENDPOINT, **body)
+            if METRICS.enabled:
+                METRICS.observe("stake", operation, time.perf_counter() - start,
+                                len(r.request.body or b""), len(r.content), error=r.status_code != 200)
+                if r.status_code == 429:
+                    METRICS.rate_limited("stake", operation)
 
             if r.status_code == 200:
                 # print(json.dumps(r.json(), indent=2))
@@ -36,21 +225,71 @@ class StakePythonClient(object):
             else:
                 raise Exception(f"Query failed to run with a {r.status_code}.")
         except requests.exceptions.ConnectionError as e:
+            if METRICS.enabled:
+                METRICS.observe("stake", operation, time.perf_counter() - start, error=True)
             print('Cannot send a GraphQL request to Stake.')
             raise e
         # TODO: retry when hit api limit?
 
+    @staticmethod
+    def __operation_name(data):
+        if isinstance(data, list):
+            return "+".join(d.get("operationName") or "anonymous" for d in data)
+        return data.get("operationName") or "anonymous"
+
+    def send_graphql_batch(self, requests_data, mode="alias"):
+        """
+        Send several GraphQL requests in one HTTP request
+            mode: "alias" merges them into one query, their root fields aliased apart,
+                  "array" posts them as a batched array, for servers that accept one
+
+        Returns the list of their responses, as send_graphql_request would have returned them
+        """
+        if mode == "array":
+            results = self.send_graphql_request(list(requests_data))
+            if not isinstance(results, list):
+                raise ValueError(f"The server does not accept batched arrays: {results}")
+            return results
+        requests_data = list(requests_data)
+        if len(requests_data) == 1:
+            return [self.send_graphql_request(requests_data[0])]
+        return _split_result(self.send_graphql_request(_batch_request(requests_data)), len(requests_data))
+
+    def batch(self, *calls, mode="alias"):
+        """
+        Run several query methods in one round trip, e.g. for a dashboard refresh
+            client.batch(("get_usd_currency_conversion_rate",), ("get_highroller_sport_bets", 50))
+
+        Each call is a tuple (method name, arguments...).
+        Returns the list of their results, an exception instead of the result of a call that failed.
+        """
+        operations = [getattr(type(self), name).operation(self, *args) for name, *args in calls]
+        responses = self.send_graphql_batch([next(op) for op in operations], mode)
+
+        results = []
+        for operation, response in zip(operations, responses):
+            try:
+                operation.send(response)
+                results.append(RuntimeError("The operation yielded more than one request"))
+            except StopIteration as e:
+                results.append(e.value)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    @graphql_operation
     def get_currency_conversion_rate(self):
         request_data = {
             "operationName": "CurrencyConversionRate",
             "variables": {},
             "query": "query CurrencyConversionRate {\n  info {\n    currencies {\n      name\n      value\n      eur: value(fiatCurrency: eur)\n      jpy: value(fiatCurrency: jpy)\n      usd: value(fiatCurrency: usd)\n      cad: value(fiatCurrency: cad)\n      brl: value(fiatCurrency: brl)\n      cny: value(fiatCurrency: cny)\n      idr: value(fiatCurrency: idr)\n      inr: value(fiatCurrency: inr)\n      krw: value(fiatCurrency: krw)\n      php: value(fiatCurrency: php)\n      rub: value(fiatCurrency: rub)\n      __typename\n    }\n    __typename\n  }\n}\n"
         }
-        result = self.send_graphql_request(request_data)
+        result = yield request_data
         if 'errors' in result:
             raise ValueError(f"Failed to request currency conversion rates: {result}")
         return result["data"]["info"]["currencies"]
 
+    @graphql_operation
     def get_usd_currency_conversion_rate(self):
         """
         This is a CUSTOMIZED query.
@@ -62,43 +301,48 @@ class StakePythonClient(object):
             "variables": {},
             "query": "query UsdCurrencyConversionRate {\n  info {\n    currencies {\n      name\n      value\n    }\n  }\n}\n"
         }
-        result = self.send_graphql_request(request_data)
+        result = yield request_data
         if 'errors' in result:
             raise ValueError(f"Failed to request usd currency conversion rates: {result}")
         return { cur['name']: cur['value'] for cur in result["data"]["info"]["currencies"] }
 
+    @graphql_operation
     def get_currency_value(self, currency="btc"):
         request_data = {
             "operationName": "CurrencyValue",
             "variables": {"currency": currency},
             "query": "query CurrencyValue($currency: CurrencyEnum!) {\n  info {\n    currency(currency: $currency) {\n      value\n      __typename\n    }\n    __typename\n  }\n}\n"
         }
-        return self.send_graphql_request(request_data)
+        return (yield request_data)
 
+    @graphql_operation
     def get_live_sport_list(self):
         request_data = {
             "operationName": "liveSportList",
             "variables": {},
             "query": "query liveSportList {\n  sportList(type: live, limit: 50, offset: 0, liveRank: true) {\n    id\n    name\n    slug\n    fixtureCount(type: live)\n    __typename\n  }\n}\n"
         }
-        return self.send_graphql_request(request_data)
+        return (yield request_data)
 
+    @graphql_operation
     def get_upcoming_sport_list(self):
         request_data = {
             "operationName": "SportList",
             "variables": {"type": "upcoming"},
             "query": "query SportList($type: SportSearchEnum!) {\n  sportList(type: $type, limit: 50, offset: 0) {\n    id\n    name\n    slug\n    fixtureCount(type: $type)\n    __typename\n  }\n}\n"
         }
-        return self.send_graphql_request(request_data)
+        return (yield request_data)
 
+    @graphql_operation
     def get_upcoming_fixture_count(self):
         request_data = {
             "operationName": "FixtureCount",
             "variables": {"type": "upcoming"},
             "query":"query FixtureCount($type: SportSearchEnum!) {\n  fixtureCount(type: $type)\n}\n"
         }
-        return self.send_graphql_request(request_data)
+        return (yield request_data)
 
+    @graphql_operation
     def get_highroller_sport_bets(self, limit=40):
         # LIMIT can't be above 50.
         request_data = {
@@ -109,11 +353,12 @@ class StakePythonClient(object):
             # Below is a CUSTOMIZED query.
             "query": "query highrollerSportBets($limit: Int!) {\n  highrollerSportBets(limit: $limit) {\n    ...SportRootBet\n    __typename\n  }\n}\n\nfragment SportRootBet on Bet {\n  id\n  iid\n  bet {\n    ... on SportBet {\n      active\n      amount\n      cashoutMultiplier\n      createdAt\n      currency\n      id\n      payout\n      payoutMultiplier\n      potentialMultiplier\n      updatedAt\n      status\n      user {\n        id\n        name\n        __typename\n      }\n      outcomes {\n        odds\n        fixture {\n          name\n          data {\n            ... on SportFixtureDataMatch {\n              startTime\n              competitors {\n                name\n                abbreviation\n                __typename\n              }\n              __typename\n            }\n            ... on SportFixtureDataOutright {\n              name\n              startTime\n              endTime\n              __typename\n            }\n            __typename\n          }\n          tournament {\n            name\n            category {\n              name\n              sport {\n                slug\n                __typename\n              }\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    ... on PlayerPropBet {\n      active\n      amount\n      cashoutMultiplier\n      createdAt\n      currency\n      id\n      odds\n      payout\n      payoutMultiplier\n      updatedAt\n      status\n      user {\n        id\n        name\n        __typename\n      }\n      playerProps {\n        id\n        lineType\n        odds\n        playerProp {\n          ...PlayerPropLineFragment\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n\nfragment PlayerPropLineFragment on PlayerPropLine {\n  id\n  line\n  over\n  under\n  suspended\n  balanced\n  name\n  player {\n    id\n    name\n    __typename\n  }\n  market {\n    id\n    stat {\n      name\n      value\n      __typename\n    }\n    game {\n      id\n      fixture {\n        id\n        name\n        data {\n          ... on SportFixtureDataMatch {\n            competitors {\n              ...CompetitorFragment\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        tournament {\n          id\n          category {\n            id\n            sport {\n              id\n              name\n              slug\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n\nfragment CompetitorFragment on SportFixtureCompetitor {\n  name\n  extId\n  countryCode\n  abbreviation\n  __typename\n}\n"
         }
-        result = self.send_graphql_request(request_data)
+        result = yield request_data
         if 'errors' in result:
             raise ValueError(f"Failed to request highroller sport bets: {result}")
         return result['data']['highrollerSportBets']   # returns a list
 
+    @graphql_operation
     def get_all_sport_bets(self, limit=40):
         # LIMIT can't be above 50.
         request_data = {
@@ -124,11 +369,12 @@ class StakePythonClient(object):
             # Below is a CUSTOMIZED query.
             "query":"query AllSportBets($limit: Int!) {\n  allSportBets(limit: $limit) {\n    ...SportRootBet\n    __typename\n  }\n}\n\nfragment SportRootBet on Bet {\n  id\n  iid\n  bet {\n    ... on SportBet {\n      active\n      amount\n      cashoutMultiplier\n      createdAt\n      currency\n      id\n      payout\n      payoutMultiplier\n      potentialMultiplier\n      updatedAt\n      status\n      user {\n        id\n        name\n        __typename\n      }\n      outcomes {\n        odds\n        fixture {\n          name\n          data {\n            ... on SportFixtureDataMatch {\n              startTime\n              competitors {\n                name\n                abbreviation\n                __typename\n              }\n              __typename\n            }\n            ... on SportFixtureDataOutright {\n              name\n              startTime\n              endTime\n              __typename\n            }\n            __typename\n          }\n          tournament {\n            name\n            category {\n              name\n              sport {\n                slug\n                __typename\n              }\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    ... on PlayerPropBet {\n      active\n      amount\n      cashoutMultiplier\n      createdAt\n      currency\n      id\n      odds\n      payout\n      payoutMultiplier\n      updatedAt\n      status\n      user {\n        id\n        name\n        __typename\n      }\n      playerProps {\n        id\n        lineType\n        odds\n        playerProp {\n          ...PlayerPropLineFragment\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n\nfragment PlayerPropLineFragment on PlayerPropLine {\n  id\n  line\n  over\n  under\n  suspended\n  balanced\n  name\n  player {\n    id\n    name\n    __typename\n  }\n  market {\n    id\n    stat {\n      name\n      value\n      __typename\n    }\n    game {\n      id\n      fixture {\n        id\n        name\n        data {\n          ... on SportFixtureDataMatch {\n            competitors {\n              ...CompetitorFragment\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        tournament {\n          id\n          category {\n            id\n            sport {\n              id\n              name\n              slug\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n\nfragment CompetitorFragment on SportFixtureCompetitor {\n  name\n  extId\n  countryCode\n  abbreviation\n  __typename\n}\n"
         }
-        result = self.send_graphql_request(request_data)
+        result = yield request_data
         if 'errors' in result:
             raise ValueError(f"Failed to request all sport bets: {result}")
         return result['data']['allSportBets']   # returns a list
 
+    @graphql_operation
     def get_bet_lookup(self, iid):
         # parameter iid example: "sport:15684378"
         # Browser visit: https://stake.com/?modal=bet&iid={iid}
@@ -137,8 +383,9 @@ class StakePythonClient(object):
             "variables": {"iid": iid},
             "query": "query BetLookup($iid: String, $betId: String) {\n  bet(iid: $iid, betId: $betId) {\n    ...BetFragment\n    __typename\n  }\n}\n\nfragment BetFragment on Bet {\n  id\n  iid\n  type\n  scope\n  game {\n    name\n    icon\n    __typename\n  }\n  bet {\n    ... on CasinoBet {\n      ...CasinoBetFragment\n      __typename\n    }\n    ... on MultiplayerCrashBet {\n      ...MultiplayerCrashBet\n      __typename\n    }\n    ... on MultiplayerSlideBet {\n      ...MultiplayerSlideBet\n      __typename\n    }\n    ... on SoftswissBet {\n      ...SoftswissBet\n      __typename\n    }\n    ... on SportBet {\n      ...SportBet\n      __typename\n    }\n    ... on EvolutionBet {\n      ...EvolutionBet\n      __typename\n    }\n    ... on PlayerPropBet {\n      ...PlayerPropBetFragment\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n\nfragment CasinoBetFragment on CasinoBet {\n  id\n  active\n  payoutMultiplier\n  amountMultiplier\n  amount\n  payout\n  updatedAt\n  currency\n  game\n  user {\n    id\n    name\n    __typename\n  }\n  __typename\n}\n\nfragment MultiplayerCrashBet on MultiplayerCrashBet {\n  id\n  user {\n    id\n    name\n    __typename\n  }\n  payoutMultiplier\n  gameId\n  amount\n  payout\n  currency\n  result\n  updatedAt\n  cashoutAt\n  btcAmount: amount(currency: btc)\n  __typename\n}\n\nfragment MultiplayerSlideBet on MultiplayerSlideBet {\n  id\n  user {\n    id\n    name\n    __typename\n  }\n  payoutMultiplier\n  gameId\n  amount\n  payout\n  currency\n  slideResult: result\n  updatedAt\n  cashoutAt\n  btcAmount: amount(currency: btc)\n  active\n  createdAt\n  __typename\n}\n\nfragment SoftswissBet on SoftswissBet {\n  id\n  amount\n  currency\n  updatedAt\n  payout\n  payoutMultiplier\n  user {\n    id\n    name\n    __typename\n  }\n  softswissGame: game {\n    id\n    name\n    edge\n    extId\n    provider {\n      id\n      name\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n\nfragment SportBet on SportBet {\n  id\n  amount\n  active\n  currency\n  status\n  payoutMultiplier\n  potentialMultiplier\n  cashoutMultiplier\n  payout\n  createdAt\n  user {\n    id\n    name\n    __typename\n  }\n  outcomes {\n    odds\n    status\n    outcome {\n      id\n      name\n      active\n      odds\n      __typename\n    }\n    market {\n      ...MarketFragment\n      fixture {\n        id\n        tournament {\n          id\n          category {\n            id\n            sport {\n              id\n              slug\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    fixture {\n      ...FixturePreviewFragment\n      __typename\n    }\n    __typename\n  }\n  adjustments {\n    id\n    payoutMultiplier\n    updatedAt\n    createdAt\n    __typename\n  }\n  __typename\n}\n\nfragment MarketFragment on SportMarket {\n  id\n  name\n  status\n  extId\n  specifiers\n  outcomes {\n    id\n    active\n    name\n    odds\n    __typename\n  }\n  __typename\n}\n\nfragment FixturePreviewFragment on SportFixture {\n  id\n  extId\n  status\n  slug\n  marketCount(status: [active, suspended])\n  data {\n    ...FixtureDataMatchFragment\n    ...FixtureDataOutrightFragment\n    __typename\n  }\n  eventStatus {\n    ...FixtureEventStatus\n    __typename\n  }\n  tournament {\n    ...TournamentTreeFragment\n    __typename\n  }\n  ...LiveStreamExistsFragment\n  __typename\n}\n\nfragment FixtureDataMatchFragment on SportFixtureDataMatch {\n  startTime\n  competitors {\n    ...CompetitorFragment\n    __typename\n  }\n  __typename\n}\n\nfragment CompetitorFragment on SportFixtureCompetitor {\n  name\n  extId\n  countryCode\n  abbreviation\n  __typename\n}\n\nfragment FixtureDataOutrightFragment on SportFixtureDataOutright {\n  name\n  startTime\n  endTime\n  __typename\n}\n\nfragment FixtureEventStatus on SportFixtureEventStatus {\n  homeScore\n  awayScore\n  matchStatus\n  clock {\n    matchTime\n    remainingTime\n    __typename\n  }\n  periodScores {\n    homeScore\n    awayScore\n    matchStatus\n    __typename\n  }\n  currentServer {\n    extId\n    __typename\n  }\n  homeGameScore\n  awayGameScore\n  statistic {\n    yellowCards {\n      away\n      home\n      __typename\n    }\n    redCards {\n      away\n      home\n      __typename\n    }\n    corners {\n      home\n      away\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n\nfragment TournamentTreeFragment on SportTournament {\n  id\n  name\n  slug\n  category {\n    id\n    name\n    slug\n    sport {\n      id\n      name\n      slug\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n\nfragment LiveStreamExistsFragment on SportFixture {\n  abiosStream {\n    exists\n    __typename\n  }\n  betradarStream {\n    exists\n    __typename\n  }\n  diceStream {\n    exists\n    __typename\n  }\n  __typename\n}\n\nfragment EvolutionBet on EvolutionBet {\n  id\n  amount\n  currency\n  createdAt\n  payout\n  payoutMultiplier\n  user {\n    id\n    name\n    __typename\n  }\n  softswissGame: game {\n    id\n    name\n    edge\n    __typename\n  }\n  __typename\n}\n\nfragment PlayerPropBetFragment on PlayerPropBet {\n  active\n  amount\n  cashoutMultiplier\n  createdAt\n  currency\n  id\n  odds\n  payout\n  payoutMultiplier\n  updatedAt\n  status\n  user {\n    id\n    name\n    __typename\n  }\n  playerProps {\n    id\n    lineType\n    odds\n    playerProp {\n      ...PlayerPropLineFragment\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n\nfragment PlayerPropLineFragment on PlayerPropLine {\n  id\n  line\n  over\n  under\n  suspended\n  balanced\n  name\n  player {\n    id\n    name\n    __typename\n  }\n  market {\n    id\n    stat {\n      name\n      value\n      __typename\n    }\n    game {\n      id\n      fixture {\n        id\n        name\n        data {\n          ... on SportFixtureDataMatch {\n            competitors {\n              ...CompetitorFragment\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        tournament {\n          id\n          category {\n            id\n            sport {\n              id\n              name\n              slug\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n  __typename\n}\n"
         }
-        return self.send_graphql_request(request_data)
+        return (yield request_data)
 
+    @graphql_operation
     def get_user_balances(self):
         """
         If the access token is wrong, the response would be
@@ -149,7 +396,7 @@ class StakePythonClient(object):
             "operationName": "UserVaultBalances",
             "variables": {},
             "query":"query UserVaultBalances {\n  user {\n    id\n    balances {\n      available {\n        amount\n        currency\n        __typename\n      }\n      vault {\n        amount\n        currency\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"}
-        return self.send_graphql_request(request_data)
+        return (yield request_data)
 
 
 
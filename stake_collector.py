@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import time
+
+from fx_rates import FxRateService, FxRateUnavailable, blockchain_usd_rates
+from poll_scheduler import AdaptivePollScheduler, DedupIndex
+from stake_async import AsyncStakeClient
+from stake_client import StakePythonClient
+from stake_queries import PreparedRequest
+from stake_run import QUERIES, format_bet
+
+
+class StakeFeed(object):
+    '''
+    A bet feed polled on its own cadence, e.g. allSportBets every few seconds and highrollerSportBets less often.
+
+    query is a StakeQuery with a $limit variable, returning a list of bets with an iid.
+    The other keyword arguments are those of AdaptivePollScheduler.
+    '''
+
+    def __init__(self, query, limit=50, interval=10, **scheduler_options):
+        super(StakeFeed, self).__init__()
+        self.name = query.name
+        self.field = query.field
+        self.request = PreparedRequest(query.request_data(limit=limit), (query.name,))
+        self.scheduler = AdaptivePollScheduler(limit, interval, sequence=lambda iid: int(iid.rsplit(':', 1)[1]),
+                                               endpoint=query.name, **scheduler_options)
+
+
+def sport_feeds(budget=None):
+    '''
+    Response: the all sport bets and high roller sport bets feeds, sharing a budget of requests per minute
+    '''
+    budget = budget and max(1, budget // 2)
+    return [StakeFeed(QUERIES['FetcherAllSportBets'], interval=10, min_interval=2, budget=budget),
+            StakeFeed(QUERIES['FetcherHighrollerSportBets'], interval=60, min_interval=10, budget=budget)]
+
+
+class StakeBetCollector(object):
+    '''
+    Polls several Stake bet feeds concurrently, each on its own cadence, and
+    merges them into one stream of bets de-duplicated by iid:
+
+        async with AsyncStakeClient() as client:
+            async for feed, bet in StakeBetCollector(client, sport_feeds()).stream():
+                print(feed, bet['iid'])
+
+    A feed failing is retried on its own cadence without stopping the others.
+    '''
+
+    def __init__(self, client, feeds, dedup_size=100000, dedup_age=3600):
+        super(StakeBetCollector, self).__init__()
+        self.client = client
+        self.feeds = list(feeds)
+        self.dedup = DedupIndex(dedup_size, dedup_age)
+        self.__queue = None
+        self.__tasks = []
+
+    async def stream(self):
+        '''
+        Async generator of (feed name, bet), oldest bets of each poll first
+        '''
+        self.__queue = asyncio.Queue()
+        self.__tasks = [asyncio.create_task(self.__poll(feed)) for feed in self.feeds]
+        try:
+            while True:
+                item = await self.__queue.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            self.stop()
+            await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+    async def __poll(self, feed):
+        while True:
+            try:
+                result, = await self.client.send_prepared(feed.request)
+                if 'errors' in result:
+                    raise ValueError(f'Failed to request {feed.name}: {result}')
+                bets = result['data'][feed.field]
+                feed.scheduler.observe(bet['iid'] for bet in bets)
+            except Exception as e:
+                print(f'Cannot poll {feed.name}: {e!r}')
+                await asyncio.sleep(max(feed.scheduler.next_delay(), feed.scheduler.min_interval))
+                continue
+
+            now = time.monotonic()
+            for bet in reversed(bets):
+                if self.dedup.add(bet['iid'], now):
+                    self.__queue.put_nowait((feed.name, bet))
+            await asyncio.sleep(feed.scheduler.next_delay())
+
+    def stop(self):
+        '''
+        End the stream
+        '''
+        for task in self.__tasks:
+            task.cancel()
+        if self.__queue is not None:
+            self.__queue.put_nowait(None)
+
+
+async def print_large_bets(min_usd_amount, budget=None, endpoint=None, record=None):
+    '''
+    record: file to append every collected bet to, one JSON per line, for stake_standin.py --replay
+    '''
+    fx_rates = FxRateService([StakePythonClient(endpoint=endpoint).get_usd_currency_conversion_rate,
+                              blockchain_usd_rates])
+    try:
+        # The first refresh may take a while, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, fx_rates.rates)
+    except FxRateUnavailable:
+        print('Cannot get the currency conversion rates.')
+        fx_rates.stop()
+        return
+
+    async with AsyncStakeClient(endpoint=endpoint) as client:
+        try:
+            async for feed, bet in StakeBetCollector(client, sport_feeds(budget)).stream():
+                if record is not None:
+                    record.write(json.dumps(bet) + '\n')
+                (usd_amount,), _ = fx_rates.to_usd([bet['bet']['amount']], [bet['bet']['currency']])
+                if usd_amount is None or usd_amount < min_usd_amount:
+                    continue
+                line = format_bet(bet, usd_amount)
+                if line:
+                    print(f'{feed:<28}{line}')
+        finally:
+            fx_rates.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Collect Stake.com bets from the all bets and high roller feeds')
+    parser.add_argument('-m', '--min_usd_amount', type=float, default=1000,
+                        help='The minimum USD amount for bets to display (default:1000)')
+    parser.add_argument('-b', '--budget', type=int, default=None,
+                        help='Maximum number of requests per minute, shared by the feeds (default:no limit)')
+    parser.add_argument('-e', '--endpoint', default=None,
+                        help='GraphQL URL, e.g. the one of stake_standin.py (default:the Stake API)')
+    parser.add_argument('-r', '--record', default=None,
+                        help='Append every collected bet to this file, to replay them with stake_standin.py')
+    args = parser.parse_args()
+
+    record = open(args.record, 'a') if args.record else None
+    # Ctrl-C to terminate the program
+    try:
+        asyncio.run(print_large_bets(args.min_usd_amount, args.budget, args.endpoint, record))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if record is not None:
+            record.close()
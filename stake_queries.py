@@ -0,0 +1,116 @@
+import json
+
+from stake_client import _batch_request
+
+
+class StakeQuery(object):
+    '''
+    A GraphQL query selecting only the fields a consumer reads.
+
+    fields are dotted paths below the root field, e.g. 'bet.outcomes.odds'.
+    A segment 'on Type' selects the fields of a union member, e.g.
+    'bet.on SportBet.amount' selects bet { __typename ... on SportBet { amount } }.
+    '''
+
+    def __init__(self, name, root, fields, variables=None, operation='query'):
+        '''
+        name: operation name
+        root: root field with its arguments, e.g. 'allSportBets(limit: $limit)'
+        variables: dictionary of variable name -> GraphQL type, e.g. {'limit': 'Int!'}
+        operation: 'query', or 'subscription' for StakePythonClient.subscribe()
+        '''
+        super(StakeQuery, self).__init__()
+        self.name = name
+        self.operation = operation
+        self.root = root
+        self.field = root.split('(', 1)[0].strip()
+        self.fields = list(fields)
+        self.variables = dict(variables or {})
+        self.query = self.__build()
+
+    def __build(self):
+        tree = {}
+        for path in self.fields:
+            node = tree
+            for part in path.split('.'):
+                node = node.setdefault(part.strip(), {})
+
+        def render(node):
+            # The type of a union, so that its value tells which fields it has, e.g. a recorded bet
+            parts = ['__typename'] if any(name.startswith('on ') for name in node) else []
+            for name, children in node.items():
+                if name.startswith('on '):
+                    parts.append(f'... {name} {{ {render(children)} }}')
+                elif children:
+                    parts.append(f'{name} {{ {render(children)} }}')
+                else:
+                    parts.append(name)
+            return ' '.join(parts)
+
+        definitions = ', '.join(f'${name}: {kind}' for name, kind in self.variables.items())
+        header = f'{self.operation} {self.name}' + (f'({definitions})' if definitions else '')
+        return f'{header} {{ {self.root} {{ {render(tree)} }} }}'
+
+    def request_data(self, **variables):
+        return {'operationName': self.name, 'variables': variables, 'query': self.query}
+
+
+class PreparedRequest(object):
+    '''
+    Request body serialized once, sent as is by StakePythonClient.send_prepared()
+    '''
+
+    __slots__ = ('operationName', 'names', 'body')
+
+    def __init__(self, data, names):
+        self.operationName = data['operationName']
+        self.names = names
+        self.body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def __len__(self):
+        return len(self.body)
+
+
+class StakeQueryRegistry(object):
+    '''
+    Trimmed queries by operation name, with their request bodies serialized once per variables.
+
+    prepare(('Bets', {'limit': 50}), ('Rates', {})) returns the same
+    PreparedRequest on every poll, several operations being merged into one
+    request like StakePythonClient.batch() does.
+    '''
+
+    def __init__(self):
+        super(StakeQueryRegistry, self).__init__()
+        self.__queries = {}
+        self.__prepared = {}
+
+    def register(self, name, root, fields, variables=None, operation='query'):
+        '''
+        Response: StakeQuery
+        '''
+        query = StakeQuery(name, root, fields, variables, operation)
+        self.__queries[name] = query
+        self.__prepared = {key: p for key, p in self.__prepared.items() if name not in p.names}
+        return query
+
+    def __getitem__(self, name):
+        return self.__queries[name]
+
+    def __contains__(self, name):
+        return name in self.__queries
+
+    def prepare(self, *operations):
+        '''
+        operations: (operation name, variables dictionary) tuples
+
+        Response: PreparedRequest
+        '''
+        key = tuple((name, json.dumps(variables, sort_keys=True)) for name, variables in operations)
+        prepared = self.__prepared.get(key)
+        if prepared is None:
+            data = [self.__queries[name].request_data(**variables) for name, variables in operations]
+            names = tuple(name for name, _ in operations)
+            prepared = PreparedRequest(data[0] if len(data) == 1 else _batch_request(data), names)
+            self.__prepared[key] = prepared
+        return prepared
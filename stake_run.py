@@ -4,90 +4,205 @@ import argparse
 import threading
 import time
 
-from client import StakePythonClient
+from fx_rates import FxRateService, FxRateUnavailable, blockchain_usd_rates
+from poll_scheduler import AdaptivePollScheduler, DedupIndex
+from stake_client import StakePythonClient
+from stake_queries import StakeQueryRegistry
+
+
+# The fields StakeBetFetcher reads, the responses leave out the rest of the bet fragment
+_SPORT_BET_FIELDS = ('active', 'status', 'amount', 'currency', 'outcomes.odds', 'outcomes.fixture.name',
+                     'outcomes.fixture.tournament.name', 'outcomes.fixture.tournament.category.name',
+                     'outcomes.fixture.tournament.category.sport.slug')
+# Player prop bets have no outcomes but are filtered by amount like sport bets
+_PLAYER_PROP_BET_FIELDS = ('active', 'status', 'amount', 'currency')
+BET_FIELDS = (('iid',) + tuple('bet.on SportBet.' + field for field in _SPORT_BET_FIELDS)
+              + tuple('bet.on PlayerPropBet.' + field for field in _PLAYER_PROP_BET_FIELDS))
+
+QUERIES = StakeQueryRegistry()
+QUERIES.register('FetcherAllSportBets', 'allSportBets(limit: $limit)', BET_FIELDS, {'limit': 'Int!'})
+QUERIES.register('FetcherHighrollerSportBets', 'highrollerSportBets(limit: $limit)', BET_FIELDS, {'limit': 'Int!'})
+QUERIES.register('FetcherUsdRates', 'info', ('currencies.name', 'currencies.value'))
+# New bets pushed one by one, see StakeBetFetcher(push=True)
+QUERIES.register('FetcherAllSportBetsSubscription', 'allSportBets', BET_FIELDS, operation='subscription')
+QUERIES.register('FetcherHighrollerSportBetsSubscription', 'highrollerSportBets', BET_FIELDS,
+                 operation='subscription')
+
+
+def format_bet(bet, usd_amount):
+    """
+    Returns the line displayed for a bet, None for a bet without sport outcomes
+    """
+    iid = bet["iid"]
+
+    # Can filter by these if needed
+    active = bet["bet"]["active"]  # bool type
+    status = bet["bet"]["status"]  # confirmed|settled|cashout|...
+    # createdAt = bet["bet"]["createdAt"]
+    # updatedAt = bet["bet"]["updatedAt"]
+
+    ### Single bet / Multibet
+    # Multibet if outcome_list has more than 1 element, otherwise single bet
+    # Multibet may contain sub-bets for different competitions/sports.
+    #
+    # How to calculate the "Total odds" for a multibet?
+    # Looks like it is not the sum of each sub-bets odds.
+    # E.g. https://stake.com/?modal=bet&iid=sport:15691453
+    outcome_list = bet["bet"].get("outcomes")
+    if not outcome_list:
+        return None
+    bet_odds = []
+    for outcome in outcome_list:
+        sport = outcome["fixture"]["tournament"]["category"]["sport"]["slug"]
+        # if sport not in ('american-football', 'basketball'):
+        #     bet_odds = []
+        #     break
+        bet_odds.append({
+            "odds": outcome["odds"],
+            "competitors": outcome["fixture"]["name"],
+            "tournament": outcome["fixture"]["tournament"].get("name"),
+            "sport_category": outcome["fixture"]["tournament"]["category"].get("name"),
+            "sport": sport
+        })
+    if not bet_odds:
+        return None
+
+    # Display bet info
+    is_multibet = "Multibet" if len(outcome_list) > 1 else "Single bet"
+    return f"betID:'{iid}'  active:{active}  Status:{status}  Amount:${usd_amount:.2f}  {is_multibet}:{bet_odds}"
+
 
 class StakeBetFetcher(object):
-    def __init__(self, min_usd_amount=0, fetch_interval=60):
+    # LIMIT can't be above 50.
+    BETS_LIMIT = 50
+
+    def __init__(self, min_usd_amount=0, fetch_interval=60, fx_rates=None, min_interval=5, max_interval=300,
+                 budget=None, push=False):
+        """
+        fetch_interval: initial interval in seconds, then adapted between min_interval and max_interval
+                        to the rate of new bets, see AdaptivePollScheduler
+        budget: maximum number of requests per minute, None for no limit
+        push: receive the new bets from a websocket subscription instead of polling,
+              polling once after each reconnection for the bets published in the meantime
+        """
         self.min_usd_amount = min_usd_amount
         self.fetch_interval = fetch_interval # in seconds
         self.last_bets = set()
         self.client = StakePythonClient()
+        if self.min_usd_amount < 1000:
+            # fetch_interval should be smaller e.g. < 1 minute
+            self.bets_query = QUERIES['FetcherAllSportBets']
+        else:
+            # fetch_interval can be larger e.g. > 1 minute
+            self.bets_query = QUERIES['FetcherHighrollerSportBets']
+        # iids like 'sport:15696289' are numbered in sequence, which tells the bets missed in a gap
+        self.scheduler = AdaptivePollScheduler(self.BETS_LIMIT, fetch_interval, min_interval, max_interval,
+                                               budget, sequence=lambda iid: int(iid.rsplit(':', 1)[1]),
+                                               endpoint=self.bets_query.name)
+        self.own_fx_rates = fx_rates is None
+        if fx_rates is None:
+            # Polls fetch the rates in the same request as the bets, pushed bets need them refreshed in the background
+            sources = [self.client.get_usd_currency_conversion_rate, blockchain_usd_rates] if push else []
+            fx_rates = FxRateService(sources)
+        self.fx_rates = fx_rates
         self.event = threading.Event()
-        threading.Thread(target=self.__run).start()
-        print(f'Fetching bets >= ${self.min_usd_amount}'
-              f' in every {self.fetch_interval} seconds.'
-              ' Press Ctrl-C to terminate the program.\n')
+        self.subscription = None
+        if push:
+            self.subscription_query = QUERIES[self.bets_query.name + 'Subscription']
+            # Bets of the polls after a reconnection may have been pushed already
+            self.seen_bets = DedupIndex(capacity=10000)
+            self.subscription = self.client.subscribe(self.subscription_query.request_data(), resume=self.__resume)
+            threading.Thread(target=self.__run_push).start()
+            print(f'Receiving bets >= ${self.min_usd_amount} as they are placed.'
+                  ' Press Ctrl-C to terminate the program.\n')
+        else:
+            threading.Thread(target=self.__run).start()
+            print(f'Fetching bets >= ${self.min_usd_amount}'
+                  f' in every {self.fetch_interval} seconds at first,'
+                  f' then every {min_interval} to {max_interval} seconds depending on the bet rate.'
+                  ' Press Ctrl-C to terminate the program.\n')
 
     def __run(self):
         while not self.event.is_set():
             self.fetch_new_markets()
-            self.event.wait(self.fetch_interval)
+            self.event.wait(self.scheduler.next_delay())
+
+    def __run_push(self):
+        try:
+            for result in self.subscription:
+                if 'errors' in result:
+                    print(f"Failed to receive a sport bet: {result}")
+                    continue
+                bet = result['data'][self.subscription_query.field]
+                if not self.seen_bets.add(bet["iid"]):
+                    continue
+                try:
+                    self.print_bets([bet])
+                except FxRateUnavailable:
+                    print(f"Cannot get the currency conversion rates, skipping bet {bet['iid']}.")
+        except Exception as e:
+            print(f'Stake subscription failed: {e!r}')
+
+    def __resume(self):
+        """
+        The bets published while the websocket was down, up to BETS_LIMIT of them, as subscription results
+        """
+        try:
+            result, = self.client.send_prepared(QUERIES.prepare((self.bets_query.name, {'limit': self.BETS_LIMIT})))
+        except Exception as e:
+            print(f'Cannot fetch the bets missed while reconnecting: {e!r}')
+            return []
+        if 'errors' in result:
+            print(f"Failed to request sport bets: {result}")
+            return []
+        bets = reversed(result['data'][self.bets_query.field])
+        return [{'data': {self.subscription_query.field: bet}} for bet in bets]
 
     def fetch_new_markets(self):
-        # Get real time currency conversion rate
-        to_usd_rates = self.client.get_usd_currency_conversion_rate()
+        # The conversion rates ride along in the same request, one round trip per tick,
+        # its body serialized once and sent as is on every tick
+        request = QUERIES.prepare((self.bets_query.name, {'limit': self.BETS_LIMIT}), ('FetcherUsdRates', {}))
+        bets_result, rates_result = self.client.send_prepared(request)
+        if 'errors' in bets_result:
+            raise ValueError(f"Failed to request sport bets: {bets_result}")
+        sport_bets = bets_result['data'][self.bets_query.field]
+        if 'errors' not in rates_result:
+            self.fx_rates.update({cur['name']: cur['value'] for cur in rates_result['data']['info']['currencies']})
+
+        new_bets = set(bet["iid"] for bet in sport_bets)
+        # Adapts the interval to the overlap with the previous window
+        self.scheduler.observe(new_bets)
+        try:
+            self.print_bets([bet for bet in sport_bets if bet["iid"] not in self.last_bets])
+        except FxRateUnavailable:
+            print('Cannot get the currency conversion rates, retrying at the next fetch.')
+            return
+        self.last_bets = new_bets
 
-        if self.min_usd_amount < 1000:
-            # fetch_interval should be smaller e.g. < 1 minute
-            sport_bets = self.client.get_all_sport_bets(50)
-        else:
-            # fetch_interval can be larger e.g. > 1 minute
-            sport_bets = self.client.get_highroller_sport_bets(50)
+    def print_bets(self, sport_bets):
+        """
+        Print the bets of at least min_usd_amount, raises FxRateUnavailable without conversion rates
+        """
+        # Convert all the amounts at once with the cached conversion rates
+        usd_amounts, stale = self.fx_rates.to_usd([bet["bet"]["amount"] for bet in sport_bets],
+                                                  [bet["bet"]["currency"] for bet in sport_bets])
+        if stale:
+            print('Using outdated currency conversion rates.')
 
         # Parse bets
-        new_bets = set()
-        for bet in sport_bets:
-            iid = bet["iid"]
-            new_bets.add(iid)
-            if iid in self.last_bets:
-                continue
-
-            # Can filter by these if needed
-            active = bet["bet"]["active"]  # bool type
-            status = bet["bet"]["status"]  # confirmed|settled|cashout|...
-            # createdAt = bet["bet"]["createdAt"]
-            # updatedAt = bet["bet"]["updatedAt"]
-
-            amount = bet["bet"]["amount"]
-            currency = bet["bet"]["currency"]
-            usd_amount = amount * to_usd_rates[currency]
-            if usd_amount < self.min_usd_amount:
+        for bet, usd_amount in zip(sport_bets, usd_amounts):
+            if usd_amount is None or usd_amount < self.min_usd_amount:
                 continue
-
-            ### Single bet / Multibet
-            # Multibet if outcome_list has more than 1 element, otherwise single bet
-            # Multibet may contain sub-bets for different competitions/sports.
-            #
-            # How to calculate the "Total odds" for a multibet?
-            # Looks like it is not the sum of each sub-bets odds.
-            # E.g. https://stake.com/?modal=bet&iid=sport:15691453
-            outcome_list = bet["bet"].get("outcomes")
-            if not outcome_list:
-                continue
-            bet_odds = []
-            for outcome in outcome_list:
-                sport = outcome["fixture"]["tournament"]["category"]["sport"]["slug"]
-                # if sport not in ('american-football', 'basketball'):
-                #     bet_odds = []
-                #     break
-                bet_odds.append({
-                    "odds": outcome["odds"],
-                    "competitors": outcome["fixture"]["name"],
-                    "tournament": outcome["fixture"]["tournament"].get("name"),
-                    "sport_category": outcome["fixture"]["tournament"]["category"].get("name"),
-                    "sport": sport
-                })
-            if not bet_odds:
-                continue
-
-            # Display bet info
-            is_multibet = "Multibet" if len(outcome_list) > 1 else "Single bet"
-            print(f"betID:'{iid}'  active:{active}  Status:{status}  Amount:${usd_amount:.2f}  {is_multibet}:{bet_odds}")
-            # print(bet)
-        self.last_bets = new_bets
+            line = format_bet(bet, usd_amount)
+            if line:
+                print(line)
 
     def stop(self):
         self.event.set()
+        if self.subscription is not None:
+            self.subscription.close()
+        if self.own_fx_rates:
+            self.fx_rates.stop()
 
 
 
@@ -96,11 +211,23 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--min_usd_amount', type=float, required=False, default=1000,
                         help='The minimum USD amount for bets to fetch (default:1000)')
     parser.add_argument('-i', '--interval', type=int, required=False, default=60,
-                        help='Fetch interval in seconds (default:60)')
+                        help='Initial fetch interval in seconds (default:60)')
+    parser.add_argument('--min-interval', type=float, default=5,
+                        help='Shortest fetch interval in seconds, when bets arrive fast (default:5)')
+    parser.add_argument('--max-interval', type=float, default=300,
+                        help='Longest fetch interval in seconds, when no bet arrives (default:300)')
+    parser.add_argument('-b', '--budget', type=int, default=None,
+                        help='Maximum number of requests per minute (default:no limit)')
+    parser.add_argument('-p', '--push', action='store_true',
+                        help='Receive the bets from a websocket subscription instead of polling')
     args = parser.parse_args()
 
     fetcher = StakeBetFetcher(min_usd_amount=args.min_usd_amount,
-                                 fetch_interval=args.interval)
+                                 fetch_interval=args.interval,
+                                 min_interval=args.min_interval,
+                                 max_interval=args.max_interval,
+                                 budget=args.budget,
+                                 push=args.push)
 
     # Ctrl-C to terminate the program
     while True:
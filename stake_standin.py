@@ -0,0 +1,554 @@
+#! /usr/bin/env python3
+'''
+Local stand-in for the Stake GraphQL API, for benchmarks and offline runs:
+
+    $ python stake_standin.py --port 8000 --ws-port 8001 --rate 5
+    $ python stake_run.py ... with StakePythonClient(endpoint='http://127.0.0.1:8000/graphql',
+                                                     websocket_endpoint='ws://127.0.0.1:8001/websockets')
+
+It answers queries on allSportBets, highrollerSportBets, info, sportList,
+fixtureCount, bet and user from generated bets that keep arriving at `rate`
+bets per second, or bets recorded with stake_collector.py --record replayed
+at that rate. Responses only contain the fields selected by the query
+(aliases, fragments and inline fragments included), like the real API.
+The websocket server publishes the new bets to allSportBets and
+highrollerSportBets subscriptions (graphql-transport-ws protocol).
+'''
+
+import argparse
+import asyncio
+import copy
+import gzip
+import http.server
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+_TOKEN = re.compile(r'\.\.\.|[{}():\[\]=!$@]|"(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?|[A-Za-z_]\w*')
+
+
+class GraphQLError(Exception):
+    pass
+
+
+def parse_document(query):
+    '''
+    Minimal GraphQL parser, enough for the queries of stake_client.py
+
+    Response: (operations, fragments)
+        operations: list of (operation type, name, selection set)
+        fragments: dictionary of name -> selection set
+        A selection set is a list of ('field', alias, name, arguments, selection set or None),
+        ('spread', fragment name) and ('inline', type condition or None, selection set).
+    '''
+    tokens = _TOKEN.findall(query)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take(expected=None):
+        nonlocal pos
+        token = peek()
+        if token is None or (expected is not None and token != expected):
+            raise GraphQLError(f'Expected {expected!r}, got {token!r}')
+        pos += 1
+        return token
+
+    def skip_group(open_token, close_token):
+        depth = 0
+        while True:
+            token = take()
+            if token == open_token:
+                depth += 1
+            elif token == close_token:
+                depth -= 1
+                if not depth:
+                    return
+
+    def value():
+        token = take()
+        if token == '$':
+            return ('variable', take())
+        if token == '[':
+            items = []
+            while peek() != ']':
+                items.append(value())
+            take(']')
+            return items
+        if token.startswith('"'):
+            return json.loads(token)
+        if re.match(r'-?\d', token):
+            return json.loads(token)
+        return {'true': True, 'false': False, 'null': None}.get(token, token)
+
+    def directives():
+        while peek() == '@':
+            take('@')
+            take()
+            if peek() == '(':
+                skip_group('(', ')')
+
+    def selection_set():
+        take('{')
+        selections = []
+        while peek() != '}':
+            if peek() == '...':
+                take('...')
+                if peek() == 'on':
+                    take('on')
+                    type_condition = take()
+                    directives()
+                    selections.append(('inline', type_condition, selection_set()))
+                elif peek() == '{':
+                    selections.append(('inline', None, selection_set()))
+                else:
+                    selections.append(('spread', take()))
+                    directives()
+                continue
+            alias = name = take()
+            if peek() == ':':
+                take(':')
+                name = take()
+            arguments = {}
+            if peek() == '(':
+                take('(')
+                while peek() != ')':
+                    argument = take()
+                    take(':')
+                    arguments[argument] = value()
+                take(')')
+            directives()
+            selections.append(('field', alias, name, arguments, selection_set() if peek() == '{' else None))
+        take('}')
+        return selections
+
+    operations, fragments = [], {}
+    while peek() is not None:
+        if peek() == '{':
+            operations.append(('query', None, selection_set()))
+        elif peek() == 'fragment':
+            take('fragment')
+            name = take()
+            take('on')
+            take()
+            fragments[name] = selection_set()
+        else:
+            kind = take()
+            name = take() if peek() not in ('(', '{', '@') else None
+            if peek() == '(':
+                skip_group('(', ')')
+            directives()
+            operations.append((kind, name, selection_set()))
+    return operations, fragments
+
+
+def _argument_values(arguments, variables):
+    def resolve(v):
+        if isinstance(v, tuple) and v[0] == 'variable':
+            return variables.get(v[1])
+        if isinstance(v, list):
+            return [resolve(x) for x in v]
+        return v
+    return {k: resolve(v) for k, v in arguments.items()}
+
+
+def _merge(target, source):
+    for key, v in source.items():
+        if isinstance(v, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], v)
+        else:
+            target[key] = v
+    return target
+
+
+def project(value, selections, fragments):
+    '''
+    The fields of a full object selected by a selection set
+    '''
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return [project(v, selections, fragments) for v in value]
+
+    result = {}
+    for selection in selections:
+        if selection[0] == 'field':
+            _, alias, name, _, subselection = selection
+            if name == '__typename':
+                field = value.get('__typename', 'Object')
+            else:
+                field = value.get(name)
+                if subselection is not None:
+                    field = project(field, subselection, fragments)
+            if isinstance(field, dict) and isinstance(result.get(alias), dict):
+                _merge(result[alias], field)
+            else:
+                result[alias] = field
+        elif selection[0] == 'spread':
+            _merge(result, project(value, fragments[selection[1]], fragments))
+        elif selection[1] is None or selection[1] == value.get('__typename'):
+            _merge(result, project(value, selection[2], fragments))
+    return result
+
+
+class StakeStandIn(object):
+    '''
+    Generated Stake data and the resolvers of the root fields.
+
+    Bet number n arrives at start + n / rate. Every 10th bet is a high-roller bet.
+    Recorded bets are replayed in a loop, renumbered in their order of arrival.
+    '''
+
+    # Root fields of the subscriptions, with the bet numbers they publish
+    SUBSCRIPTIONS = {'allSportBets': lambda n: True, 'highrollerSportBets': lambda n: n % 10 == 0}
+
+    CURRENCIES = {'btc': 44863.16733961418, 'eth': 3155.569580309246, 'ltc': 141.94, 'doge': 0.1673,
+                  'usdt': 1.0, 'trx': 0.0771, 'xrp': 0.8169, 'eos': 3.03}
+    SPORTS = (('american-football', 'American Football', 'NFL'), ('basketball', 'Basketball', 'NBA'),
+              ('soccer', 'Soccer', 'Premier League'), ('tennis', 'Tennis', 'ATP'))
+
+    def __init__(self, rate=2.0, seed=1, recorded=None):
+        '''
+        recorded: list of bets, e.g. from the lines of a stake_collector.py --record file
+        '''
+        super(StakeStandIn, self).__init__()
+        self.rate = rate
+        self.seed = seed
+        self.recorded = recorded
+        self.start = time.time()
+        self.resolvers = {
+            'allSportBets': lambda limit=40: self.bets(limit),
+            'highrollerSportBets': lambda limit=40: self.bets(limit, highroller=True),
+            'info': lambda: {'__typename': 'Info', 'currencies': [
+                {'__typename': 'CryptoCurrency', 'name': name, 'value': value} for name, value in self.CURRENCIES.items()]},
+            'sportList': lambda **_: [{'__typename': 'Sport', 'id': str(i), 'name': name, 'slug': slug,
+                                       'fixtureCount': 10 + i} for i, (slug, name, _) in enumerate(self.SPORTS)],
+            'fixtureCount': lambda **_: 1234,
+            'bet': lambda iid=None, betId=None: self.bet(int(iid.split(':')[1]) - 10000000) if iid else None,
+            'user': lambda: None,
+        }
+
+    def arrived(self, now=None):
+        return int(((now or time.time()) - self.start) * self.rate)
+
+    def bets(self, limit, highroller=False):
+        limit = min(limit, 50)
+        newest = self.arrived()
+        numbers = range(newest, -1, -1)
+        if highroller:
+            numbers = range(newest - newest % 10, -1, -10)
+        return [self.bet(n) for n in numbers[:limit]]
+
+    def bet(self, n):
+        if self.recorded:
+            bet = copy.deepcopy(self.recorded[n % len(self.recorded)])
+            bet['iid'] = f'sport:{10000000 + n}'
+            bet['id'] = f'bet-{n}'
+            return bet
+        rng = random.Random(self.seed * 1000003 + n)
+        currency = rng.choice(list(self.CURRENCIES))
+        usd = rng.uniform(10000, 200000) if n % 10 == 0 else rng.uniform(1, 2000)
+        created = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(self.start + n / self.rate))
+        outcomes = []
+        for leg in range(rng.choice((1, 1, 1, 2, 3))):
+            slug, sport, tournament = rng.choice(self.SPORTS)
+            home, away = f'{tournament} Team {rng.randint(1, 30)}', f'{tournament} Team {rng.randint(31, 60)}'
+            outcomes.append({
+                '__typename': 'SportBetOutcome',
+                'odds': round(rng.uniform(1.1, 5), 2),
+                'fixture': {
+                    '__typename': 'SportFixture',
+                    'id': f'fixture-{n}-{leg}',
+                    'name': f'{home} - {away}',
+                    'data': {'__typename': 'SportFixtureDataMatch', 'startTime': created,
+                             'competitors': [{'__typename': 'SportFixtureCompetitor', 'name': home,
+                                              'abbreviation': home[:3].upper()},
+                                             {'__typename': 'SportFixtureCompetitor', 'name': away,
+                                              'abbreviation': away[:3].upper()}]},
+                    'tournament': {'__typename': 'SportTournament', 'id': tournament, 'name': tournament,
+                                   'category': {'__typename': 'SportCategory', 'id': sport, 'name': sport,
+                                                'sport': {'__typename': 'Sport', 'id': slug, 'name': sport,
+                                                          'slug': slug}}},
+                },
+            })
+        multiplier = 1.0
+        for outcome in outcomes:
+            multiplier *= outcome['odds']
+        amount = usd / self.CURRENCIES[currency]
+        return {
+            '__typename': 'Bet', 'id': f'bet-{n}', 'iid': f'sport:{10000000 + n}', 'type': 'sport',
+            'scope': 'sport', 'game': None,
+            'bet': {
+                '__typename': 'SportBet', 'id': f'sport-bet-{n}', 'active': n % 3 != 0,
+                'status': 'confirmed' if n % 3 else 'settled', 'amount': amount, 'currency': currency,
+                'cashoutMultiplier': 0, 'createdAt': created, 'updatedAt': created, 'payout': 0,
+                'payoutMultiplier': 0, 'potentialMultiplier': round(multiplier, 4),
+                'user': {'__typename': 'User', 'id': f'user-{n % 997}', 'name': f'player{n % 997}'},
+                'outcomes': outcomes,
+            },
+        }
+
+    def execute(self, body):
+        '''
+        Response: dictionary, the GraphQL response to a request body
+        '''
+        try:
+            operations, fragments = parse_document(body.get('query') or '')
+            name = body.get('operationName')
+            operation = next((o for o in operations if name is None or o[1] == name), None)
+            if operation is None:
+                raise GraphQLError(f'Unknown operation {name!r}')
+            variables = body.get('variables') or {}
+            data = {}
+            for selection in operation[2]:
+                if selection[0] != 'field':
+                    raise GraphQLError('Fragments on the root type are not supported')
+                _, alias, field, arguments, subselection = selection
+                if field not in self.resolvers:
+                    raise GraphQLError(f'Unknown field {field!r}')
+                value = self.resolvers[field](**_argument_values(arguments, variables))
+                data[alias] = project(value, subselection, fragments) if subselection else value
+            return {'data': data}
+        except (GraphQLError, TypeError, KeyError) as e:
+            return {'errors': [{'message': str(e)}], 'data': None}
+
+
+    def publish(self, body, after, until):
+        '''
+        Response: list of the results of a subscription request body for the bets numbered after < n <= until
+        '''
+        operations, fragments = parse_document(body.get('query') or '')
+        name = body.get('operationName')
+        operation = next((o for o in operations if name is None or o[1] == name), None)
+        if operation is None or operation[0] != 'subscription':
+            raise GraphQLError(f'Unknown subscription {name!r}')
+        if len(operation[2]) != 1 or operation[2][0][0] != 'field':
+            raise GraphQLError('Subscriptions have one root field')
+        _, alias, field, _, subselection = operation[2][0]
+        if field not in self.SUBSCRIPTIONS:
+            raise GraphQLError(f'Unknown subscription field {field!r}')
+        return [{'data': {alias: project(self.bet(n), subselection, fragments) if subselection else self.bet(n)}}
+                for n in range(after + 1, until + 1) if self.SUBSCRIPTIONS[field](n)]
+
+
+class StandInGraphQLServer(object):
+    '''
+    HTTP/1.1 keep-alive server for a StakeStandIn, in a background thread.
+
+    connect_delay: seconds added to every new connection, e.g. the TCP and TLS handshakes to api.stake.com
+    latency: seconds added to every request
+    '''
+
+    def __init__(self, stand_in=None, host='127.0.0.1', port=0, connect_delay=0.0, latency=0.0):
+        super(StandInGraphQLServer, self).__init__()
+        self.stand_in = stand_in or StakeStandIn()
+        self.connect_delay = connect_delay
+        self.latency = latency
+        self.connections = 0
+        self.requests = 0
+        # Not name-mangled, the request handler class updates the counters
+        self._lock = threading.Lock()
+        self.__server = http.server.ThreadingHTTPServer((host, port), self.__handler())
+        self.__server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.__server.server_address[:2]
+        return f'http://{host}:{port}/graphql'
+
+    def start(self):
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def __handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, Nagle would hold the body for the delayed ACK
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+                time.sleep(server.connect_delay)
+
+            def do_POST(self):
+                with server._lock:
+                    server.requests += 1
+                time.sleep(server.latency)
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                except ValueError:
+                    self.send_error(400)
+                    return
+                if isinstance(body, list):
+                    response = [server.stand_in.execute(b) for b in body]
+                else:
+                    response = server.stand_in.execute(body)
+                self.__respond(json.dumps(response).encode('utf-8'))
+
+            def __respond(self, payload):
+                accepted = self.headers.get('Accept-Encoding', '')
+                encoding = None
+                if brotli is not None and 'br' in accepted:
+                    payload, encoding = brotli.compress(payload), 'br'
+                elif 'gzip' in accepted:
+                    payload, encoding = gzip.compress(payload, 6), 'gzip'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class StandInWebSocketServer(object):
+    '''
+    GraphQL over websocket server for a StakeStandIn (graphql-transport-ws protocol), in a background thread.
+
+    A subscription publishes the bets arriving after it started.
+    drop_after: close every connection after that many results, to exercise the reconnections of the clients
+    '''
+
+    def __init__(self, stand_in=None, host='127.0.0.1', port=0, drop_after=None):
+        super(StandInWebSocketServer, self).__init__()
+        self.stand_in = stand_in or StakeStandIn()
+        self.host = host
+        self.port = port
+        self.drop_after = drop_after
+        self.connections = 0
+        self.published = 0
+        self.__loop = None
+        self.__runner = None
+
+    @property
+    def url(self):
+        return f'ws://{self.host}:{self.port}/websockets'
+
+    def start(self):
+        # aiohttp is only needed for the websocket server
+        from aiohttp import web
+
+        self.__loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get('/websockets', self.__websocket)
+        self.__runner = web.AppRunner(app)
+        self.__loop.run_until_complete(self.__runner.setup())
+        site = web.TCPSite(self.__runner, self.host, self.port)
+        self.__loop.run_until_complete(site.start())
+        self.port = self.__runner.addresses[0][1]
+        threading.Thread(target=self.__loop.run_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.__runner.cleanup(), self.__loop).result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    async def __websocket(self, request):
+        from aiohttp import web
+
+        ws = web.WebSocketResponse(protocols=('graphql-transport-ws',))
+        await ws.prepare(request)
+        self.connections += 1
+        subscriptions = {}
+        try:
+            async for message in ws:
+                if message.type != web.WSMsgType.TEXT:
+                    break
+                message = json.loads(message.data)
+                if message['type'] == 'connection_init':
+                    await ws.send_json({'type': 'connection_ack'})
+                elif message['type'] == 'ping':
+                    await ws.send_json({'type': 'pong'})
+                elif message['type'] == 'subscribe':
+                    subscriptions[message['id']] = asyncio.ensure_future(
+                        self.__publish(ws, message['id'], message['payload']))
+                elif message['type'] == 'complete' and message.get('id') in subscriptions:
+                    subscriptions.pop(message['id']).cancel()
+        finally:
+            for subscription in subscriptions.values():
+                subscription.cancel()
+        return ws
+
+    async def __publish(self, ws, id, body):
+        after, sent = self.stand_in.arrived(), 0
+        while not ws.closed:
+            await asyncio.sleep(min(0.05, 1 / self.stand_in.rate))
+            until = self.stand_in.arrived()
+            try:
+                results = self.stand_in.publish(body, after, until)
+            except GraphQLError as e:
+                await ws.send_json({'id': id, 'type': 'error', 'payload': [{'message': str(e)}]})
+                return
+            after = until
+            for result in results:
+                await ws.send_json({'id': id, 'type': 'next', 'payload': result})
+                self.published += 1
+                sent += 1
+                if self.drop_after and sent >= self.drop_after:
+                    await ws.close()
+                    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Stake GraphQL API')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on (default:8000)')
+    parser.add_argument('-r', '--rate', type=float, default=2.0, help='New bets per second (default:2)')
+    parser.add_argument('--connect-delay', type=float, default=0.0,
+                        help='Seconds added to every new connection (default:0)')
+    parser.add_argument('-w', '--ws-port', type=int, default=None,
+                        help='Port of the websocket server for subscriptions (default:no websocket server)')
+    parser.add_argument('--drop-after', type=int, default=None,
+                        help='Close the websockets after that many bets, to test reconnections (default:never)')
+    parser.add_argument('--replay', default=None,
+                        help='Replay the bets recorded in this file by stake_collector.py --record')
+    args = parser.parse_args()
+
+    recorded = None
+    if args.replay:
+        with open(args.replay) as f:
+            recorded = [json.loads(line) for line in f if line.strip()]
+    stand_in = StakeStandIn(rate=args.rate, recorded=recorded)
+    servers = [StandInGraphQLServer(stand_in, port=args.port, connect_delay=args.connect_delay).start()]
+    if args.ws_port is not None:
+        servers.append(StandInWebSocketServer(stand_in, port=args.ws_port, drop_after=args.drop_after).start())
+    print(f'Serving {", ".join(server.url for server in servers)}, press Ctrl-C to stop.')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.stop()